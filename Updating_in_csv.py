@@ -1,10 +1,28 @@
 import os
 import json
-import csv
 from azure.ai.formrecognizer import DocumentAnalysisClient
 from azure.core.credentials import AzureKeyCredential
 from dotenv import load_dotenv
-from openai import AzureOpenAI
+from openai_clients import get_openai_client
+from ocr_correction import correct_pages_batched, build_batch_prompt, split_by_confidence, merge_pages
+from ocr_result import document_details_from_result, ocr_pages, confidences_by_page
+from ocr_cache import ocr_cache_from_env
+from pdf_text_layer import details_with_text_layer
+from page_dedup import page_index_from_env
+from llm_cache import llm_cache_from_env
+from rate_limiter import rate_limiter_from_env, estimate_request_tokens
+from metrics import timed_stage, track_document, document_context, count_pages, count_cache_lookup, record_llm_usage, LLM_REQUESTS, print_metrics_summary
+from csv_sink import AppendOnlyCSVWriter
+from result_store import SQLiteResultStore
+from manifest import manifest_from_env, is_settled, watch, STATUS_SUCCEEDED, STATUS_FAILED
+from batch_runner import run_batch, print_batch_summary
+from stage_pipeline import Stage, run_pipeline, print_stage_summary
+from chunked_extraction import extract_in_windows
+from field_prefill import prefill_fields, remaining_fields, merge_prefilled
+from streaming_pipeline import iter_corrected_pages, extract_streaming
+from metadata_parser import parse_json_metadata, response_format_for, extract_fields
+from prompt_builder import build_extraction_prompt
+from field_schemas import document_type_for, fields_for, validate_answers
 
 
 load_dotenv()
@@ -21,71 +39,236 @@ document_analysis_client = DocumentAnalysisClient(
 document_directory = r"D:/testingoffice/testingDocumentType"
 csv_file_path = r"D:/testingoffice/metadata.csv"
 
-
-
-def analyze_document(document_path):
+# number of pages sent to the LLM at the same time during OCR correction
+ocr_correction_workers = int(os.getenv("OCR_CORRECTION_WORKERS", "4"))
+
+# short pages are packed into one correction request up to this many (estimated) tokens, 0 = one request per page
+ocr_batch_token_budget = int(os.getenv("OCR_BATCH_TOKEN_BUDGET", "600"))
+
+# pages whose average OCR word confidence is at least this high are not sent to the LLM, 0 = correct every page
+ocr_confidence_threshold = float(os.getenv("OCR_CONFIDENCE_THRESHOLD", "0.95"))
+
+# OCR model and the on-disk cache of its results, keyed by file content hash and model id
+ocr_model_id = "prebuilt-document"
+# seconds to wait for an OCR result (0 = no limit), so a stuck poll gives the batch worker back
+ocr_timeout = float(os.getenv("OCR_TIMEOUT", "300"))
+ocr_cache = ocr_cache_from_env()
+
+# born-digital PDFs: pages with a clean embedded text layer are read locally (needs the optional pypdf package)
+# and skip both Azure OCR and LLM correction, only image-only pages are sent to OCR
+pdf_text_layer_enabled = os.getenv("PDF_TEXT_LAYER", "1") == "1"
+pdf_text_layer_min_chars = int(os.getenv("PDF_TEXT_LAYER_MIN_CHARS", "100"))
+
+# near-duplicates of already corrected pages (riders, notary acknowledgements, disclaimers) reuse that correction.
+# pages repeated in PAGE_DEDUP_BOILERPLATE_DOCUMENTS documents go last in the extraction input,
+# or are left out of it with PAGE_DEDUP_SKIP_BOILERPLATE=1
+page_index = page_index_from_env()
+skip_boilerplate_pages = os.getenv("PAGE_DEDUP_SKIP_BOILERPLATE", "0") == "1"
+
+# opt-in cache of LLM responses (LLM_CACHE_ENABLED=1), pass bypass_cache=True to skip it for one call
+llm_cache = llm_cache_from_env()
+
+# every LLM call is throttled against the deployment's quota (OPENAI_RPM / OPENAI_TPM, 0 = no limit),
+# rate limited and failed requests are retried with backoff
+rate_limiter = rate_limiter_from_env()
+
+# metadata.csv is appended to, "always" fsyncs every row, "interval" every CSV_FSYNC_INTERVAL rows, "never" only flushes
+csv_fsync_policy = os.getenv("CSV_FSYNC_POLICY", "interval")
+csv_fsync_interval = int(os.getenv("CSV_FSYNC_INTERVAL", "50"))
+csv_writers = {}
+
+# where results are written: "csv" (csv_file_path), "sqlite" (an indexed database at RESULT_DB_PATH,
+# default next to the CSV) or both, e.g. "csv,sqlite". see result_store.py for queries and Parquet export
+result_sinks = [sink.strip() for sink in os.getenv("RESULT_SINK", "csv").split(",") if sink.strip()]
+result_db_path = os.getenv("RESULT_DB_PATH") or os.path.splitext(csv_file_path)[0] + ".sqlite"
+
+# what was already processed, by path, size, mtime and content hash, so reruns only pick up new or changed files.
+# WATCH_MODE=1 scans document_directory again every WATCH_INTERVAL seconds, files modified in the last
+# WATCH_SETTLE_SECONDS are left for the next scan in case they are still being copied in
+document_manifest = manifest_from_env(csv_file_path + ".manifest.jsonl")
+watch_mode = os.getenv("WATCH_MODE", "0") == "1"
+watch_interval = float(os.getenv("WATCH_INTERVAL", "30"))
+watch_settle_seconds = float(os.getenv("WATCH_SETTLE_SECONDS", "10"))
+
+# batch runs: files processed at the same time, "thread" or "process" workers, per-file timeout in seconds (0 = none)
+# counted from when a worker starts the file
+batch_workers = int(os.getenv("BATCH_WORKERS", "1"))
+batch_mode = os.getenv("BATCH_MODE", "thread")
+batch_file_timeout = float(os.getenv("BATCH_FILE_TIMEOUT", "0"))
+
+# BATCH_MODE=pipeline: OCR, correction and extraction of different documents overlap instead. each stage has its own
+# workers and a queue of at most PIPELINE_QUEUE_SIZE documents in front of it (no per-file timeout in this mode)
+pipeline_ocr_workers = int(os.getenv("PIPELINE_OCR_WORKERS", "4"))
+pipeline_correction_workers = int(os.getenv("PIPELINE_CORRECTION_WORKERS", "2"))
+pipeline_extraction_workers = int(os.getenv("PIPELINE_EXTRACTION_WORKERS", "2"))
+pipeline_queue_size = int(os.getenv("PIPELINE_QUEUE_SIZE", "8"))
+
+# documents longer than one window are extracted window by window in parallel and the results merged
+extraction_window_tokens = int(os.getenv("EXTRACTION_WINDOW_TOKENS", "3000"))
+extraction_workers = int(os.getenv("EXTRACTION_WORKERS", "4"))
+extraction_max_attempts = int(os.getenv("EXTRACTION_MAX_ATTEMPTS", "3"))
+# "text" (JSON asked for in the prompt), "json_object" (JSON mode) or "json_schema" (strict structured output)
+extraction_response_format = os.getenv("EXTRACTION_RESPONSE_FORMAT", "text")
+
+# "staged" finishes each stage for all pages before the next one starts, "streaming" feeds corrected pages into
+# extraction as they are ready. OCR_PAGES limits OCR to a page range such as "1-3" (empty = every page)
+pipeline_mode = os.getenv("PIPELINE_MODE", "staged")
+ocr_pages_range = os.getenv("OCR_PAGES") or None
+
+# documents in a folder named after a known type (DEED, DEED_OF_TRUST, SETTLEMENT_STATEMENT, ...) get that type,
+# everything else this one. the type decides which fields are asked for, see field_schemas.py
+default_document_type = os.getenv("DOCUMENT_TYPE", "DEED")
+
+
+
+@timed_stage("ocr")
+def analyze_document_details(document_path, pages=None):
+    # pages is an optional 1-based range such as "1-3" or "1,4-5", only those pages are read
+    if pdf_text_layer_enabled:
+        return details_with_text_layer(document_path, pages, ocr_document_details, pdf_text_layer_min_chars)
+    return ocr_document_details(document_path, pages)
+
+def ocr_document_details(document_path, pages=None):
     try:
+        cache_key = ocr_cache.key_for(document_path, ocr_model_id, pages)
+        cached_details = ocr_cache.get(cache_key)
+        if cache_key is not None:
+            count_cache_lookup("ocr", cached_details is not None)
+        if cached_details is not None:
+            count_pages("ocr_cached", len(cached_details["pages"]))
+            print(f"Using cached OCR result for {document_path}")
+            return cached_details
+
+        # the open file is streamed to Azure instead of being read into memory first
+        analyze_options = {"pages": pages} if pages else {}
         with open(document_path, "rb") as f:
             poller = document_analysis_client.begin_analyze_document(
-                "prebuilt-document", document=f.read()
+                ocr_model_id, document=f, **analyze_options
             )
-        result = poller.result()
-
-        extracted_data = []
-        for page in result.pages:
-            page_content = " ".join([line.content for line in page.lines])
-            extracted_data.append({str(page.page_number - 1): page_content})
-        return extracted_data
+        result = poller.result(timeout=ocr_timeout or None)
+        if not poller.done():
+            raise TimeoutError(f"OCR did not finish within {ocr_timeout} seconds")
+
+        document_details = document_details_from_result(result)
+        ocr_cache.set(cache_key, document_details, model_id=ocr_model_id, source=document_path)
+        count_pages("ocr", len(document_details["pages"]))
+        return document_details
     except Exception as e:
         print(f"Error during document analysis: {e}")
         raise
 
-def process_ocr_output(ocr_output):
-    try:
-        corrected_output_parts = []
-
-        for page in ocr_output:
-            page_content = list(page.values())[0]
-            messages = f"Correct the following OCR text:\n{page_content}"
-            response = get_openai_response(messages)
-            corrected_output_parts.append({list(page.keys())[0]: response})
+def analyze_document(document_path, pages=None):
+    return ocr_pages(analyze_document_details(document_path, pages))
 
-        return corrected_output_parts
+@timed_stage("correction")
+def process_ocr_output(ocr_output, max_workers=None, token_budget=None, page_confidences=None, stats=None, document_id=None):
+    if max_workers is None:
+        max_workers = ocr_correction_workers
+    if token_budget is None:
+        token_budget = ocr_batch_token_budget
+    try:
+        # near-duplicates of pages corrected before take that correction instead of another LLM call
+        pages_to_check, reused_pages, boilerplate = page_index.split_reusable(ocr_output, document_id)
+        if reused_pages:
+            print(f"Reusing the correction of {len(reused_pages)} of {len(ocr_output)} near-duplicate pages")
+        pages_to_correct, skipped_pages = split_by_confidence(pages_to_check, page_confidences, ocr_confidence_threshold)
+        if skipped_pages:
+            print(f"Skipping LLM correction for {len(skipped_pages)} of {len(ocr_output)} pages with high OCR confidence")
+        if stats is not None:
+            stats["pages_corrected"] = len(pages_to_correct)
+            stats["pages_skipped"] = len(skipped_pages)
+            stats["pages_reused"] = len(reused_pages)
+            stats["boilerplate_pages"] = boilerplate
+        count_pages("corrected", len(pages_to_correct))
+        count_pages("skipped", len(skipped_pages))
+        count_pages("reused", len(reused_pages))
+        corrected_pages = correct_pages_batched(pages_to_correct, correct_ocr_page, correct_ocr_batch, token_budget, max_workers)
+        # skipped and failed pages are indexed without a correction, they only count towards boilerplate
+        page_index.remember(pages_to_check, corrected_pages, document_id)
+        return merge_pages(ocr_output, reused_pages + corrected_pages)
     except json.JSONDecodeError as e:
         print(f"Error parsing corrected JSON: {e}")
         raise
 
-def get_openai_response(messages):
+def correct_ocr_page(page_content):
+    messages = f"Correct the following OCR text:\n{page_content}"
+    return get_openai_response(messages)
+
+def correct_ocr_batch(pages):
+    messages = build_batch_prompt("Correct the following OCR text.", pages)
+    return get_openai_response(messages)
+
+def get_openai_response(messages, bypass_cache=False, response_format=None, validate=None):
+    # validate(response_text) is true for a usable response. only those are cached, so a retry after an
+    # unparseable answer asks the model again instead of getting the same text back from the cache
+    chat_messages = [
+        {"role": "user", "content": messages}
+    ]
+    cache_key = None if bypass_cache else llm_cache.key_for("gpt-3.5-turbo", "aipal", chat_messages, 800, response_format=response_format)
+    cached_response = llm_cache.get(cache_key)
+    if cached_response is not None and validate is not None and not validate(cached_response):
+        cached_response = None
+    if cache_key is not None:
+        count_cache_lookup("llm", cached_response is not None)
+    if cached_response is not None:
+        LLM_REQUESTS.inc(result="cached")
+        return cached_response
     try:
-        client = AzureOpenAI(
-            api_key=os.getenv("OPENAI_API_KEY"),
-            api_version="2024-07-01-preview",  
-            azure_endpoint=os.getenv("OPENAI_ENDPOINT"),
-            azure_deployment="aipal",
-        )
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "user", "content": messages}
-            ],
-            max_tokens=800
+        client = get_openai_client("azure")
+        response = rate_limiter.call(
+            lambda: client.chat.completions.create(
+                model="gpt-3.5-turbo",
+                messages=chat_messages,
+                max_tokens=800,
+                **({"response_format": response_format} if response_format else {})
+            ),
+            estimate_request_tokens(chat_messages, 800),
         )
-        return response.choices[0].message.content.strip()
+        record_llm_usage(response)
+        response_text = response.choices[0].message.content.strip()
+        if validate is None or validate(response_text):
+            llm_cache.set(cache_key, response_text)
+        return response_text
     except Exception as e:
+        LLM_REQUESTS.inc(result="error")
         print(f"Error fetching response from OpenAI: {e}")
         return None
 
-def get_metadata(content):
-    prompt = f"""
+# fields extracted by get_metadata
+metadata_fields = [
+    'Seller Name',
+    'Seller Suffix',
+    'Seller Relationship',
+    'Seller Current Address',
+    'Seller Same as Property address',
+    'Seller City',
+    'Seller State',
+    'Seller Zip Code',
+    'Seller Email address',
+    'Seller WorkPhone /Ext:',
+    'Seller Fax',
+    'Seller Marketing Rep',
+    'Seller Marketing Source',
+    'Buyer Name',
+    'Buyer Suffix',
+    'Buyer Relationship',
+    'Buyer Current Address',
+    'Buyer Same as Property address',
+    'Buyer City',
+    'Buyer State',
+    'Buyer Zip Code',
+    'Buyer Email address',
+    'Buyer WorkPhone /Ext:',
+    'Buyer Fax',
+    'Buyer Marketing Rep',
+    'Buyer Marketing Source',
+]
+
+# static part of the extraction prompt, the field list and then the document text are appended after it
+metadata_instructions = """
     You are an AI assistant tasked with extracting specific metadata fields from a document. Your goal is to accurately extract all required fields from the given document text. Follow these instructions carefully:
-    1. Here is the full text of the document:
-    <document_text>
-    {content}
-    </document_text>
-    2. You need to extract information for the following fields:
-    <fields_to_extract>
-    Seller Name, Seller Suffix, Seller Relationship, Seller Current Address, Seller Same as Property address, Seller City, Seller State, Seller Zip Code, Seller Email address, Seller WorkPhone /Ext:, Seller Fax, Seller Marketing Rep, Seller Marketing Source, Buyer Name, Buyer Suffix, Buyer Relationship, Buyer Current Address, Buyer Same as Property address, Buyer City, Buyer State, Buyer Zip Code, Buyer Email address, Buyer WorkPhone /Ext:, Buyer Fax, Buyer Marketing Rep, Buyer Marketing Source
-    </fields_to_extract>
+    1. You need to extract information for the fields listed in <fields_to_extract> below.
+    2. The full text of the document follows the field list, in <document_text>.
     3. To extract the information:
     a. Carefully read through the entire document text.
     b. For each field listed, search for relevant information within the document.
@@ -97,56 +280,196 @@ def get_metadata(content):
     c. If the field is not found, return it with a value "Not provided".
     d. The JSON object should be human-readable, with field names as keys and their corresponding extracted values as values.
     """
-    try:
-        response = get_openai_response(prompt)
+
+def build_metadata_prompt(content, fields):
+    return build_extraction_prompt(metadata_instructions, fields, content, field_separator=", ")
+
+@timed_stage("extraction")
+def get_metadata(content, fields=None):
+    if fields is None:
+        fields = metadata_fields
+
+    def parse(response, fields_to_ask):
+        return validate_answers(parse_json_metadata(response, fields_to_ask))
+
+    def ask(fields_to_ask):
+        response = get_openai_response(
+            build_metadata_prompt(content, fields_to_ask),
+            response_format=response_format_for(extraction_response_format, fields_to_ask),
+            validate=lambda response: parse(response, fields_to_ask),
+        )
         if response is None:
             print("OpenAI API returned None. Check API key and quota.")
             return None
 
         print("OpenAI response:")
         print(response)
+        return response
 
-        # Parse the response as JSON
-        metadata = json.loads(response)
-        return metadata
+    try:
+        # fields missing from a malformed or partial answer are asked for again on their own
+        return extract_fields(
+            ask,
+            parse,
+            fields,
+            extraction_max_attempts,
+        )
     except Exception as e:
         print(f"Failed to parse OpenAI response: {e}")
         return None
 
-def process_document(file_path):
+# the stages of process_document. BATCH_MODE=pipeline runs each of them on its own workers,
+# the document dict returned by one stage is what the next one takes
+def ocr_document(file_path, pages=None, document_type=None):
+    if pages is None:
+        pages = ocr_pages_range
+    # only the fields this type of document can contain are asked for
+    fields = fields_for(document_type or document_type_for(file_path, default_document_type), metadata_fields)
+    print(f"Starting document analysis for file: {file_path}")
+    document_details = analyze_document_details(file_path, pages)
+    extracted_data = ocr_pages(document_details)
+    if not extracted_data:
+        print("No data extracted from OCR")
+        return {"error": "No data extracted"}
+    return {"file_path": file_path, "fields": fields, "document_details": document_details, "pages": extracted_data}
+
+def correct_document(document):
+    ocr_stats = {}
+    processed_data = process_ocr_output(
+        document["pages"],
+        page_confidences=confidences_by_page(document["document_details"]),
+        stats=ocr_stats,
+        document_id=document["file_path"],
+    )
+    document["pages"] = page_index.order_for_extraction(
+        processed_data, ocr_stats["boilerplate_pages"], skip_boilerplate_pages
+    )
+    return document
+
+def extract_document(document):
+    fields = document["fields"]
+    # fields Azure already paired with a value are filled directly, the LLM is only asked for the rest
+    prefilled = prefill_fields(document["document_details"].get("key_value_pairs"), fields)
+    fields_to_ask = remaining_fields(fields, prefilled)
+    if prefilled:
+        print(f"Pre-filled {len(prefilled)} of {len(fields)} fields from OCR key-value pairs")
+    if not fields_to_ask:
+        return prefilled
+
+    fields_and_answers = extract_in_windows(
+        document["pages"],
+        lambda window: get_metadata(window, fields_to_ask),
+        extraction_window_tokens,
+        max_workers=extraction_workers,
+        max_attempts=1,
+    )
+
+    if fields_and_answers is None:
+        return {"error": "Failed to extract metadata from OpenAI"}
+    else:
+        return merge_prefilled(fields_and_answers, prefilled, fields)
+
+@track_document(default_document_type=default_document_type)
+def process_document(file_path, pages=None, document_type=None):
     try:
-        print(f"Starting document analysis for file: {file_path}")
-        extracted_data = analyze_document(file_path)
+        document = ocr_document(file_path, pages, document_type)
+        if "error" in document:
+            return document
+        return extract_document(correct_document(document))
+    except Exception as e:
+        print(f"Error in process_document: {str(e)}")
+        return {"error": str(e)}
+    
+@track_document(default_document_type=default_document_type)
+def process_document_streaming(file_path, pages=None, document_type=None):
+    if pages is None:
+        pages = ocr_pages_range
+    # only the fields this type of document can contain are asked for
+    fields = fields_for(document_type or document_type_for(file_path, default_document_type), metadata_fields)
+    try:
+        print(f"Starting streaming document analysis for file: {file_path}")
+        document_details = analyze_document_details(file_path, pages)
+        extracted_data = ocr_pages(document_details)
         if not extracted_data:
             print("No data extracted from OCR")
             return {"error": "No data extracted"}
 
-        processed_data = process_ocr_output(extracted_data)
-        fields_and_answers = get_metadata(processed_data)
+        prefilled = prefill_fields(document_details.get("key_value_pairs"), fields)
+        fields_to_ask = remaining_fields(fields, prefilled)
+        if not fields_to_ask:
+            return prefilled
+
+        # pages go to extraction as soon as they are corrected instead of waiting for the whole document
+        corrected_pages = iter_corrected_pages(
+            extracted_data,
+            page_index.reusing(correct_ocr_page, file_path),
+            max_workers=ocr_correction_workers,
+            page_confidences=confidences_by_page(document_details),
+            confidence_threshold=ocr_confidence_threshold,
+        )
+        fields_and_answers = extract_streaming(
+            corrected_pages,
+            lambda window: get_metadata(window, fields_to_ask),
+            extraction_window_tokens,
+            max_workers=extraction_workers,
+            max_attempts=1,
+        )
 
         if fields_and_answers is None:
             return {"error": "Failed to extract metadata from OpenAI"}
         else:
-            return fields_and_answers
+            return merge_prefilled(fields_and_answers, prefilled, fields)
     except Exception as e:
-        print(f"Error in process_document: {str(e)}")
+        print(f"Error in process_document_streaming: {str(e)}")
         return {"error": str(e)}
-    
+
 def ensure_directory_exists(directory_path):
     if not os.path.exists(directory_path):
         os.makedirs(directory_path)
 
+def get_csv_writer(csv_file_path):
+    # one open append-only writer per CSV file for the whole run
+    if csv_file_path not in csv_writers:
+        csv_writers[csv_file_path] = AppendOnlyCSVWriter(
+            csv_file_path,
+            leading_fields=['office name', 'document type', 'filename'],
+            # a file processed again after it changed replaces its earlier row
+            key_fields=['office name', 'document type', 'filename'],
+            fsync_policy=csv_fsync_policy,
+            fsync_interval=csv_fsync_interval,
+        )
+    return csv_writers[csv_file_path]
+
+def get_result_store(db_path):
+    # kept with the CSV writers so close_csv_writers closes it too
+    if db_path not in csv_writers:
+        csv_writers[db_path] = SQLiteResultStore(db_path)
+    return csv_writers[db_path]
+
+def get_result_writers(csv_file_path):
+    writers = []
+    if "csv" in result_sinks:
+        writers.append(get_csv_writer(csv_file_path))
+    if "sqlite" in result_sinks:
+        writers.append(get_result_store(result_db_path))
+    return writers
+
+def close_csv_writers():
+    # rewrites each header once so it lists every field that showed up during the run, and drops the rows
+    # of reprocessed files that were replaced by a newer row
+    while csv_writers:
+        csv_file_path, writer = csv_writers.popitem()
+        try:
+            writer.close()
+        except Exception as e:
+            print(f"Error while closing CSV {csv_file_path}: {e}")
+
+@timed_stage("csv")
 def update_csv(fields_and_answers, csv_file_path, office_name, document_type, filename):
     try:
         # Ensure the directory exists
         ensure_directory_exists(os.path.dirname(csv_file_path))
 
-        # Define the new fields we want to add
-        new_fields = ['office name', 'document type', 'filename']
-
-        # Combine all fields
-        all_fields = new_fields + [field for field in fields_and_answers.keys() if field not in new_fields]
-
         # Prepare the row data
         row_data = {
             'office name': office_name,
@@ -155,55 +478,118 @@ def update_csv(fields_and_answers, csv_file_path, office_name, document_type, fi
         }
         row_data.update(fields_and_answers)
 
-        # Check if the file exists and read its current content
-        file_exists = os.path.exists(csv_file_path)
-        existing_data = []
-        if file_exists:
-            with open(csv_file_path, 'r', newline='') as f:
-                reader = csv.DictReader(f)
-                existing_data = list(reader)
-                existing_fields = reader.fieldnames
-
-            # Update all_fields to include any missing existing fields
-            for field in existing_fields:
-                if field not in all_fields:
-                    all_fields.append(field)
-
-        # Write to CSV
-        with open(csv_file_path, 'w', newline='') as f:
-            writer = csv.DictWriter(f, fieldnames=all_fields)
-            writer.writeheader()
-            for row in existing_data:
-                writer.writerow(row)
-            writer.writerow(row_data)
+        # Append the row, new fields are added to the header when the writer is closed.
+        # the first sink decides whether the file counts as done; a failed write to a second sink is only
+        # logged, so the file isn't processed again and appended twice to the first one
+        primary, *secondary = get_result_writers(csv_file_path)
+        primary.write_row(row_data)
+        for writer in secondary:
+            try:
+                writer.write_row(row_data)
+            except Exception as e:
+                print(f"Error while writing {filename} to {type(writer).__name__}, it is only in {type(primary).__name__}: {e}")
 
         print(f"Successfully updated CSV for file: {filename}")
+        return row_data
 
     except Exception as e:
         print(f"Error while updating CSV: {e}")
 
 
-def process_all_documents(directory_path):
+def process_all_documents(directory_path, max_workers=None, mode=None, timeout=None, settle_seconds=0):
+    if max_workers is None:
+        max_workers = batch_workers
+    if mode is None:
+        mode = batch_mode
+    if timeout is None:
+        timeout = batch_file_timeout
+    dedup_before = page_index.stats()
+
+    file_paths = []
+    file_details = []
+    unchanged = 0
     for root, dirs, files in os.walk(directory_path):
         for file_name in files:
             if file_name.endswith((".pdf", ".jpg", ".jpeg", ".png")):  # Add extensions as needed
                 file_path = os.path.join(root, file_name)
+                if not is_settled(file_path, settle_seconds):
+                    continue
+                # files processed before and unchanged since are not queued again
+                fingerprint = document_manifest.check(file_path)
+                if fingerprint is None:
+                    unchanged += 1
+                    continue
                 
                 office_name = "bangalore"  # here we should mention the 'office name' 
-                document_type = 'DEED'  # here 'document type' 
-
-                print(f"Processing file: {file_name} (Office: {office_name}, Document Type: {document_type})")
-                
-                
-                result = process_document(file_path)
-                if "error" not in result:
-                    update_csv(result, csv_file_path, office_name, document_type, file_name)
+                document_type = document_type_for(file_path, default_document_type)
+
+                print(f"Queueing file: {file_name} (Office: {office_name}, Document Type: {document_type})")
+                file_paths.append(file_path)
+                file_details.append((file_name, office_name, document_type, fingerprint))
+
+    if not file_paths:
+        return {"total": 0, "succeeded": 0, "failed": [], "unchanged": unchanged}
+    if unchanged:
+        print(f"Skipping {unchanged} files already processed and unchanged since")
+
+    def write_result(index, file_path, result):
+        # runs in file order on this thread only, so the CSV and the manifest have a single writer
+        file_name, office_name, document_type, fingerprint = file_details[index]
+        if "error" in result:
+            document_manifest.record(file_path, fingerprint, STATUS_FAILED, error=result["error"])
+            return
+        row = update_csv(result, csv_file_path, office_name, document_type, file_name)
+        if row is None:
+            document_manifest.record(file_path, fingerprint, STATUS_FAILED, error="Could not write the CSV row")
+        else:
+            document_manifest.record(file_path, fingerprint, STATUS_SUCCEEDED, row=row)
+
+    if mode == "pipeline":
+        stages = [
+            Stage("ocr", ocr_document, pipeline_ocr_workers),
+            Stage("correction", correct_document, pipeline_correction_workers),
+            Stage("extraction", extract_document, pipeline_extraction_workers),
+        ]
+        summary = run_pipeline(
+            file_paths, stages, write_result, pipeline_queue_size,
+            context_for=lambda file_path: document_context(file_path, default_document_type=default_document_type),
+        )
+    else:
+        process_file = process_document_streaming if pipeline_mode == "streaming" else process_document
+        summary = run_batch(file_paths, process_file, write_result, max_workers=max_workers, mode=mode, timeout=timeout)
+    summary["unchanged"] = unchanged
+    document_manifest.compact()
+    print_batch_summary(summary)
+    print_stage_summary(summary)
+    print_metrics_summary()
+    print(f"Near-duplicate pages in this batch: {page_index.stats_since(dedup_before)}")
+    return summary
+
+
+def process_new_documents():
+    # one watch mode scan, the CSV header is brought up to date after every batch that wrote rows
+    summary = process_all_documents(document_directory, settle_seconds=watch_settle_seconds)
+    if summary["total"]:
+        close_csv_writers()
+        print(f"Manifest: {document_manifest.stats()}")
 
 
 def main():
     # Process all documents in the directory
     print("Processing documents in directory...")
-    process_all_documents(document_directory)
+    try:
+        if watch_mode:
+            print(f"Watching {document_directory} for new or changed documents, press Ctrl+C to stop")
+            watch(process_new_documents, watch_interval)
+        elif not process_all_documents(document_directory)["total"]:
+            print("No new or changed documents")
+    finally:
+        close_csv_writers()
+        document_manifest.close()
+    print(f"OCR cache statistics: {ocr_cache.stats()}")
+    print(f"LLM cache statistics: {llm_cache.stats()}")
+    print(f"Rate limiter statistics: {rate_limiter.stats()}")
+    print(f"Near-duplicate page statistics: {page_index.stats()}")
     
 if __name__ == "__main__":
     main()
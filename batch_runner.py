@@ -0,0 +1,116 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+
+def run_batch(file_paths, process_file, write_result, max_workers=1, mode="thread", timeout=None):
+    # process_file(file_path) runs on the worker pool; write_result(index, file_path, result) always runs
+    # on the calling thread and in the original file order, so a single writer owns the output.
+    # a file that runs past `timeout` seconds, counted from when a worker picks it up, is reported as failed
+    # and its late result is ignored. process workers are killed and replaced: the other files that were running
+    # start again on the new pool. a thread can't be stopped, so it isn't given another file until it returns;
+    # process_file has to bound its own blocking calls (OCR_TIMEOUT, OPENAI_TIMEOUT) for it to come back.
+    started_at = time.time()
+    summary = {"total": len(file_paths), "succeeded": 0, "failed": []}
+    results = {}
+    next_to_write = 0
+    workers = max(1, max_workers)
+
+    executor_class = ProcessPoolExecutor if mode == "process" else ThreadPoolExecutor
+    executor = executor_class(max_workers=workers)
+    try:
+        # future -> [index, time a worker started it (None while queued)]
+        pending = {}
+        # timed out files that are still running
+        abandoned = set()
+        next_to_submit = 0
+        while next_to_write < len(file_paths):
+            abandoned = {future for future in abandoned if not future.done()}
+            while next_to_submit < len(file_paths) and len(pending) + len(abandoned) < workers:
+                future = executor.submit(process_file, file_paths[next_to_submit])
+                pending[future] = [next_to_submit, None]
+                next_to_submit += 1
+
+            done, _ = wait(
+                list(pending) + list(abandoned), timeout=0.25 if timeout else None, return_when=FIRST_COMPLETED
+            )
+            for future in done:
+                if future not in pending:
+                    continue
+                index, _ = pending.pop(future)
+                try:
+                    results[index] = future.result()
+                except Exception as e:
+                    results[index] = {"error": str(e)}
+
+            if timeout:
+                now = time.time()
+                timed_out = False
+                for future, entry in list(pending.items()):
+                    if entry[1] is None and future.running():
+                        entry[1] = now
+                    if entry[1] is not None and now - entry[1] > timeout and not future.done():
+                        future.cancel()
+                        pending.pop(future)
+                        if mode != "process":
+                            abandoned.add(future)
+                        results[entry[0]] = {"error": f"Timed out after {timeout} seconds"}
+                        timed_out = True
+                if timed_out and mode == "process":
+                    # files that finished in the meantime keep their result, the rest run again on a new pool
+                    for future in [future for future in pending if future.done()]:
+                        index, _ = pending.pop(future)
+                        try:
+                            results[index] = future.result()
+                        except Exception as e:
+                            results[index] = {"error": str(e)}
+                    terminate_process_pool(executor)
+                    executor = executor_class(max_workers=workers)
+                    for future, (index, _) in list(pending.items()):
+                        pending.pop(future)
+                        pending[executor.submit(process_file, file_paths[index])] = [index, None]
+
+            while next_to_write in results:
+                result = results.pop(next_to_write)
+                file_path = file_paths[next_to_write]
+                if isinstance(result, dict) and "error" in result:
+                    print(f"Failed to process {file_path}: {result['error']}")
+                    summary["failed"].append({"file": file_path, "error": result["error"]})
+                else:
+                    summary["succeeded"] += 1
+                try:
+                    write_result(next_to_write, file_path, result)
+                except Exception as e:
+                    print(f"Error writing result for {file_path}: {e}")
+                next_to_write += 1
+    finally:
+        # don't wait for abandoned (timed out) files before returning
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    elapsed = time.time() - started_at
+    summary["elapsed_seconds"] = round(elapsed, 2)
+    summary["documents_per_minute"] = round(summary["total"] / elapsed * 60, 2) if elapsed else 0.0
+    return summary
+
+
+def terminate_process_pool(executor):
+    # ProcessPoolExecutor can only stop its workers itself from Python 3.14 on (terminate_workers),
+    # before that the worker processes are terminated directly
+    if hasattr(executor, "terminate_workers"):
+        executor.terminate_workers()
+        return
+    processes = list((executor._processes or {}).values())
+    executor.shutdown(wait=False, cancel_futures=True)
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.join(timeout=5)
+
+
+def print_batch_summary(summary):
+    print(
+        f"Processed {summary['total']} documents in {summary['elapsed_seconds']}s "
+        f"({summary['documents_per_minute']} documents/minute), "
+        f"{summary['succeeded']} succeeded, {len(summary['failed'])} failed"
+    )
+    for failure in summary["failed"]:
+        print(f"  {failure['file']}: {failure['error']}")
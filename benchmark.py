@@ -0,0 +1,509 @@
+# offline benchmark of the document pipeline. Azure Form Recognizer and Azure OpenAI are replaced by local fakes
+# with configurable latency, error rates and page counts, so throughput can be measured (and compared between
+# commits) without any Azure resources:
+#
+#   python benchmark.py --target adm --mode document --documents 40 --concurrency 1,4,8
+#   python benchmark.py --target content --mode endpoint --pages 12 --llm-error-rate 0.05
+#   python benchmark.py --target new_content --mode async --concurrency 1,50,200
+#   python benchmark.py --target Updating_in_csv --mode batch --json results.json --min-documents-per-minute 100
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import threading
+import importlib
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows, peak RSS is reported as None there
+    resource = None
+
+from ocr_correction import PAGE_MARKER_PATTERN, estimate_tokens
+from metrics import print_metrics_summary
+from field_schemas import check_value
+
+# how each script is driven: the answer format its get_metadata parses and how /process is called
+TARGETS = {
+    "adm": {"reply_format": "json", "endpoint_method": None},
+    "Updating_in_csv": {"reply_format": "json", "endpoint_method": None},
+    "content": {"reply_format": "lines", "endpoint_method": "post"},
+    "new_content": {"reply_format": "lines", "endpoint_method": "get"},
+}
+
+# extraction replies use the first of these that passes the field's validation rule, so the fake answers
+# aren't dropped and asked for again
+FAKE_VALUES = ["Benchmark Value", "555-123-4567", "01/15/2024", "$250,000.00", "94105", "benchmark@example.com"]
+
+FILLER_WORDS = (
+    "the grantor hereby conveys to grantee all that certain real property situated in county state of described "
+    "as follows lot block tract recorded in book page official records together with all improvements thereon"
+).split()
+
+
+class FakeServiceError(Exception):
+    # looks enough like an openai / azure error for rate_limiter to retry it
+    def __init__(self, message, status_code, retry_after=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.response = SimpleNamespace(headers={"retry-after": str(retry_after)} if retry_after is not None else {})
+
+
+class Latency:
+    def __init__(self, seconds, jitter=0.2, seed=0):
+        self.seconds = seconds
+        self.jitter = jitter
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def sample(self, extra=0.0):
+        with self._lock:
+            factor = self._random.uniform(1 - self.jitter, 1 + self.jitter)
+            roll = self._random.random()
+        return max(0.0, (self.seconds + extra) * factor), roll
+
+
+def fake_page_text(page_number, words_per_page, rng):
+    words = [rng.choice(FILLER_WORDS) for _ in range(words_per_page)]
+    if page_number == 1:
+        words = ["Seller", "Name:", "John", "Smith", "Buyer", "Name:", "Jane", "Doe", "APN:", "123-456-789"] + words
+    return words
+
+
+class FakeDocumentAnalysisClient:
+    # stands in for DocumentAnalysisClient.begin_analyze_document with a prebuilt-document shaped result
+    def __init__(self, pages=5, words_per_page=300, latency=0.5, latency_per_page=0.1, error_rate=0.0,
+                 confidence=0.9, seed=0):
+        self.pages = pages
+        self.words_per_page = words_per_page
+        self.latency_per_page = latency_per_page
+        self.error_rate = error_rate
+        self.confidence = confidence
+        self.latency = Latency(latency, seed=seed)
+        self.seed = seed
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def begin_analyze_document(self, model_id, document=None, pages=None, **kwargs):
+        delay, error, result = self.analyze()
+        time.sleep(delay)
+        if error is not None:
+            raise error
+        return SimpleNamespace(result=lambda timeout=None: result, done=lambda: True)
+
+    def analyze(self):
+        # -> (seconds the call takes, the error it raises or None, the result)
+        with self._lock:
+            self.calls += 1
+            call_number = self.calls
+        page_numbers = list(range(1, self.pages + 1))
+        delay, roll = self.latency.sample(self.latency_per_page * len(page_numbers))
+        if roll < self.error_rate:
+            return delay, FakeServiceError("Fake OCR service error", 500), None
+        rng = random.Random(self.seed * 100003 + call_number)
+        result_pages = []
+        for page_number in page_numbers:
+            words = fake_page_text(page_number, self.words_per_page, rng)
+            lines = [" ".join(words[start:start + 12]) for start in range(0, len(words), 12)]
+            result_pages.append(SimpleNamespace(
+                page_number=page_number,
+                lines=[SimpleNamespace(content=line) for line in lines],
+                words=[
+                    SimpleNamespace(content=word, confidence=min(1.0, rng.uniform(self.confidence - 0.05, self.confidence + 0.05)))
+                    for word in words
+                ],
+            ))
+        key_value_pairs = [
+            SimpleNamespace(key=SimpleNamespace(content="APN"), value=SimpleNamespace(content="123-456-789"), confidence=0.9)
+        ]
+        return delay, None, SimpleNamespace(pages=result_pages, key_value_pairs=key_value_pairs)
+
+
+class FakeAsyncDocumentAnalysisClient:
+    # the azure.ai.formrecognizer.aio shape of the same fake: the call and the poll are awaited
+    def __init__(self, client):
+        self.client = client
+
+    async def begin_analyze_document(self, model_id, document=None, pages=None, **kwargs):
+        delay, error, result = self.client.analyze()
+        await asyncio.sleep(delay)
+        if error is not None:
+            raise error
+
+        async def poll():
+            return result
+        return SimpleNamespace(result=poll)
+
+    async def close(self):
+        pass
+
+
+class FakeChatCompletions:
+    def __init__(self, client):
+        self.client = client
+
+    def create(self, model=None, messages=None, max_tokens=None, **kwargs):
+        return self.client.complete(messages, max_tokens)
+
+
+class FakeOpenAIClient:
+    # stands in for the OpenAI / AzureOpenAI client returned by openai_clients.get_openai_client
+    def __init__(self, fields, reply_format="json", latency=0.3, latency_per_1k_tokens=0.2, error_rate=0.0,
+                 rate_limit_rate=0.0, retry_after=0.2, seed=0):
+        self.fields = fields
+        self.reply_format = reply_format
+        self.latency_per_1k_tokens = latency_per_1k_tokens
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.latency = Latency(latency, seed=seed + 1)
+        self.chat = SimpleNamespace(completions=FakeChatCompletions(self))
+        self._seen_prefixes = set()
+        self._lock = threading.Lock()
+
+    def cached_tokens(self, prompt_text):
+        # like the provider's prompt cache: prefixes from 1024 tokens on, in steps of 128 tokens (4 characters each)
+        cached = 0
+        boundaries = range(1024 * 4, len(prompt_text) + 1, 128 * 4)
+        with self._lock:
+            for boundary in boundaries:
+                if prompt_text[:boundary] in self._seen_prefixes:
+                    cached = boundary // 4
+            self._seen_prefixes.update(prompt_text[:boundary] for boundary in boundaries)
+        return cached
+
+    def complete(self, messages, max_tokens):
+        delay, error, completion = self.respond(messages, max_tokens)
+        time.sleep(delay)
+        if error is not None:
+            raise error
+        return completion
+
+    def respond(self, messages, max_tokens):
+        # -> (seconds the call takes, the error it raises or None, the completion)
+        prompt = messages[-1]["content"]
+        reply = self.reply_for(prompt)
+        prompt_tokens = sum(estimate_tokens(message["content"]) for message in messages)
+        completion_tokens = min(estimate_tokens(reply), max_tokens or estimate_tokens(reply))
+        cached_tokens = self.cached_tokens("".join(message["content"] for message in messages))
+        # cached prompt tokens cost no processing time
+        delay, roll = self.latency.sample(
+            (prompt_tokens - cached_tokens + completion_tokens) / 1000 * self.latency_per_1k_tokens
+        )
+        if roll < self.rate_limit_rate:
+            return 0.0, FakeServiceError("Fake rate limit", 429, retry_after=self.retry_after), None
+        if roll < self.rate_limit_rate + self.error_rate:
+            return delay, FakeServiceError("Fake LLM service error", 500), None
+        return delay, None, SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=reply))],
+            usage=SimpleNamespace(
+                prompt_tokens=prompt_tokens,
+                completion_tokens=completion_tokens,
+                total_tokens=prompt_tokens + completion_tokens,
+                prompt_tokens_details=SimpleNamespace(cached_tokens=cached_tokens),
+            ),
+        )
+
+    def reply_for(self, prompt):
+        # extraction prompts are the ones with a field list (prompt_builder), every target words its
+        # correction prompt differently
+        if "<fields_to_extract>" not in prompt:
+            # batched correction: hand the marked pages back unchanged
+            marker = PAGE_MARKER_PATTERN.search(prompt)
+            if marker:
+                return prompt[marker.start():]
+            # single page correction: one instruction line, then the page text
+            return prompt.partition("\n")[2]
+        values = {field: "Not provided" for field in self.fields}
+        values.update({
+            field: next((value for value in FAKE_VALUES if check_value(field, value)), FAKE_VALUES[0])
+            for field in self.fields[::3]
+        })
+        if self.reply_format == "json":
+            return json.dumps(values)
+        return "\n".join(f"{field} : {value}" for field, value in values.items())
+
+
+class FakeAsyncChatCompletions:
+    def __init__(self, client):
+        self.client = client
+
+    async def create(self, model=None, messages=None, max_tokens=None, **kwargs):
+        delay, error, completion = self.client.respond(messages, max_tokens)
+        await asyncio.sleep(delay)
+        if error is not None:
+            raise error
+        return completion
+
+
+class FakeAsyncOpenAIClient:
+    # stands in for the AsyncOpenAI / AsyncAzureOpenAI client returned by openai_clients.get_async_openai_client
+    def __init__(self, client):
+        self.chat = SimpleNamespace(completions=FakeAsyncChatCompletions(client))
+
+    async def close(self):
+        pass
+
+
+def load_target(name, ocr_client, openai_client, use_cache=False):
+    # the scripts build their Azure clients at import time, dummy settings keep that offline
+    for variable, value in {
+        "AZURE_OCR_ENDPOINT": "https://benchmark.invalid/",
+        "AZURE_OCR_KEY": "benchmark",
+        "AZURE_STORAGE_ACCOUNT_URL": "https://benchmark.invalid/",
+        "OPENAI_API_KEY": "benchmark",
+        "OPENAI_ENDPOINT": "https://benchmark.invalid/",
+    }.items():
+        os.environ.setdefault(variable, value)
+    # every batch run goes over the same files, the manifest would skip them after the first
+    os.environ["DOCUMENT_MANIFEST_ENABLED"] = "0"
+    if not use_cache:
+        os.environ["OCR_CACHE_ENABLED"] = "0"
+        os.environ["LLM_CACHE_ENABLED"] = "0"
+        # reused pages would make every run after the first faster than the service calls it measures
+        os.environ["PAGE_DEDUP"] = "0"
+    module = importlib.import_module(name)
+    module.document_analysis_client = ocr_client
+    module.get_openai_client = lambda *args, **kwargs: openai_client
+    module.async_document_analysis_client = FakeAsyncDocumentAnalysisClient(ocr_client)
+    async_openai_client = FakeAsyncOpenAIClient(openai_client)
+    module.get_async_openai_client = lambda *args, **kwargs: async_openai_client
+    return module
+
+
+def percentile(values, q):
+    # nearest rank
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, int(round(q / 100 * len(ordered) + 0.5)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def create_documents(directory, count):
+    paths = []
+    for number in range(count):
+        path = os.path.join(directory, f"benchmark_{number:04d}.pdf")
+        with open(path, "wb") as f:
+            f.write(f"%PDF-1.4 benchmark document {number}\n".encode("ascii"))
+        paths.append(path)
+    return paths
+
+
+def timed_call(process, latencies, lock):
+    def run(*args, **kwargs):
+        started_at = time.perf_counter()
+        try:
+            return process(*args, **kwargs)
+        finally:
+            with lock:
+                latencies.append(time.perf_counter() - started_at)
+    return run
+
+
+def run_level(module, mode, paths, concurrency, endpoint_method, directory):
+    latencies = []
+    lock = threading.Lock()
+    errors = 0
+    started_at = time.perf_counter()
+
+    if mode == "document":
+        process = timed_call(module.process_document, latencies, lock)
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(process, paths))
+        errors = sum(1 for result in results if isinstance(result, dict) and "error" in result)
+
+    elif mode == "batch":
+        # process_all_documents looks process_document up by name, so the timing wrapper is patched in;
+        # the fakes only exist in this process, so batch workers are always threads here
+        original = module.process_document, module.process_document_streaming
+        module.process_document = timed_call(original[0], latencies, lock)
+        module.process_document_streaming = timed_call(original[1], latencies, lock)
+        module.csv_file_path = os.path.join(directory, f"metadata_{concurrency}.csv")
+        try:
+            summary = module.process_all_documents(directory, max_workers=concurrency, mode="thread", timeout=0)
+            module.close_csv_writers()
+        finally:
+            module.process_document, module.process_document_streaming = original
+        errors = len(summary["failed"])
+
+    elif mode == "pipeline":
+        # BATCH_MODE=pipeline with `concurrency` workers in every stage. a document's latency runs from the start
+        # of its OCR to the end of its extraction
+        ocr_started_at = {}
+        original = module.ocr_document, module.extract_document
+        original_workers = (
+            module.pipeline_ocr_workers, module.pipeline_correction_workers, module.pipeline_extraction_workers
+        )
+
+        def ocr_document(file_path, *args, **kwargs):
+            ocr_started_at[file_path] = time.perf_counter()
+            return original[0](file_path, *args, **kwargs)
+
+        def extract_document(document):
+            try:
+                return original[1](document)
+            finally:
+                with lock:
+                    latencies.append(time.perf_counter() - ocr_started_at[document["file_path"]])
+
+        module.ocr_document, module.extract_document = ocr_document, extract_document
+        module.pipeline_ocr_workers = module.pipeline_correction_workers = concurrency
+        module.pipeline_extraction_workers = concurrency
+        module.csv_file_path = os.path.join(directory, f"metadata_pipeline_{concurrency}.csv")
+        try:
+            summary = module.process_all_documents(directory, mode="pipeline")
+            module.close_csv_writers()
+        finally:
+            module.ocr_document, module.extract_document = original
+            (
+                module.pipeline_ocr_workers, module.pipeline_correction_workers, module.pipeline_extraction_workers
+            ) = original_workers
+        errors = len(summary["failed"])
+
+    elif mode == "async":
+        # process_document_async on one event loop, `concurrency` documents in flight at a time
+        async def run_all():
+            semaphore = asyncio.Semaphore(concurrency)
+
+            async def run(path):
+                async with semaphore:
+                    started_at = time.perf_counter()
+                    try:
+                        return await module.process_document_async(path)
+                    finally:
+                        latencies.append(time.perf_counter() - started_at)
+            return await asyncio.gather(*(run(path) for path in paths))
+
+        results = asyncio.run(run_all())
+        errors = sum(1 for result in results if isinstance(result, dict) and "error" in result)
+
+    else:
+        from fastapi.testclient import TestClient
+        with TestClient(module.app) as client:
+            send = getattr(client, endpoint_method)
+
+            def request(path):
+                response = send("/process", params={"file_path": path})
+                body = response.json()
+                return response.status_code != 200 or (isinstance(body, dict) and "error" in body)
+
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                failed = list(executor.map(timed_call(request, latencies, lock), paths))
+        errors = sum(failed)
+
+    elapsed = time.perf_counter() - started_at
+    return {
+        "concurrency": concurrency,
+        "documents": len(paths),
+        "errors": errors,
+        "elapsed_seconds": round(elapsed, 2),
+        "documents_per_minute": round(len(paths) / elapsed * 60, 2) if elapsed else 0.0,
+        "p50_seconds": round(percentile(latencies, 50) or 0.0, 3),
+        "p95_seconds": round(percentile(latencies, 95) or 0.0, 3),
+        "p99_seconds": round(percentile(latencies, 99) or 0.0, 3),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def print_results(results):
+    print(f"{'workers':>8} {'docs':>6} {'errors':>7} {'docs/min':>9} {'p50 s':>8} {'p95 s':>8} {'p99 s':>8} {'peak RSS MB':>12}")
+    for result in results:
+        print(
+            f"{result['concurrency']:>8} {result['documents']:>6} {result['errors']:>7} "
+            f"{result['documents_per_minute']:>9} {result['p50_seconds']:>8} {result['p95_seconds']:>8} "
+            f"{result['p99_seconds']:>8} {str(result['peak_rss_mb']):>12}"
+        )
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the document pipeline against local OCR and LLM fakes.")
+    parser.add_argument("--target", choices=sorted(TARGETS), default="adm")
+    parser.add_argument("--mode", choices=["document", "batch", "pipeline", "async", "endpoint"], default="document",
+                        help="process_document calls, process_all_documents with thread workers or BATCH_MODE=pipeline, "
+                             "process_document_async calls on one event loop, or the /process endpoint")
+    parser.add_argument("--documents", type=int, default=20)
+    parser.add_argument("--concurrency", default="1,4,8", help="comma separated worker counts, one run per value")
+    parser.add_argument("--pages", type=int, default=5, help="pages per document")
+    parser.add_argument("--words-per-page", type=int, default=300)
+    parser.add_argument("--ocr-confidence", type=float, default=0.9, help="average word confidence of the fake OCR")
+    parser.add_argument("--ocr-latency", type=float, default=0.5, help="seconds per OCR call")
+    parser.add_argument("--ocr-latency-per-page", type=float, default=0.1)
+    parser.add_argument("--ocr-error-rate", type=float, default=0.0)
+    parser.add_argument("--llm-latency", type=float, default=0.3, help="seconds per LLM call")
+    parser.add_argument("--llm-latency-per-1k-tokens", type=float, default=0.2)
+    parser.add_argument("--llm-error-rate", type=float, default=0.0, help="fraction of LLM calls failing with a 500")
+    parser.add_argument("--llm-rate-limit-rate", type=float, default=0.0, help="fraction of LLM calls answered with a 429")
+    parser.add_argument("--use-cache", action="store_true", help="keep the OCR/LLM caches and page dedup as configured in the environment")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", dest="json_path", help="also write the results to this file")
+    parser.add_argument("--min-documents-per-minute", type=float, default=0.0,
+                        help="exit with status 1 when any run is slower than this")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    target = TARGETS[args.target]
+    if args.mode in ("batch", "pipeline") and args.target not in ("adm", "Updating_in_csv"):
+        sys.exit(f"--mode {args.mode} needs a target with process_all_documents (adm or Updating_in_csv)")
+    if args.mode in ("async", "endpoint") and target["endpoint_method"] is None:
+        sys.exit(f"--mode {args.mode} needs a FastAPI target (content or new_content)")
+
+    ocr_client = FakeDocumentAnalysisClient(
+        pages=args.pages,
+        words_per_page=args.words_per_page,
+        latency=args.ocr_latency,
+        latency_per_page=args.ocr_latency_per_page,
+        error_rate=args.ocr_error_rate,
+        confidence=args.ocr_confidence,
+        seed=args.seed,
+    )
+    openai_client = FakeOpenAIClient(
+        fields=[],
+        reply_format=target["reply_format"],
+        latency=args.llm_latency,
+        latency_per_1k_tokens=args.llm_latency_per_1k_tokens,
+        error_rate=args.llm_error_rate,
+        rate_limit_rate=args.llm_rate_limit_rate,
+        seed=args.seed,
+    )
+    module = load_target(args.target, ocr_client, openai_client, args.use_cache)
+    openai_client.fields = list(module.metadata_fields)
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix="benchmark_") as directory:
+        paths = create_documents(directory, args.documents)
+        for concurrency in [int(value) for value in args.concurrency.split(",") if value.strip()]:
+            print(f"Running {args.documents} documents through {args.target} ({args.mode}) with {concurrency} workers")
+            results.append(run_level(module, args.mode, paths, concurrency, target["endpoint_method"], directory))
+
+    print_results(results)
+    print_metrics_summary()
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump({"settings": vars(args), "results": results}, f, indent=2)
+    if args.min_documents_per_minute and any(
+        result["documents_per_minute"] < args.min_documents_per_minute for result in results
+    ):
+        print(f"Throughput fell below {args.min_documents_per_minute} documents/minute")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,136 @@
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from ocr_correction import estimate_tokens
+
+# values the models use for "nothing found", these never win over a real value when merging windows
+MISSING_VALUES = {"", "not provided", "not found", "unclear", "n/a", "na", "none", "null"}
+
+
+def split_into_windows(processed_data, max_tokens):
+    # splits the corrected pages into consecutive windows of at most max_tokens (estimated),
+    # a page that doesn't fit in one window on its own is cut into several parts
+    windows = []
+    current_window = []
+    current_tokens = 0
+    for page in processed_data:
+        page_index, page_content = next(iter(page.items()))
+        page_content = page_content or ""
+        for part_number, part in enumerate(split_text(page_content, max_tokens)):
+            part_key = page_index if part_number == 0 else f"{page_index}.{part_number}"
+            part_tokens = estimate_tokens(part)
+            if current_window and current_tokens + part_tokens > max_tokens:
+                windows.append(current_window)
+                current_window = []
+                current_tokens = 0
+            current_window.append({part_key: part})
+            current_tokens += part_tokens
+    if current_window:
+        windows.append(current_window)
+    return windows
+
+
+def split_text(text, max_tokens):
+    max_chars = max(1, max_tokens * 4)
+    if len(text) <= max_chars:
+        return [text]
+    parts = []
+    while text:
+        if len(text) <= max_chars:
+            parts.append(text)
+            break
+        # cut on the last whitespace before the limit so words aren't split in half
+        cut = text.rfind(" ", 0, max_chars)
+        if cut <= 0:
+            cut = max_chars
+        parts.append(text[:cut])
+        text = text[cut:].lstrip()
+    return parts
+
+
+def extract_in_windows(processed_data, extract_window, max_tokens, max_workers=4, max_attempts=3):
+    # map: extract_window(window) runs on every window in parallel and returns {field: value} or None.
+    # reduce: the per-window results are merged with reduce_extractions.
+    windows = split_into_windows(processed_data, max_tokens)
+    if len(windows) > 1:
+        print(f"Extracting metadata from {len(windows)} windows of up to {max_tokens} tokens")
+
+    if len(windows) <= 1 or not max_workers or max_workers <= 1:
+        extractions = [
+            extract_with_retries(extract_window, window, max_attempts, number) for number, window in enumerate(windows)
+        ]
+    else:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(windows))) as executor:
+            futures = [
+                executor.submit(
+                    contextvars.copy_context().run, extract_with_retries, extract_window, window, max_attempts, number
+                )
+                for number, window in enumerate(windows)
+            ]
+            extractions = [future.result() for future in futures]
+    return merge_extractions(extractions)
+
+
+def extract_with_retries(extract_window, window, max_attempts, window_number=0):
+    for attempt in range(max_attempts):
+        extraction = extract_window(window)
+        if extraction is not None:
+            return extraction
+        print(f"Window {window_number}, attempt {attempt + 1}: metadata extraction failed, retrying...")
+    return None
+
+
+def merge_extractions(extractions):
+    # extractions are in window order, failed windows (None) are left out
+    extractions = [extraction for extraction in extractions if isinstance(extraction, dict)]
+    if not extractions:
+        return None
+    if len(extractions) == 1:
+        return extractions[0]
+    return reduce_extractions(extractions)
+
+
+def value_and_confidence(value):
+    # values are either plain strings or {"value": ..., "confidence": ...} style dicts
+    if isinstance(value, dict):
+        for value_key in ("value", "Value", "Extracted Value", "extracted_value"):
+            if value_key in value:
+                confidence = None
+                for confidence_key in ("confidence", "Confidence", "Confidence score", "confidence_score"):
+                    if confidence_key in value:
+                        confidence = value[confidence_key]
+                        break
+                try:
+                    confidence = float(confidence) if confidence is not None else None
+                except (TypeError, ValueError):
+                    confidence = None
+                return value[value_key], confidence
+    return value, None
+
+
+def is_missing(value):
+    value, _ = value_and_confidence(value)
+    if value is None:
+        return True
+    if isinstance(value, (list, dict)):
+        return len(value) == 0
+    text = str(value).strip().lower()
+    return text in MISSING_VALUES or text.startswith("unclear")
+
+
+def reduce_extractions(extractions):
+    # deterministic merge: a real value beats "Not provided", then the higher confidence wins,
+    # then the earlier window. fields keep the order in which they first appeared.
+    merged = {}
+    best_rank = {}
+    for window_number, extraction in enumerate(extractions):
+        for field, value in extraction.items():
+            _, confidence = value_and_confidence(value)
+            rank = (
+                0 if is_missing(value) else 1,
+                confidence if confidence is not None else -1.0,
+                -window_number,
+            )
+            if field not in merged or rank > best_rank[field]:
+                merged[field] = value
+                best_rank[field] = rank
+    return merged
@@ -1,11 +1,27 @@
 import os
 import json
-from openai import OpenAI
-from fastapi import FastAPI
-from fastapi.responses import JSONResponse
+import asyncio
+import tempfile
+from openai_clients import get_openai_client, get_async_openai_client, close_async_openai_clients
+from fastapi import FastAPI, UploadFile, File
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, PlainTextResponse
 from azure.ai.formrecognizer import DocumentAnalysisClient
+from azure.ai.formrecognizer.aio import DocumentAnalysisClient as AsyncDocumentAnalysisClient
 from azure.core.credentials import AzureKeyCredential
 from dotenv import load_dotenv
+from ocr_correction import correct_pages_batched, correct_pages_batched_async, build_batch_prompt, split_by_confidence, merge_pages
+from ocr_result import document_details_from_result, ocr_pages, confidences_by_page
+from field_prefill import prefill_fields, remaining_fields
+from prompt_builder import build_extraction_prompt
+from field_schemas import document_type_for, fields_for
+from ocr_cache import ocr_cache_from_env
+from pdf_text_layer import details_with_text_layer, details_with_text_layer_async
+from page_dedup import page_index_from_env
+from llm_cache import llm_cache_from_env
+from rate_limiter import rate_limiter_from_env, estimate_request_tokens, priority, PRIORITY_INTERACTIVE
+from metrics import timed_stage, timed_async_stage, track_document, count_pages, count_cache_lookup, record_llm_usage, LLM_REQUESTS, render_metrics
+from job_queue import JobManager, JobQueueFullError, JOB_QUEUED, JOB_RUNNING
 
 
 # load environment variables
@@ -17,208 +33,429 @@ form_recognizer_key = os.getenv("AZURE_OCR_KEY")
 document_analysis_client = DocumentAnalysisClient(
     endpoint=form_recognizer_endpoint, credential=AzureKeyCredential(form_recognizer_key)
 )
+# the same client from azure.ai.formrecognizer.aio for the async path (/process and /upload)
+async_document_analysis_client = AsyncDocumentAnalysisClient(
+    endpoint=form_recognizer_endpoint, credential=AzureKeyCredential(form_recognizer_key)
+)
+
+# initialize openAI, the shared client reads OPENAI_API_KEY and OPENAI_ENDPOINT (custom endpoint)
+openai_client_kind = "openai"
+
+# number of pages sent to the LLM at the same time during OCR correction
+ocr_correction_workers = int(os.getenv("OCR_CORRECTION_WORKERS", "4"))
+
+# short pages are packed into one correction request up to this many (estimated) tokens, 0 = one request per page
+ocr_batch_token_budget = int(os.getenv("OCR_BATCH_TOKEN_BUDGET", "1500"))
+
+# pages whose average OCR word confidence is at least this high are not sent to the LLM, 0 = correct every page
+ocr_confidence_threshold = float(os.getenv("OCR_CONFIDENCE_THRESHOLD", "0.95"))
+
+# OCR model and the on-disk cache of its results, keyed by file content hash and model id
+ocr_model_id = "prebuilt-document"
+ocr_cache = ocr_cache_from_env()
+
+# born-digital PDFs: pages with a clean embedded text layer are read locally (needs the optional pypdf package)
+# and skip both Azure OCR and LLM correction, only image-only pages are sent to OCR
+pdf_text_layer_enabled = os.getenv("PDF_TEXT_LAYER", "1") == "1"
+pdf_text_layer_min_chars = int(os.getenv("PDF_TEXT_LAYER_MIN_CHARS", "100"))
+
+# near-duplicates of already corrected pages (riders, notary acknowledgements, disclaimers) reuse that correction.
+# pages repeated in PAGE_DEDUP_BOILERPLATE_DOCUMENTS documents go last in the extraction input,
+# or are left out of it with PAGE_DEDUP_SKIP_BOILERPLATE=1
+page_index = page_index_from_env()
+skip_boilerplate_pages = os.getenv("PAGE_DEDUP_SKIP_BOILERPLATE", "0") == "1"
+
+# opt-in cache of LLM responses (LLM_CACHE_ENABLED=1), pass bypass_cache=True to skip it for one call
+llm_cache = llm_cache_from_env()
+
+# every LLM call is throttled against the deployment's quota (OPENAI_RPM / OPENAI_TPM, 0 = no limit),
+# rate limited and failed requests are retried with backoff
+rate_limiter = rate_limiter_from_env()
+
+# pass document_type (DEED, DEED_OF_TRUST, SETTLEMENT_STATEMENT, ...) to ask only for the fields that type of
+# document can contain, see field_schemas.py. without it (and without DOCUMENT_TYPE) every field is asked for
+default_document_type = os.getenv("DOCUMENT_TYPE") or None
+
+# uploads are spooled to disk in chunks of this size, so memory per request stays bounded
+upload_chunk_size = int(os.getenv("UPLOAD_CHUNK_KB", "1024")) * 1024
+upload_directory = os.getenv("UPLOAD_DIR") or None
+
+# /process and /upload run the async pipeline on the event loop, so one worker process keeps many OCR polls and
+# LLM calls in flight. ASYNC_PIPELINE=0 runs process_document in the thread pool instead. /jobs stays on threads
+async_pipeline_enabled = os.getenv("ASYNC_PIPELINE", "1") == "1"
 
-# initialize openAI
-client = OpenAI(
-    api_key=os.environ.get("OPENAI_API_KEY"),
-    base_url=os.environ.get("OPENAI_ENDPOINT")  # Add this line for custom endpoint
+# background jobs submitted through /jobs, the queue is bounded so a flood of submissions is rejected instead of piling up
+job_manager = JobManager(
+    lambda file_path, pages=None, document_type=None: process_document(file_path, pages, document_type),
+    max_queue_size=int(os.getenv("JOB_QUEUE_SIZE", "500")),
+    workers=int(os.getenv("JOB_WORKERS", "4")),
 )
 
 # initialize fastAPI 
 app = FastAPI()
 
 
-def analyze_document(document_path):
+@timed_stage("ocr")
+def analyze_document_details(document_path, pages=None):
+    # pages is an optional 1-based range such as "1-3" or "1,4-5", only those pages are read
+    if pdf_text_layer_enabled:
+        return details_with_text_layer(document_path, pages, ocr_document_details, pdf_text_layer_min_chars)
+    return ocr_document_details(document_path, pages)
+
+def ocr_cache_hit(document_path, cache_key, cached_details):
+    # counts the OCR cache lookup, shared by the sync and async OCR calls
+    if cache_key is not None:
+        count_cache_lookup("ocr", cached_details is not None)
+    if cached_details is not None:
+        count_pages("ocr_cached", len(cached_details["pages"]))
+        print(f"Using cached OCR result for {document_path}")
+    return cached_details
+
+def ocr_result_details(result):
+    document_details = document_details_from_result(result)
+    count_pages("ocr", len(document_details["pages"]))
+    return document_details
+
+def ocr_document_details(document_path, pages=None):
     try:
+        cache_key = ocr_cache.key_for(document_path, ocr_model_id, pages)
+        cached_details = ocr_cache_hit(document_path, cache_key, ocr_cache.get(cache_key))
+        if cached_details is not None:
+            return cached_details
+
+        # the open file is streamed to Azure instead of being read into memory first
+        analyze_options = {"pages": pages} if pages else {}
         with open(document_path, "rb") as f:
             poller = document_analysis_client.begin_analyze_document(
-                "prebuilt-document", document=f.read()
+                ocr_model_id, document=f, **analyze_options
             )
-        result = poller.result()
+        document_details = ocr_result_details(poller.result())
+        ocr_cache.set(cache_key, document_details, model_id=ocr_model_id, source=document_path)
+        return document_details
+    except Exception as e:
+        print(f"Error during document analysis: {e}")
+        raise
 
-        extracted_data = []
-        for page in result.pages:
-            page_content = " ".join([line.content for line in page.lines])
-            extracted_data.append({str(page.page_number - 1): page_content})
-        return extracted_data
+def analyze_document(document_path, pages=None):
+    return ocr_pages(analyze_document_details(document_path, pages))
+
+
+@timed_async_stage("ocr")
+async def analyze_document_details_async(document_path, pages=None):
+    # analyze_document_details() on the async client: the OCR poll waits on the event loop, not in a thread
+    if pdf_text_layer_enabled:
+        return await details_with_text_layer_async(document_path, pages, ocr_document_details_async, pdf_text_layer_min_chars)
+    return await ocr_document_details_async(document_path, pages)
+
+async def ocr_document_details_async(document_path, pages=None):
+    try:
+        # hashing the file for the cache key and the cache's disk reads and writes run in threads
+        cache_key = await asyncio.to_thread(ocr_cache.key_for, document_path, ocr_model_id, pages)
+        cached_details = ocr_cache_hit(document_path, cache_key, await asyncio.to_thread(ocr_cache.get, cache_key))
+        if cached_details is not None:
+            return cached_details
+
+        analyze_options = {"pages": pages} if pages else {}
+        with open(document_path, "rb") as f:
+            poller = await async_document_analysis_client.begin_analyze_document(
+                ocr_model_id, document=f, **analyze_options
+            )
+        document_details = ocr_result_details(await poller.result())
+        await asyncio.to_thread(ocr_cache.set, cache_key, document_details, model_id=ocr_model_id, source=document_path)
+        return document_details
     except Exception as e:
         print(f"Error during document analysis: {e}")
         raise
 
+async def analyze_document_async(document_path, pages=None):
+    return ocr_pages(await analyze_document_details_async(document_path, pages))
+
+
+def correction_limits(max_workers, token_budget):
+    if max_workers is None:
+        max_workers = ocr_correction_workers
+    if token_budget is None:
+        token_budget = ocr_batch_token_budget
+    return max_workers, token_budget
+
+def pages_needing_correction(ocr_output, pages_to_check, reused_pages, boilerplate, page_confidences, stats):
+    # the pages left for the LLM after the near-duplicate lookup and the confidence split, with their stats and counts
+    if reused_pages:
+        print(f"Reusing the correction of {len(reused_pages)} of {len(ocr_output)} near-duplicate pages")
+    pages_to_correct, skipped_pages = split_by_confidence(pages_to_check, page_confidences, ocr_confidence_threshold)
+    if skipped_pages:
+        print(f"Skipping LLM correction for {len(skipped_pages)} of {len(ocr_output)} pages with high OCR confidence")
+    if stats is not None:
+        stats["pages_corrected"] = len(pages_to_correct)
+        stats["pages_skipped"] = len(skipped_pages)
+        stats["pages_reused"] = len(reused_pages)
+        stats["boilerplate_pages"] = boilerplate
+    count_pages("corrected", len(pages_to_correct))
+    count_pages("skipped", len(skipped_pages))
+    count_pages("reused", len(reused_pages))
+    return pages_to_correct
 
-def process_ocr_output(ocr_output):
+@timed_stage("correction")
+def process_ocr_output(ocr_output, max_workers=None, token_budget=None, page_confidences=None, stats=None, document_id=None):
+    max_workers, token_budget = correction_limits(max_workers, token_budget)
     try:
-        corrected_output_parts = []
-        
-        for page in ocr_output:
-            page_content = list(page.values())[0]
-            messages = f"You are a helpful assistant that fixes errors in OCR outputs and provides correct data in the same JSON format.:\n{page_content}"
-            response = get_openai_response(messages)
-            corrected_output_parts.append({list(page.keys())[0]: response})
-        
-        return corrected_output_parts
+        # near-duplicates of pages corrected before take that correction instead of another LLM call
+        pages_to_check, reused_pages, boilerplate = page_index.split_reusable(ocr_output, document_id)
+        pages_to_correct = pages_needing_correction(
+            ocr_output, pages_to_check, reused_pages, boilerplate, page_confidences, stats
+        )
+        corrected_pages = correct_pages_batched(pages_to_correct, correct_ocr_page, correct_ocr_batch, token_budget, max_workers)
+        # skipped and failed pages are indexed without a correction, they only count towards boilerplate
+        page_index.remember(pages_to_check, corrected_pages, document_id)
+        return merge_pages(ocr_output, reused_pages + corrected_pages)
     except json.JSONDecodeError as e:
-        print(f"Error parsing corrected JSON: {e}") 
+        print(f"Error parsing corrected JSON: {e}")
         raise
 
-def get_openai_response(messages):
+def correct_ocr_page(page_content):
+    messages = f"You are a helpful assistant that fixes errors in OCR outputs and provides correct data in the same JSON format.:\n{page_content}"
+    return get_openai_response(messages)
+
+def correct_ocr_batch(pages):
+    messages = build_batch_prompt("You are a helpful assistant that fixes errors in OCR outputs.", pages)
+    return get_openai_response(messages)
+
+@timed_async_stage("correction")
+async def process_ocr_output_async(ocr_output, max_workers=None, token_budget=None, page_confidences=None, stats=None, document_id=None):
+    # process_ocr_output() with the correction requests as tasks on the event loop, max_workers of them in flight
+    max_workers, token_budget = correction_limits(max_workers, token_budget)
     try:
-        chat_completion = client.chat.completions.create(
-            messages=[
-                {"role": "system", "content": "You are a helpful assistant."},
-                {"role": "user", "content": messages}
-            ],
-            model="gpt-3.5-turbo",
-            max_tokens=2000
+        pages_to_check, reused_pages, boilerplate = await asyncio.to_thread(page_index.split_reusable, ocr_output, document_id)
+        pages_to_correct = pages_needing_correction(
+            ocr_output, pages_to_check, reused_pages, boilerplate, page_confidences, stats
         )
-        
-        return chat_completion.choices[0].message.content.strip()
+        corrected_pages = await correct_pages_batched_async(
+            pages_to_correct, correct_ocr_page_async, correct_ocr_batch_async, token_budget, max_workers
+        )
+        await asyncio.to_thread(page_index.remember, pages_to_check, corrected_pages, document_id)
+        return merge_pages(ocr_output, reused_pages + corrected_pages)
+    except json.JSONDecodeError as e:
+        print(f"Error parsing corrected JSON: {e}")
+        raise
+
+async def correct_ocr_page_async(page_content):
+    messages = f"You are a helpful assistant that fixes errors in OCR outputs and provides correct data in the same JSON format.:\n{page_content}"
+    return await get_openai_response_async(messages)
+
+async def correct_ocr_batch_async(pages):
+    messages = build_batch_prompt("You are a helpful assistant that fixes errors in OCR outputs.", pages)
+    return await get_openai_response_async(messages)
+
+def chat_request(messages, bypass_cache=False, response_format=None):
+    # the chat.completions.create() arguments and their cache key, the same for the sync and async clients
+    chat_messages = [
+        {"role": "system", "content": "You are a helpful assistant."},
+        {"role": "user", "content": messages}
+    ]
+    cache_key = None if bypass_cache else llm_cache.key_for("gpt-3.5-turbo", None, chat_messages, 2000, response_format=response_format)
+    request = {
+        "messages": chat_messages,
+        "model": "gpt-3.5-turbo",
+        "max_tokens": 2000,
+        **({"response_format": response_format} if response_format else {})
+    }
+    return request, cache_key
+
+def llm_cache_hit(cache_key, cached_response):
+    if cache_key is not None:
+        count_cache_lookup("llm", cached_response is not None)
+    if cached_response is not None:
+        LLM_REQUESTS.inc(result="cached")
+    return cached_response
+
+def llm_response_text(chat_completion):
+    record_llm_usage(chat_completion)
+    return chat_completion.choices[0].message.content.strip()
+
+def llm_request_failed(e):
+    LLM_REQUESTS.inc(result="error")
+    print(f"Error fetching response from OpenAI: {e}")
+
+def get_openai_response(messages, bypass_cache=False, response_format=None):
+    request, cache_key = chat_request(messages, bypass_cache, response_format)
+    cached_response = llm_cache_hit(cache_key, llm_cache.get(cache_key))
+    if cached_response is not None:
+        return cached_response
+    try:
+        client = get_openai_client(openai_client_kind)
+        chat_completion = rate_limiter.call(
+            lambda: client.chat.completions.create(**request),
+            estimate_request_tokens(request["messages"], request["max_tokens"]),
+        )
+        response = llm_response_text(chat_completion)
+        llm_cache.set(cache_key, response)
+        return response
     except Exception as e:
-        print(f"Error fetching response from OpenAI: {e}")
+        llm_request_failed(e)
         raise
 
-def get_metadata(content):
-    prompt= f"""
+async def get_openai_response_async(messages, bypass_cache=False, response_format=None):
+    # get_openai_response() on the async client, sharing the cache and the rate limiter with the threads
+    request, cache_key = chat_request(messages, bypass_cache, response_format)
+    cached_response = llm_cache_hit(cache_key, await asyncio.to_thread(llm_cache.get, cache_key))
+    if cached_response is not None:
+        return cached_response
+    try:
+        client = get_async_openai_client(openai_client_kind)
+        chat_completion = await rate_limiter.call_async(
+            lambda: client.chat.completions.create(**request),
+            estimate_request_tokens(request["messages"], request["max_tokens"]),
+        )
+        response = llm_response_text(chat_completion)
+        await asyncio.to_thread(llm_cache.set, cache_key, response)
+        return response
+    except Exception as e:
+        llm_request_failed(e)
+        raise
+
+# fields extracted by get_metadata
+metadata_fields = [
+    'Buyer1 First Name',
+    'Buyer1 Middle Name',
+    'Buyer1 Last Name',
+    'Buyer2 First Name',
+    'Buyer2 Middle Name',
+    'Buyer2 Last Name',
+    'Buyer Organization',
+    'Seller1 First Name',
+    'Seller1 Middle Name',
+    'Seller1 Last Name',
+    'Seller2 First Name',
+    'Seller2 Middle Name',
+    'Seller2 Last Name',
+    'Seller Organization',
+    'Lender Name',
+    'Lender - Address',
+    'Lender - Phone Number',
+    'Lender Fax',
+    'Lender Email address',
+    'Lender Marketing Source',
+    'Lender Marketing Rep',
+    'Lender Reference',
+    'Lender Contact 1',
+    'Lender Contact 2',
+    'Listing Agent Name',
+    'Listing Agent Address',
+    'Listing Agent Phone Number',
+    'Listing Agent Fax',
+    'Listing Agent Email address',
+    'Listing Agent Marketing Source',
+    'Listing Agent Marketing Rep',
+    'Listing Agent Reference',
+    'Mortgage Broker Name',
+    'Mortgage Broker Address',
+    'Mortgage Broker Phone Number',
+    'Mortgage Broker Fax',
+    'Mortgage Broker Email address',
+    'Mortgage Broker Marketing Source',
+    'Marketing Rep',
+    'Reference',
+    'Mortgage Broker Contact 1',
+    'Mortgage Broker Contact 2',
+    'APN',
+    'Selling Agent',
+    'Escrow Company Name',
+    'Escrow Company Address',
+    'Escrow Company Phone Number',
+    'Escrow Company Fax',
+    'Escrow Company Email address',
+    'Escrow Company Marketing Source',
+    'Escrow Company Marketing Rep',
+    'Escrow Company Reference',
+    'Escrow Company Contact 1',
+    'Escrow Company Contact 2',
+    'Loan Amount',
+    'Sales Price',
+    'Policy Code',
+    'Transaction Type',
+    'Order Type',
+    'Policy Type',
+    'Product Type',
+    'Property Type',
+    'Rush Order',
+    'Title Officer',
+    'Related order(s):',
+    'Notes',
+    'Instructions',
+    'CPL',
+    'Other',
+    'Payoff Lender',
+    'Title Company Name',
+    'Title Company Lender - Address',
+    'Title Company Lender - Phone Number',
+    'Title Company Fax',
+    'Title Company Email address',
+    'Title Company Marketing Source',
+    'Title Company Marketing Rep',
+    'Title Company Reference',
+    'Settlement Agent Name',
+    'Settlement Agent Lender - Address',
+    'Settlement Agent Lender - Phone Number',
+    'Settlement Agent Fax',
+    'Settlement Agent Email address',
+    'Settlement Agent Marketing Source',
+    'Settlement Agent Marketing Rep',
+    'Settlement Agent Reference',
+    'Escrow Officer',
+    'Title Insurance Premium',
+    'Other (Title Searcher)',
+    'Project Name',
+    '360 Queue',
+    'Settlement Date',
+    'Abstractor',
+    'Underwriter',
+    'Attorney',
+    'Property Use',
+    'Endorsements',
+    'Tax/Map ID',
+    'Government',
+    'HOA',
+    'HOA Management Company',
+    'Qualified Intermediary',
+    'County Taxes',
+    'Lot Number(s)',
+    'Block',
+    'Subdivision/Tract',
+    'Pre-closer/ Escrow Assistant',
+    'Appraiser',
+    'Builder',
+    'General Contractor',
+    'Home Inspector',
+    'Loan Servicer',
+    'Pest Inspector',
+    'Sub Contractor',
+    'Guarantee',
+    'Hazard Insurance Agent',
+]
+
+# static part of the extraction prompt, the field list and then the document text are appended after it
+metadata_instructions = """
             You are tasked with extracting specific metadata fields from a document. Your goal is to accurately extract all required fields from the given document text.
 
-            Now, here is the full text of the document:
-            
-            <document_text>
-            {content}
-            </document_text>
-            
-
-            You will need to extract information for the following fields:
-            
-            <fields_to_extract>
-            Buyer1 First Name
-            Buyer1 Middle Name
-            Buyer1 Last Name
-            Buyer2 First Name
-            Buyer2 Middle Name
-            Buyer2 Last Name
-            Buyer Organization
-            Seller1 First Name
-            Seller1 Middle Name
-            Seller1 Last Name
-            Seller2 First Name
-            Seller2 Middle Name
-            Seller2 Last Name
-            Seller Organization
-            Lender Name
-            Lender - Address
-            Lender - Phone Number
-            Lender Fax
-            Lender Email address
-            Lender Marketing Source
-            Lender Marketing Rep
-            Lender Reference
-            Lender Contact 1
-            Lender Contact 2
-            Listing Agent Name
-            Listing Agent Address
-            Listing Agent Phone Number
-            Listing Agent Fax
-            Listing Agent Email address
-            Listing Agent Marketing Source
-            Listing Agent Marketing Rep
-            Listing Agent Reference
-            Mortgage Broker Name
-            Mortgage Broker Address
-            Mortgage Broker Phone Number
-            Mortgage Broker Fax
-            Mortgage Broker Email address
-            Mortgage Broker Marketing Source
-            Marketing Rep
-            Reference
-            Mortgage Broker Contact 1
-            Mortgage Broker Contact 2
-            APN
-            Selling Agent
-            Escrow Company Name
-            Escrow Company Address
-            Escrow Company Phone Number
-            Escrow Company Fax
-            Escrow Company Email address
-            Escrow Company Marketing Source
-            Escrow Company Marketing Rep
-            Escrow Company Reference
-            Escrow Company Contact 1
-            Escrow Company Contact 2
-            Loan Amount
-            Sales Price
-            Policy Code
-            Transaction Type
-            Order Type
-            Policy Type
-            Product Type
-            Property Type
-            Rush Order
-            Title Officer
-            Related order(s):
-            Notes
-            Instructions
-            CPL
-            Other
-            Payoff Lender
-            Title Company Name
-            Title Company Lender - Address
-            Title Company Lender - Phone Number
-            Title Company Fax
-            Title Company Email address
-            Title Company Marketing Source
-            Title Company Marketing Rep
-            Title Company Reference
-            Settlement Agent Name
-            Settlement Agent Lender - Address
-            Settlement Agent Lender - Phone Number
-            Settlement Agent Fax
-            Settlement Agent Email address
-            Settlement Agent Marketing Source
-            Settlement Agent Marketing Rep
-            Settlement Agent Reference
-            Escrow Officer
-            Title Insurance Premium
-            Other (Title Searcher)
-            Project Name
-            360 Queue
-            Settlement Date
-            Abstractor
-            Underwriter
-            Attorney
-            Property Use
-            Endorsements
-            Tax/Map ID
-            Government
-            HOA
-            HOA Management Company
-            Qualified Intermediary
-            County Taxes
-            Lot Number(s)
-            Block
-            Subdivision/Tract
-            Pre-closer/ Escrow Assistant
-            Appraiser
-            Builder
-            General Contractor
-            Home Inspector
-            Loan Servicer
-            Pest Inspector
-            Sub Contractor
-            Guarantee
-            Hazard Insurance Agent
-            </fields_to_extract>
+            You will need to extract information for the fields listed in <fields_to_extract> below. The full text of the document follows the field list, in <document_text>.
+
             Please follow these instructions to extract the required information:
             1. Carefully read through the entire document text.
-            2. For each field listed above, search for relevant information in the document.
+            2. For each field listed, search for relevant information in the document.
             3. Extract the exact text that corresponds to each field.
             4. If a field's information is not found or is unclear, mark it as "Not found" or "Unclear" respectively.
-           Guidelines for handling missing or unclear information:
+            Guidelines for handling missing or unclear information:
             - If a date is not explicitly stated but can be inferred from context, extract it and note "Inferred" in parentheses after the date.
             - For numeric fields (e.g., loan amounts), extract the full number including cents if available.
             - For names, extract full names as they appear in the document.
             - If a field has multiple relevant entries, include all of them separated by semicolons.
             After extracting all fields, give the response in a field : value."""
+
+@timed_stage("extraction")
+def get_metadata(content, fields=None):
+    if fields is None:
+        fields = metadata_fields
+    prompt = build_extraction_prompt(metadata_instructions, fields, content)
     try:
         response = get_openai_response(prompt)
         return response
@@ -226,28 +463,107 @@ def get_metadata(content):
         print(f"Failed to parse OpenAI response for metadata: {e}")
         return None
 
-def process_document(file_path):    
+@timed_async_stage("extraction")
+async def get_metadata_async(content, fields=None):
+    if fields is None:
+        fields = metadata_fields
+    prompt = build_extraction_prompt(metadata_instructions, fields, content)
+    try:
+        return await get_openai_response_async(prompt)
+    except Exception as e:
+        print(f"Failed to parse OpenAI response for metadata: {e}")
+        return None
+
+def document_fields(file_path, document_type=None):
+    return fields_for(document_type or document_type_for(file_path, default_document_type), metadata_fields)
+
+def extraction_text(processed_data, ocr_stats):
+    processed_data = page_index.order_for_extraction(
+        processed_data, ocr_stats["boilerplate_pages"], skip_boilerplate_pages
+    )
+    print("processed ocr is completed. Now geting values for the fields.")
+    return processed_data
+
+def prefill_from_ocr(document_details, fields):
+    # fields Azure already paired with a value are filled directly, the LLM is only asked for the rest
+    prefilled = prefill_fields(document_details.get("key_value_pairs"), fields)
+    if prefilled:
+        print(f"Pre-filled {len(prefilled)} of {len(fields)} fields from OCR key-value pairs")
+    return prefilled, remaining_fields(fields, prefilled)
+
+def add_prefilled_text(fields_and_answers, prefilled):
+    # the pre-filled fields go first, in the same "field : value" lines as the LLM answer
+    if fields_and_answers is None or not prefilled:
+        return fields_and_answers
+    prefilled_text = "\n".join(f"{field} : {value}" for field, value in prefilled.items())
+    return f"{prefilled_text}\n{fields_and_answers}" if fields_and_answers else prefilled_text
+
+@track_document(default_document_type=default_document_type)
+def process_document(file_path, pages=None, document_type=None):
+    fields = document_fields(file_path, document_type)
     try:
-        extracted_data = analyze_document(file_path)
+        document_details = analyze_document_details(file_path, pages)
+        extracted_data = ocr_pages(document_details)
         print("OCR is completed, now processing OCR output")
         # print(extracted_data)
         if not extracted_data:
             return {"error": "No data extracted"}
         else:
-            processed_data = process_ocr_output(extracted_data)
-            print("processed ocr is completed. Now geting values for the fields.")
+            ocr_stats = {}
+            processed_data = process_ocr_output(
+                extracted_data, page_confidences=confidences_by_page(document_details), stats=ocr_stats, document_id=file_path
+            )
+            processed_data = extraction_text(processed_data, ocr_stats)
             # print(processed_data)
-        
-        fields_and_answers = get_metadata(processed_data)
+
+        prefilled, fields_to_ask = prefill_from_ocr(document_details, fields)
+        if not fields_to_ask:
+            return add_prefilled_text("", prefilled)
+
+        fields_and_answers = get_metadata(processed_data, fields_to_ask)
         max_attempts = 5
         attempt = 0
         
         while fields_and_answers is None and attempt < max_attempts:
-            fields_and_answers = get_metadata(processed_data)
+            fields_and_answers = get_metadata(processed_data, fields_to_ask)
             if fields_and_answers is None:
                 print(f"Attempt {attempt + 1}: fields is None, retrying...")
             attempt += 1
-        return fields_and_answers
+        return add_prefilled_text(fields_and_answers, prefilled)
+
+    except Exception as e:
+        print(f"Document analysis (OCR) failed for the document: {e}")
+        return {"error": str(e)}
+
+@track_document(default_document_type=default_document_type)
+async def process_document_async(file_path, pages=None, document_type=None):
+    # process_document() on the async clients, many documents can be in flight on one event loop
+    fields = document_fields(file_path, document_type)
+    try:
+        document_details = await analyze_document_details_async(file_path, pages)
+        extracted_data = ocr_pages(document_details)
+        print("OCR is completed, now processing OCR output")
+        if not extracted_data:
+            return {"error": "No data extracted"}
+        ocr_stats = {}
+        processed_data = await process_ocr_output_async(
+            extracted_data, page_confidences=confidences_by_page(document_details), stats=ocr_stats, document_id=file_path
+        )
+        processed_data = extraction_text(processed_data, ocr_stats)
+
+        prefilled, fields_to_ask = prefill_from_ocr(document_details, fields)
+        if not fields_to_ask:
+            return add_prefilled_text("", prefilled)
+
+        fields_and_answers = await get_metadata_async(processed_data, fields_to_ask)
+        max_attempts = 5
+        attempt = 0
+        while fields_and_answers is None and attempt < max_attempts:
+            fields_and_answers = await get_metadata_async(processed_data, fields_to_ask)
+            if fields_and_answers is None:
+                print(f"Attempt {attempt + 1}: fields is None, retrying...")
+            attempt += 1
+        return add_prefilled_text(fields_and_answers, prefilled)
 
     except Exception as e:
         print(f"Document analysis (OCR) failed for the document: {e}")
@@ -257,11 +573,88 @@ def process_document(file_path):
 def read_root():
     return {"status": "success"}
 
+@app.get("/metrics")
+def metrics_route():
+    # Prometheus text format: stage latency histograms by document type, page, token, cache and retry counters
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+@app.get("/cache/stats")
+def cache_stats_route():
+    return {
+        "ocr_cache": ocr_cache.stats(),
+        "llm_cache": llm_cache.stats(),
+        "rate_limiter": rate_limiter.stats(),
+        "page_dedup": page_index.stats(),
+    }
+
 @app.post("/process")
-def process_route(file_path: str):
-    process_result = process_document(file_path)
+async def process_route(file_path: str, pages: str = None, document_type: str = None):
+    # someone is waiting on the response, so its LLM calls go ahead of queued /jobs work
+    with priority(PRIORITY_INTERACTIVE):
+        if async_pipeline_enabled:
+            process_result = await process_document_async(file_path, pages, document_type)
+        else:
+            process_result = await run_in_threadpool(process_document, file_path, pages, document_type)
     return JSONResponse(content=process_result, status_code=200)
 
+@app.post("/upload")
+async def upload_route(file: UploadFile = File(...), pages: str = None, document_type: str = None):
+    suffix = os.path.splitext(file.filename or "")[1]
+    fd, spool_path = tempfile.mkstemp(suffix=suffix, dir=upload_directory)
+    try:
+        with os.fdopen(fd, "wb") as spool:
+            while True:
+                chunk = await file.read(upload_chunk_size)
+                if not chunk:
+                    break
+                spool.write(chunk)
+        with priority(PRIORITY_INTERACTIVE):
+            if async_pipeline_enabled:
+                process_result = await process_document_async(spool_path, pages, document_type)
+            else:
+                process_result = await run_in_threadpool(process_document, spool_path, pages, document_type)
+    finally:
+        await file.close()
+        os.remove(spool_path)
+    return JSONResponse(content=process_result, status_code=200)
+
+@app.on_event("startup")
+def start_job_workers():
+    job_manager.start()
+
+@app.on_event("shutdown")
+def stop_job_workers():
+    job_manager.stop()
+
+@app.on_event("shutdown")
+async def close_async_clients():
+    await async_document_analysis_client.close()
+    await close_async_openai_clients()
+
+@app.post("/jobs")
+def submit_job_route(file_path: str, pages: str = None, document_type: str = None):
+    try:
+        job_id = job_manager.submit(file_path, pages, document_type)
+    except JobQueueFullError as e:
+        return JSONResponse(content={"error": str(e)}, status_code=503)
+    return JSONResponse(content={"job_id": job_id, "status": JOB_QUEUED}, status_code=202)
+
+@app.get("/jobs/{job_id}")
+def job_status_route(job_id: str):
+    status = job_manager.status(job_id)
+    if status is None:
+        return JSONResponse(content={"error": "Unknown job id"}, status_code=404)
+    return JSONResponse(content=status, status_code=200)
+
+@app.get("/jobs/{job_id}/result")
+def job_result_route(job_id: str):
+    job = job_manager.result(job_id)
+    if job is None:
+        return JSONResponse(content={"error": "Unknown job id"}, status_code=404)
+    if job["status"] in (JOB_QUEUED, JOB_RUNNING):
+        return JSONResponse(content={"job_id": job_id, "status": job["status"]}, status_code=202)
+    return JSONResponse(content=job["result"], status_code=200)
+
 
 if __name__ == '__main__':
     import uvicorn
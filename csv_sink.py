@@ -0,0 +1,211 @@
+import os
+import io
+import csv
+import json
+import tempfile
+import threading
+
+FSYNC_NEVER = "never"
+FSYNC_INTERVAL = "interval"
+FSYNC_ALWAYS = "always"
+
+
+class AppendOnlyCSVWriter:
+    # appends one row per document instead of rewriting the whole file.
+    # the full column list lives in a "<csv>.columns.json" sidecar; rows written after a new field
+    # shows up are simply longer than the header until compact() rewrites the header once at the end.
+    # with key_fields, a row whose key was written before replaces the earlier row; both stay in the file
+    # until compact() drops the earlier one.
+    def __init__(self, csv_file_path, leading_fields=None, fsync_policy=FSYNC_INTERVAL, fsync_interval=50, flush_every=1,
+                 key_fields=None):
+        self.csv_file_path = csv_file_path
+        self.key_fields = list(key_fields or [])
+        self.columns_path = csv_file_path + ".columns.json"
+        self.fsync_policy = fsync_policy
+        self.fsync_interval = max(1, fsync_interval)
+        self.flush_every = max(1, flush_every)
+        self.rows_written = 0
+        self.rows_replaced = 0
+        self._keys = set()
+        self._unflushed = 0
+        self._unsynced = 0
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(csv_file_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        file_exists = os.path.exists(csv_file_path) and os.path.getsize(csv_file_path) > 0
+        if file_exists:
+            truncate_partial_row(csv_file_path)
+        self.header = read_header(csv_file_path) if file_exists else []
+        self.columns = self._load_columns()
+        for field in list(leading_fields or []) + self.key_fields:
+            if field not in self.columns:
+                self.columns.append(field)
+        if file_exists and self.key_fields:
+            for values in self._read_rows():
+                self._add_key(values)
+
+        self._file = open(csv_file_path, "a", newline="")
+        if not self.header:
+            self.header = list(self.columns)
+            self._write_line(self.header)
+            self._sync()
+        self._save_columns()
+
+    def write_row(self, row_data):
+        with self._lock:
+            new_fields = [field for field in row_data.keys() if field not in self.columns]
+            if new_fields:
+                self.columns.extend(new_fields)
+                # the sidecar is updated before the row so it always describes every row in the file
+                self._save_columns()
+            values = [row_data.get(field, "") for field in self.columns]
+            self._write_line(values)
+            self.rows_written += 1
+            if self.key_fields:
+                self._add_key(values)
+
+            self._unflushed += 1
+            self._unsynced += 1
+            if self.fsync_policy == FSYNC_ALWAYS or (
+                self.fsync_policy == FSYNC_INTERVAL and self._unsynced >= self.fsync_interval
+            ):
+                self._sync()
+            elif self._unflushed >= self.flush_every:
+                self._file.flush()
+                self._unflushed = 0
+
+    def compact(self):
+        # rewrites the file once so that the header matches the full column list and every key keeps only
+        # its latest row
+        with self._lock:
+            self._sync()
+            if self.header == self.columns and not self.rows_replaced:
+                return
+            # a first pass finds the position of the latest row of every key so the rows aren't held in memory
+            latest_rows = {}
+            if self.rows_replaced:
+                for position, values in enumerate(self._read_rows()):
+                    latest_rows[self._row_key(values)] = position
+            self._file.close()
+            directory = os.path.dirname(self.csv_file_path) or "."
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+            try:
+                with open(self.csv_file_path, "r", newline="") as source, os.fdopen(fd, "w", newline="") as target:
+                    writer = csv.writer(target)
+                    writer.writerow(self.columns)
+                    for position, row in enumerate(iter_rows(source)):
+                        if latest_rows and latest_rows[self._row_key(row)] != position:
+                            continue
+                        writer.writerow(row + [""] * (len(self.columns) - len(row)))
+                    target.flush()
+                    os.fsync(target.fileno())
+                os.replace(tmp_path, self.csv_file_path)
+            except Exception:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+            finally:
+                self._file = open(self.csv_file_path, "a", newline="")
+            self.header = list(self.columns)
+            self.rows_replaced = 0
+
+    def close(self, compact=True):
+        if compact:
+            self.compact()
+        with self._lock:
+            if not self._file.closed:
+                self._sync()
+                self._file.close()
+
+    def _write_line(self, values):
+        buffer = io.StringIO()
+        csv.writer(buffer).writerow(values)
+        # a single write per row keeps a crash from interleaving half rows
+        self._file.write(buffer.getvalue())
+
+    def _sync(self):
+        self._file.flush()
+        if self.fsync_policy != FSYNC_NEVER:
+            os.fsync(self._file.fileno())
+        self._unflushed = 0
+        self._unsynced = 0
+
+    def _read_rows(self):
+        with open(self.csv_file_path, "r", newline="") as f:
+            yield from iter_rows(f)
+
+    def _row_key(self, values):
+        positions = [self.columns.index(field) for field in self.key_fields]
+        return tuple(values[position] if position < len(values) else "" for position in positions)
+
+    def _add_key(self, values):
+        # values written to the file and values read back from it compare equal as strings
+        key = tuple("" if value is None else str(value) for value in self._row_key(values))
+        if key in self._keys:
+            self.rows_replaced += 1
+        else:
+            self._keys.add(key)
+
+    def _load_columns(self):
+        return read_columns(self.csv_file_path, self.header)
+
+    def _save_columns(self):
+        directory = os.path.dirname(self.columns_path) or "."
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(self.columns, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.columns_path)
+
+
+def read_header(csv_file_path):
+    with open(csv_file_path, "r", newline="") as f:
+        return next(csv.reader(f), [])
+
+
+def iter_rows(f):
+    # the rows after the header, without blank lines
+    reader = csv.reader(f)
+    next(reader, None)
+    for row in reader:
+        if any(row):
+            yield row
+
+
+def read_columns(csv_file_path, header=None):
+    # the header plus the fields of rows written after it, from the "<csv>.columns.json" sidecar
+    columns = list(read_header(csv_file_path) if header is None else header)
+    columns_path = csv_file_path + ".columns.json"
+    if os.path.exists(columns_path):
+        try:
+            with open(columns_path, "r", encoding="utf-8") as f:
+                saved_columns = json.load(f)
+            columns += [field for field in saved_columns if field not in columns]
+        except (OSError, ValueError) as e:
+            print(f"Ignoring unreadable column sidecar {columns_path}: {e}")
+    return columns
+
+
+def truncate_partial_row(csv_file_path):
+    # a crash in the middle of a write leaves a row without its line terminator; drop it
+    with open(csv_file_path, "rb") as f:
+        f.seek(-1, os.SEEK_END)
+        if f.read(1) == b"\n":
+            return
+        f.seek(0)
+        data = f.read()
+
+    last_row_end = 0
+    in_quotes = False
+    for position, byte in enumerate(data):
+        if byte == ord('"'):
+            in_quotes = not in_quotes
+        elif byte == ord("\n") and not in_quotes:
+            last_row_end = position + 1
+    print(f"Removing a partially written row from {csv_file_path}")
+    with open(csv_file_path, "r+b") as f:
+        f.truncate(last_row_end)
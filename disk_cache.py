@@ -0,0 +1,165 @@
+import os
+import json
+import time
+import hashlib
+import tempfile
+import threading
+
+
+def file_sha256(document_path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(document_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class DiskCache:
+    # writes keep a running total of the cache size instead of scanning the directory every time. the directory
+    # is scanned (expired entries dropped, least recently used ones removed) on the first write, when the total
+    # passes max_bytes, and otherwise every evict_interval_seconds, which also picks up what other processes wrote.
+    def __init__(self, cache_dir, max_bytes=1024 * 1024 * 1024, max_age_seconds=30 * 24 * 3600, enabled=True,
+                 evict_interval_seconds=3600):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self.enabled = enabled
+        self.evict_interval_seconds = evict_interval_seconds
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+        self._total_bytes = None
+        self._last_evicted_at = 0.0
+        self._lock = threading.Lock()
+        self._evict_lock = threading.Lock()
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def get(self, key):
+        entry = self.get_entry(key)
+        return entry["value"] if entry is not None else None
+
+    def get_entry(self, key):
+        # the stored entry: the value, when it was written ("created_at") and the details passed to set()
+        if key is None:
+            return None
+        entry_path = self._entry_path(key)
+        try:
+            with open(entry_path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            self._count("misses")
+            return None
+        except (OSError, ValueError) as e:
+            print(f"Ignoring unreadable cache entry {entry_path}: {e}")
+            self._remove(entry_path)
+            self._count("misses")
+            return None
+
+        if self.max_age_seconds and time.time() - entry.get("created_at", 0) > self.max_age_seconds:
+            self._remove(entry_path)
+            self._count("evictions")
+            self._count("misses")
+            return None
+
+        # touch the entry so size-based eviction drops the least recently used files first
+        try:
+            os.utime(entry_path)
+        except OSError:
+            pass
+        self._count("hits")
+        return entry
+
+    def set(self, key, value, **details):
+        if key is None:
+            return
+        entry_path = self._entry_path(key)
+        entry = dict(details, created_at=time.time(), value=value)
+        try:
+            os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+            # write to a temp file and rename it so readers never see a half written entry
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(entry_path), suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(entry, f)
+            replaced_bytes = os.stat(entry_path).st_size if os.path.exists(entry_path) else 0
+            os.replace(tmp_path, entry_path)
+            written_bytes = os.stat(entry_path).st_size
+            self._count("writes")
+        except OSError as e:
+            print(f"Error writing cache entry {entry_path}: {e}")
+            return
+        with self._lock:
+            if self._total_bytes is not None:
+                self._total_bytes += written_bytes - replaced_bytes
+            needs_eviction = (
+                self._total_bytes is None
+                or (self.max_bytes and self._total_bytes > self.max_bytes)
+                or time.time() - self._last_evicted_at > self.evict_interval_seconds
+            )
+        if needs_eviction:
+            self.evict()
+
+    def evict(self):
+        # one scan at a time: a worker that finds another one scanning leaves it to that one
+        if not self._evict_lock.acquire(blocking=False):
+            return
+        try:
+            self._evict()
+        finally:
+            self._evict_lock.release()
+
+    def _evict(self):
+        entries = []
+        now = time.time()
+        for root, dirs, files in os.walk(self.cache_dir):
+            for file_name in files:
+                if not file_name.endswith(".json"):
+                    continue
+                entry_path = os.path.join(root, file_name)
+                try:
+                    stat = os.stat(entry_path)
+                except OSError:
+                    continue
+                if self.max_age_seconds and now - stat.st_mtime > self.max_age_seconds:
+                    self._remove(entry_path)
+                    self._count("evictions")
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry_path))
+
+        total_bytes = sum(size for _, size, _ in entries)
+        if self.max_bytes and total_bytes > self.max_bytes:
+            # down to 90% of the limit, so the next few writes don't start another scan right away
+            target_bytes = self.max_bytes * 0.9
+            for _, size, entry_path in sorted(entries):
+                self._remove(entry_path)
+                self._count("evictions")
+                total_bytes -= size
+                if total_bytes <= target_bytes:
+                    break
+        with self._lock:
+            self._total_bytes = total_bytes
+            self._last_evicted_at = now
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "writes": self.writes,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+    def _count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def _remove(self, entry_path):
+        try:
+            os.remove(entry_path)
+        except OSError:
+            pass
+
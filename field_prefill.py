@@ -0,0 +1,80 @@
+import re
+
+# other labels the same field goes by on closing documents, matched after normalize_label
+FIELD_ALIASES = {
+    "APN": ["apn", "a p n", "assessors parcel number", "assessors parcel no", "assessor parcel number", "parcel number", "parcel no", "parcel id"],
+    "Tax/Map ID": ["tax map id", "tax id", "tax map number", "map id"],
+    "Loan Amount": ["loan amount", "principal amount", "amount of loan", "original loan amount"],
+    "Sales Price": ["sales price", "sale price", "purchase price", "contract sales price", "consideration"],
+    "Escrow Officer": ["escrow officer", "escrow agent"],
+    "Title Officer": ["title officer"],
+    "Escrow Company Name": ["escrow company", "escrow company name"],
+    "Title Company Name": ["title company", "title company name", "title insurer"],
+    "Lender Name": ["lender", "lender name", "mortgagee", "beneficiary"],
+    "Settlement Date": ["settlement date", "closing date", "date of settlement", "close of escrow"],
+    "Lot Number(s)": ["lot", "lot number", "lot numbers", "lot no"],
+    "Block": ["block", "block number", "block no"],
+    "Subdivision/Tract": ["subdivision", "tract", "subdivision tract", "tract number", "tract no"],
+    "Property Type": ["property type"],
+    "Transaction Type": ["transaction type"],
+    "Underwriter": ["underwriter", "underwriter name"],
+    "Buyer Name": ["buyer", "buyers", "buyer name", "borrower", "borrowers", "purchaser", "grantee", "grantees"],
+    "Seller Name": ["seller", "sellers", "seller name", "grantor", "grantors"],
+    "Buyer Current Address": ["buyer address", "borrower address", "buyers address", "grantee address"],
+    "Seller Current Address": ["seller address", "sellers address", "grantor address"],
+    "Buyer Email address": ["buyer email", "borrower email"],
+    "Seller Email address": ["seller email"],
+}
+
+
+def normalize_label(label):
+    # "Assessor's Parcel No.:" -> "assessors parcel no"
+    label = label.lower().replace("'", "").replace("’", "")
+    label = re.sub(r"[^a-z0-9]+", " ", label)
+    return label.strip()
+
+
+def build_label_index(fields):
+    label_index = {}
+    for field in fields:
+        label_index.setdefault(normalize_label(field), field)
+    for field in fields:
+        for alias in FIELD_ALIASES.get(field, []):
+            label_index.setdefault(normalize_label(alias), field)
+    return label_index
+
+
+def prefill_fields_with_confidence(key_value_pairs, fields, min_confidence=0.5):
+    # fills fields straight from the OCR key-value pairs whose key matches the field name or a known alias.
+    # returns {field: (value, confidence)}, when a field is matched more than once the most confident pair wins.
+    label_index = build_label_index(fields)
+    prefilled = {}
+    for pair in key_value_pairs or []:
+        value = (pair.get("value") or "").strip()
+        confidence = pair.get("confidence") or 0.0
+        if not value or confidence < min_confidence:
+            continue
+        field = label_index.get(normalize_label(pair.get("key") or ""))
+        if field is None:
+            continue
+        if field not in prefilled or confidence > prefilled[field][1]:
+            prefilled[field] = (value, confidence)
+    return prefilled
+
+
+def prefill_fields(key_value_pairs, fields, min_confidence=0.5):
+    prefilled = prefill_fields_with_confidence(key_value_pairs, fields, min_confidence)
+    return {field: value for field, (value, _) in prefilled.items()}
+
+
+def remaining_fields(fields, prefilled):
+    return [field for field in fields if field not in prefilled]
+
+
+def merge_prefilled(answers, prefilled, fields):
+    # prefilled values win, fields keep the order of the field list with anything else after them
+    merged = dict(answers or {})
+    merged.update(prefilled)
+    ordered = {field: merged.pop(field) for field in fields if field in merged}
+    ordered.update(merged)
+    return ordered
@@ -0,0 +1,142 @@
+import os
+import re
+from chunked_extraction import value_and_confidence, is_missing
+
+# the fields each document type can actually contain. names come from both field lists in use:
+# the buyer/seller party fields (adm.py, Updating_in_csv.py, new_content.py) and the order form fields (content.py).
+# a script only ever asks for the fields of its own list, see fields_for.
+SELLER_PARTY_FIELDS = [
+    'Seller Name', 'Seller Suffix', 'Seller Relationship', 'Seller Current Address', 'Seller Same as Property address',
+    'Seller City', 'Seller State', 'Seller Zip Code', 'Seller Email address', 'Seller WorkPhone /Ext:', 'Seller Fax',
+    'Seller Marketing Rep', 'Seller Marketing Source',
+]
+BUYER_PARTY_FIELDS = [field.replace('Seller', 'Buyer') for field in SELLER_PARTY_FIELDS]
+SELLER_NAME_FIELDS = [
+    'Seller1 First Name', 'Seller1 Middle Name', 'Seller1 Last Name',
+    'Seller2 First Name', 'Seller2 Middle Name', 'Seller2 Last Name', 'Seller Organization',
+]
+BUYER_NAME_FIELDS = [field.replace('Seller', 'Buyer') for field in SELLER_NAME_FIELDS]
+PROPERTY_FIELDS = [
+    'APN', 'Tax/Map ID', 'Lot Number(s)', 'Block', 'Subdivision/Tract', 'Property Type', 'Property Use',
+    'County Taxes', 'Government', 'HOA', 'HOA Management Company',
+]
+LENDER_FIELDS = [
+    'Lender Name', 'Lender - Address', 'Lender - Phone Number', 'Lender Fax', 'Lender Email address',
+    'Lender Reference', 'Lender Contact 1', 'Lender Contact 2', 'Loan Amount', 'Loan Servicer',
+]
+ESCROW_FIELDS = [
+    'Escrow Company Name', 'Escrow Company Address', 'Escrow Company Phone Number', 'Escrow Company Fax',
+    'Escrow Company Email address', 'Escrow Officer',
+]
+SETTLEMENT_AGENT_FIELDS = [
+    'Settlement Agent Name', 'Settlement Agent Lender - Address', 'Settlement Agent Lender - Phone Number',
+    'Settlement Agent Fax', 'Settlement Agent Email address',
+]
+
+# None means every field of the script's list
+DOCUMENT_TYPES = {
+    "DEED": SELLER_PARTY_FIELDS + BUYER_PARTY_FIELDS + SELLER_NAME_FIELDS + BUYER_NAME_FIELDS + PROPERTY_FIELDS + [
+        'Sales Price', 'Transaction Type', 'Settlement Date', 'Title Company Name', 'Escrow Company Name', 'Attorney',
+    ],
+    "DEED_OF_TRUST": BUYER_PARTY_FIELDS + BUYER_NAME_FIELDS + PROPERTY_FIELDS + LENDER_FIELDS + [
+        'Settlement Date', 'Title Company Name', 'Escrow Company Name', 'Mortgage Broker Name', 'Hazard Insurance Agent',
+    ],
+    "SETTLEMENT_STATEMENT": (
+        SELLER_PARTY_FIELDS + BUYER_PARTY_FIELDS + SELLER_NAME_FIELDS + BUYER_NAME_FIELDS + ESCROW_FIELDS
+        + SETTLEMENT_AGENT_FIELDS + [
+            'APN', 'Property Type', 'Lender Name', 'Loan Amount', 'Sales Price', 'Settlement Date', 'Transaction Type',
+            'Title Company Name', 'Title Insurance Premium', 'County Taxes', 'HOA', 'Payoff Lender',
+            'Listing Agent Name', 'Selling Agent', 'Mortgage Broker Name', 'Hazard Insurance Agent',
+        ]
+    ),
+    "TITLE_ORDER": None,
+}
+
+# other names the same document type goes by, matched after normalize_document_type
+DOCUMENT_TYPE_ALIASES = {
+    "GRANT_DEED": "DEED",
+    "WARRANTY_DEED": "DEED",
+    "QUITCLAIM_DEED": "DEED",
+    "MORTGAGE": "DEED_OF_TRUST",
+    "SECURITY_INSTRUMENT": "DEED_OF_TRUST",
+    "HUD_1": "SETTLEMENT_STATEMENT",
+    "CLOSING_DISCLOSURE": "SETTLEMENT_STATEMENT",
+    "ALTA_SETTLEMENT_STATEMENT": "SETTLEMENT_STATEMENT",
+    "ORDER": "TITLE_ORDER",
+}
+
+# values that fail their field's rule are dropped, so extract_fields asks for the field again
+ZIP_CODE = re.compile(r"^\d{5}(-\d{4})?$")
+EMAIL = re.compile(r"^[^@\s]+@[^@\s]+\.[^@\s]+$")
+AMOUNT = re.compile(r"^\$?\s*\d[\d,]*(\.\d{1,2})?$")
+DATE = re.compile(r"\d{1,4}[/.-]\d{1,2}[/.-]\d{1,4}|[A-Za-z]{3,}\.?\s+\d{1,2},?\s+\d{4}|\d{1,2}\s+[A-Za-z]{3,}\.?,?\s+\d{4}")
+AMOUNT_FIELDS = {'Loan Amount', 'Sales Price', 'Title Insurance Premium'}
+DATE_FIELDS = {'Settlement Date'}
+
+
+def normalize_document_type(document_type):
+    # "Grant Deed" / "grant-deed" -> "GRANT_DEED"
+    return re.sub(r"[^A-Z0-9]+", "_", str(document_type).upper()).strip("_")
+
+
+def canonical_document_type(document_type):
+    if not document_type:
+        return None
+    name = normalize_document_type(document_type)
+    name = DOCUMENT_TYPE_ALIASES.get(name, name)
+    return name if name in DOCUMENT_TYPES else None
+
+
+def document_type_for(file_path, default=None):
+    # documents are sorted into one folder per type (.../<office>/<document type>/file.pdf),
+    # the nearest folder named after a known type wins
+    directory = os.path.dirname(os.path.abspath(file_path))
+    while True:
+        document_type = canonical_document_type(os.path.basename(directory))
+        if document_type:
+            return document_type
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            return canonical_document_type(default) or default
+        directory = parent
+
+
+def fields_for(document_type, available_fields):
+    # the script's own fields that belong to this document type, in the script's order.
+    # unknown types, and types whose fields the script doesn't have at all, get every field.
+    document_type = canonical_document_type(document_type)
+    schema_fields = DOCUMENT_TYPES.get(document_type) if document_type else None
+    if schema_fields is None:
+        return list(available_fields)
+    schema_fields = set(schema_fields)
+    return [field for field in available_fields if field in schema_fields] or list(available_fields)
+
+
+def check_value(field, value):
+    # several values separated by semicolons are checked one by one
+    parts = [part.strip() for part in str(value).split(";") if part.strip()]
+    if field.endswith("Zip Code"):
+        return all(ZIP_CODE.match(part) for part in parts)
+    if "Email" in field:
+        return all(EMAIL.match(part) for part in parts)
+    if "Phone" in field or field.endswith("Fax"):
+        return all(len(re.sub(r"\D", "", part)) >= 7 for part in parts)
+    if field in AMOUNT_FIELDS:
+        return all(AMOUNT.match(part) for part in parts)
+    if field in DATE_FIELDS:
+        return all(DATE.search(part) for part in parts)
+    return True
+
+
+def validate_answers(answers):
+    # answers is {field: value} or {field: {"value": ..., "confidence": ...}}, "Not found" style values are kept
+    if not answers:
+        return answers
+    valid = {}
+    for field, answer in answers.items():
+        value, _ = value_and_confidence(answer)
+        if not is_missing(answer) and not check_value(field, value):
+            print(f"Dropping {field!r}: {value!r} doesn't look like a valid value")
+            continue
+        valid[field] = answer
+    return valid
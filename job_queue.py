@@ -0,0 +1,120 @@
+import time
+import uuid
+import queue
+import threading
+from collections import OrderedDict
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_SUCCEEDED = "succeeded"
+JOB_FAILED = "failed"
+
+
+class JobQueueFullError(Exception):
+    pass
+
+
+class JobManager:
+    # runs process_job(*args) on a fixed set of worker threads fed by a bounded queue
+    def __init__(self, process_job, max_queue_size=500, workers=2, max_finished_jobs=1000):
+        self.process_job = process_job
+        self.workers = workers
+        self.max_finished_jobs = max_finished_jobs
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._threads = []
+        self._stopping = threading.Event()
+
+    def start(self):
+        if self._threads:
+            return
+        self._stopping.clear()
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"job-worker-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        # workers check the event between jobs; a sentinel put on a full queue would block here
+        self._stopping.set()
+        # jobs still waiting in the queue won't run, mark them failed so their status doesn't stay queued
+        while True:
+            try:
+                job_id, _ = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            with self._lock:
+                job = self._jobs.get(job_id)
+                if job is not None:
+                    job["status"] = JOB_FAILED
+                    job["error"] = "Job cancelled, the server is shutting down"
+                    job["finished_at"] = time.time()
+        for thread in self._threads:
+            thread.join(timeout=5)
+        self._threads = []
+
+    def submit(self, *args):
+        job_id = uuid.uuid4().hex
+        job = {
+            "job_id": job_id,
+            "status": JOB_QUEUED,
+            "submitted_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+            "result": None,
+            "error": None,
+        }
+        with self._lock:
+            self._jobs[job_id] = job
+        try:
+            self._queue.put_nowait((job_id, args))
+        except queue.Full:
+            with self._lock:
+                del self._jobs[job_id]
+            raise JobQueueFullError("Job queue is full, try again later")
+        return job_id
+
+    def status(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            status = {key: value for key, value in job.items() if key != "result"}
+        status["queue_depth"] = self._queue.qsize()
+        return status
+
+    def result(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def _work(self):
+        while not self._stopping.is_set():
+            try:
+                job_id, args = self._queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            with self._lock:
+                job = self._jobs.get(job_id)
+                if job is None:
+                    continue
+                job["status"] = JOB_RUNNING
+                job["started_at"] = time.time()
+            try:
+                result = self.process_job(*args)
+                error = result.get("error") if isinstance(result, dict) else None
+            except Exception as e:
+                print(f"Job {job_id} failed: {e}")
+                result, error = None, str(e)
+            with self._lock:
+                job["status"] = JOB_FAILED if error else JOB_SUCCEEDED
+                job["result"] = result
+                job["error"] = error
+                job["finished_at"] = time.time()
+                self._forget_old_jobs()
+
+    def _forget_old_jobs(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job["finished_at"] is not None]
+        for job_id in finished[:max(0, len(finished) - self.max_finished_jobs)]:
+            del self._jobs[job_id]
@@ -0,0 +1,95 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from disk_cache import DiskCache
+
+
+class LLMCache:
+    # two tiers: a small in-memory LRU in front of a larger on-disk cache shared between runs
+    def __init__(self, cache_dir, max_memory_entries=1024, max_disk_bytes=256 * 1024 * 1024,
+                 ttl_seconds=7 * 24 * 3600, enabled=False):
+        self.enabled = enabled
+        self.max_memory_entries = max_memory_entries
+        self.ttl_seconds = ttl_seconds
+        self.disk = DiskCache(cache_dir, max_bytes=max_disk_bytes, max_age_seconds=ttl_seconds, enabled=enabled)
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+
+    def key_for(self, model, deployment, messages, max_tokens, **options):
+        if not self.enabled:
+            return None
+        payload = json.dumps(
+            {
+                "model": model,
+                "deployment": deployment,
+                "messages": messages,
+                "max_tokens": max_tokens,
+                **{name: value for name, value in options.items() if value is not None},
+            },
+            sort_keys=True,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        if key is None:
+            return None
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                created_at, value = entry
+                if not self.ttl_seconds or time.time() - created_at <= self.ttl_seconds:
+                    self._memory.move_to_end(key)
+                    self.memory_hits += 1
+                    return value
+                del self._memory[key]
+
+        entry = self.disk.get_entry(key)
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+        # the entry keeps the time it was written, so reading it doesn't extend its TTL
+        self._remember(key, entry["value"], entry.get("created_at"))
+        return entry["value"]
+
+    def set(self, key, value):
+        if key is None or value is None:
+            return
+        self._remember(key, value)
+        self.disk.set(key, value)
+
+    def _remember(self, key, value, created_at=None):
+        with self._lock:
+            self._memory[key] = (created_at or time.time(), value)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_memory_entries:
+                self._memory.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            hits = self.memory_hits + self.disk_hits
+            lookups = hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "memory_entries": len(self._memory),
+                "hit_rate": hits / lookups if lookups else 0.0,
+            }
+
+
+def llm_cache_from_env():
+    return LLMCache(
+        cache_dir=os.getenv("LLM_CACHE_DIR", ".llm_cache"),
+        max_memory_entries=int(os.getenv("LLM_CACHE_MAX_ENTRIES", "1024")),
+        max_disk_bytes=int(float(os.getenv("LLM_CACHE_MAX_MB", "256")) * 1024 * 1024),
+        ttl_seconds=int(float(os.getenv("LLM_CACHE_TTL_HOURS", "168")) * 3600),
+        enabled=os.getenv("LLM_CACHE_ENABLED", "0") == "1",
+    )
@@ -0,0 +1,164 @@
+import os
+import json
+import time
+import tempfile
+import threading
+from disk_cache import file_sha256
+
+STATUS_SUCCEEDED = "succeeded"
+STATUS_FAILED = "failed"
+
+
+class DocumentManifest:
+    # what has been done to each document of a directory, so reruns only process new or changed files.
+    # kept as JSON lines, one line appended per processed file (the last line for a path wins),
+    # and rewritten with one line per path by compact().
+    # entry: {"path", "size", "mtime", "sha256", "status", "row" or "error", "processed_at"}
+    def __init__(self, manifest_path, enabled=True, retry_failed=True):
+        self.manifest_path = manifest_path
+        self.enabled = enabled
+        self.retry_failed = retry_failed
+        self.entries = {}
+        self._lines_since_compact = 0
+        self._lock = threading.Lock()
+        self._file = None
+        if enabled:
+            self._load()
+
+    def _load(self):
+        if not os.path.exists(self.manifest_path):
+            return
+        with open(self.manifest_path, "r", encoding="utf-8") as f:
+            for line_number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # a crash in the middle of a write leaves a partial last line
+                    print(f"Ignoring unreadable line {line_number} of {self.manifest_path}")
+                    continue
+                self.entries[entry["path"]] = entry
+                self._lines_since_compact += 1
+
+    def key(self, file_path):
+        return os.path.abspath(file_path)
+
+    def check(self, file_path):
+        # -> None when the file was already processed and hasn't changed since,
+        # otherwise its fingerprint {"size", "mtime", "sha256"} to pass to record()
+        stat = os.stat(file_path)
+        fingerprint = {"size": stat.st_size, "mtime": stat.st_mtime}
+        if not self.enabled:
+            return fingerprint
+        entry = self.entries.get(self.key(file_path))
+        if entry is not None and entry["status"] == STATUS_FAILED and not self.retry_failed:
+            return None
+        done = entry is not None and entry["status"] == STATUS_SUCCEEDED
+        if done and entry["size"] == fingerprint["size"] and entry["mtime"] == fingerprint["mtime"]:
+            return None
+        # size or mtime differ: only a different content hash makes it a changed file (a copy or touch doesn't)
+        fingerprint["sha256"] = file_sha256(file_path)
+        if done and entry.get("sha256") == fingerprint["sha256"]:
+            self._append(dict(entry, **fingerprint))
+            return None
+        return fingerprint
+
+    def record(self, file_path, fingerprint, status, row=None, error=None):
+        if not self.enabled:
+            return
+        entry = {"path": self.key(file_path), **fingerprint, "status": status, "processed_at": time.time()}
+        if row is not None:
+            entry["row"] = row
+        if error is not None:
+            entry["error"] = error
+        self._append(entry)
+
+    def _append(self, entry):
+        with self._lock:
+            self.entries[entry["path"]] = entry
+            if self._file is None:
+                # opened on the first write, so importing a script doesn't create its output directory
+                directory = os.path.dirname(self.manifest_path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                self._file = open(self.manifest_path, "a", encoding="utf-8")
+            self._file.write(json.dumps(entry) + "\n")
+            self._file.flush()
+            self._lines_since_compact += 1
+
+    def compact(self):
+        # rewrites the manifest with only the latest line of every path
+        if not self.enabled:
+            return
+        with self._lock:
+            if self._file is None or self._lines_since_compact <= len(self.entries):
+                return
+            self._file.close()
+            directory = os.path.dirname(self.manifest_path) or "."
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "w", encoding="utf-8") as f:
+                    for entry in self.entries.values():
+                        f.write(json.dumps(entry) + "\n")
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.manifest_path)
+                self._lines_since_compact = len(self.entries)
+            except Exception:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+            finally:
+                self._file = None
+
+    def close(self):
+        if not self.enabled:
+            return
+        self.compact()
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def stats(self):
+        with self._lock:
+            statuses = [entry["status"] for entry in self.entries.values()]
+        return {
+            "files": len(statuses),
+            "succeeded": statuses.count(STATUS_SUCCEEDED),
+            "failed": statuses.count(STATUS_FAILED),
+        }
+
+
+def is_settled(file_path, settle_seconds):
+    # a file still being copied in keeps changing, leave it for the next scan
+    try:
+        return time.time() - os.stat(file_path).st_mtime >= settle_seconds
+    except OSError:
+        return False
+
+
+def watch(scan, interval_seconds, stop=None):
+    # calls scan() every interval_seconds until stop() returns True or Ctrl+C
+    try:
+        while True:
+            started_at = time.time()
+            try:
+                scan()
+            except Exception as e:
+                # a failed scan (unreadable directory, full disk) is retried on the next one
+                print(f"Error while scanning for new documents: {e}")
+            if stop is not None and stop():
+                return
+            time.sleep(max(0.0, interval_seconds - (time.time() - started_at)))
+    except KeyboardInterrupt:
+        print("Stopped watching")
+
+
+def manifest_from_env(default_path):
+    return DocumentManifest(
+        manifest_path=os.getenv("DOCUMENT_MANIFEST_PATH", default_path),
+        enabled=os.getenv("DOCUMENT_MANIFEST_ENABLED", "1") == "1",
+        retry_failed=os.getenv("DOCUMENT_MANIFEST_RETRY_FAILED", "1") == "1",
+    )
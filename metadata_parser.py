@@ -0,0 +1,180 @@
+import re
+import json
+
+CONFIDENCE_LABEL = re.compile(r"^'?\s*confidence(\s*score)?\s*'?$", re.IGNORECASE)
+BLOCK_PATTERN = re.compile(r"\[(.*?)\]", re.DOTALL)
+
+
+def normalize_field(name):
+    return re.sub(r"[^a-z0-9]+", " ", name.lower()).strip()
+
+
+def canonical_fields(parsed, fields):
+    # maps the field names the model wrote ("seller name", "'Seller Name'") back onto the requested names
+    if not fields:
+        return parsed
+    by_name = {normalize_field(field): field for field in fields}
+    return {by_name.get(normalize_field(field), field): value for field, value in parsed.items()}
+
+
+def strip_json_text(text):
+    text = text.strip()
+    fence = re.match(r"^```(?:json)?\s*(.*?)\s*```$", text, re.DOTALL)
+    if fence:
+        text = fence.group(1)
+    start, end = text.find("{"), text.rfind("}")
+    if start != -1 and end > start:
+        text = text[start:end + 1]
+    return text
+
+
+def parse_json_metadata(text, fields=None):
+    # tolerates markdown fences and text around the object, returns None when there is no JSON object at all
+    if not text:
+        return None
+    try:
+        parsed = json.loads(strip_json_text(text))
+    except ValueError:
+        # trailing commas are the most common slip
+        try:
+            parsed = json.loads(re.sub(r",\s*([}\]])", r"\1", strip_json_text(text)))
+        except ValueError:
+            return None
+    if not isinstance(parsed, dict):
+        return None
+    return canonical_fields(parsed, fields)
+
+
+def clean_part(text):
+    # a leading ":" is left over from a field name that ends in a colon ("Seller WorkPhone /Ext: : 555")
+    text = text.strip().rstrip(",").strip().lstrip(":").strip()
+    # the prompt's own template sometimes leaks into the answer: 'Field'-Seller Name : 'Extracted Value' - John
+    text = re.sub(r"^'?(field|extracted value)'?\s*-\s*", "", text, flags=re.IGNORECASE)
+    if len(text) >= 2 and text[0] == text[-1] and text[0] in "'\"":
+        text = text[1:-1]
+    return text.strip()
+
+
+def parse_confidence(text):
+    match = re.search(r"\d+(\.\d+)?", text)
+    return float(match.group()) if match else None
+
+
+def split_label(part, field_names=None):
+    # field names can contain a colon themselves and are not always quoted ("Seller WorkPhone /Ext: : 555"),
+    # so the separator is the colon after the longest label that normalizes to one of the requested field_names
+    part = part.strip()
+    if field_names:
+        separator = None
+        for colon in re.finditer(":", part):
+            if normalize_field(clean_part(part[:colon.start()])) in field_names:
+                separator = colon.start()
+        if separator is not None:
+            return part[:separator], part[separator + 1:]
+    # "'Seller WorkPhone /Ext:' : '555'" -> the colon inside the quoted label is not the separator
+    if part[:1] in "'\"":
+        closing = part.find(part[0], 1)
+        if closing != -1 and part[closing + 1:].lstrip().startswith(":"):
+            return part[:closing + 1], part[closing + 1:].lstrip()[1:]
+    label, _, text = part.partition(":")
+    return label, text.lstrip(":")
+
+
+def parse_block(block, field_names=None):
+    # one "[ 'Field' : value, 'Confidence score': 90 ]" entry, returns (field, value, confidence)
+    field = value = confidence = None
+    for part in re.split(r",\s*\n|\n|,\s*(?=['\"]?confidence)", block, flags=re.IGNORECASE):
+        if ":" not in part:
+            continue
+        label, text = split_label(part, field_names)
+        label = clean_part(label)
+        if CONFIDENCE_LABEL.match(label):
+            confidence = parse_confidence(text)
+        elif field is None and label:
+            field, value = label, clean_part(text)
+    return field, value, confidence
+
+
+def parse_extracted_metadata(text, fields=None):
+    # tolerant parser for the <extracted_metadata> [ ... ] format asked for by new_content.py,
+    # returns {field: {"value": ..., "confidence": ...}} or None when nothing could be read
+    if not text:
+        return None
+    match = re.search(r"<extracted_metadata>(.*?)(</extracted_metadata>|$)", text, re.DOTALL)
+    body = match.group(1) if match else text
+    field_names = {normalize_field(field) for field in fields or []}
+    parsed = {}
+    for block in BLOCK_PATTERN.findall(body):
+        field, value, confidence = parse_block(block, field_names)
+        if field:
+            parsed[field] = {"value": value, "confidence": confidence}
+    if not parsed:
+        # fall back to plain "field: value" lines
+        for line in body.splitlines():
+            if ":" not in line:
+                continue
+            label, value = split_label(line, field_names)
+            if clean_part(label):
+                parsed[clean_part(label)] = {"value": clean_part(value), "confidence": None}
+    return canonical_fields(parsed, fields) or None
+
+
+def json_schema_response_format(fields):
+    # structured output: the model has to return exactly these fields as strings
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "extracted_metadata",
+            "strict": True,
+            "schema": {
+                "type": "object",
+                "properties": {field: {"type": "string"} for field in fields},
+                "required": list(fields),
+                "additionalProperties": False,
+            },
+        },
+    }
+
+
+def response_format_for(mode, fields):
+    # "json_schema" (strict structured output), "json_object" (JSON mode) or "text" (no response_format)
+    if mode == "json_schema":
+        return json_schema_response_format(fields)
+    if mode == "json_object":
+        return {"type": "json_object"}
+    return None
+
+
+def extract_fields(ask, parse, fields, max_attempts=3):
+    # ask(fields) returns the raw model response for those fields, parse(response, fields) returns a dict.
+    # after each attempt only the fields that are still missing are asked for again.
+    answers = {}
+    fields_to_ask = list(fields)
+    for attempt in range(max_attempts):
+        response = ask(fields_to_ask)
+        parsed = parse(response, fields_to_ask) if response is not None else None
+        if parsed:
+            answers.update({field: value for field, value in parsed.items() if field in fields_to_ask or field not in answers})
+        fields_to_ask = [field for field in fields_to_ask if field not in answers]
+        if not fields_to_ask:
+            break
+        if attempt + 1 < max_attempts:
+            print(f"Attempt {attempt + 1}: {len(fields_to_ask)} fields missing from the response, asking again for those only")
+    return answers or None
+
+
+async def extract_fields_async(ask, parse, fields, max_attempts=3):
+    # extract_fields() for an async ask(fields)
+    answers = {}
+    fields_to_ask = list(fields)
+    for attempt in range(max_attempts):
+        response = await ask(fields_to_ask)
+        parsed = parse(response, fields_to_ask) if response is not None else None
+        if parsed:
+            answers.update({field: value for field, value in parsed.items() if field in fields_to_ask or field not in answers})
+        fields_to_ask = [field for field in fields_to_ask if field not in answers]
+        if not fields_to_ask:
+            break
+        if attempt + 1 < max_attempts:
+            print(f"Attempt {attempt + 1}: {len(fields_to_ask)} fields missing from the response, asking again for those only")
+    return answers or None
@@ -0,0 +1,357 @@
+import os
+import time
+import bisect
+import inspect
+import functools
+import threading
+import contextvars
+from contextlib import contextmanager
+from field_schemas import canonical_document_type, document_type_for
+
+# seconds, the last bucket catches everything slower
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, float("inf"))
+
+# set for the duration of one document so every stage it goes through is labelled with its type.
+# worker pools copy the context into their threads, like the request priority in rate_limiter.
+current_document_type = contextvars.ContextVar("current_document_type", default="unknown")
+
+
+def label_key(label_names, labels):
+    return tuple(str(labels.get(name, "")) for name in label_names)
+
+
+def format_labels(label_names, key, extra=None):
+    pairs = list(zip(label_names, key)) + list(extra or [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label(value)}"' for name, value in pairs) + "}"
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_bound(bound):
+    return "+Inf" if bound == float("inf") else repr(float(bound))
+
+
+class Counter:
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = label_key(self.label_names, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._values)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(self.snapshot().items()):
+            lines.append(f"{self.name}{format_labels(self.label_names, key)} {value}")
+        return lines
+
+
+class Gauge(Counter):
+    # a value that goes up and down, such as the number of documents waiting in a queue
+    def set(self, value, **labels):
+        key = label_key(self.label_names, labels)
+        with self._lock:
+            self._values[key] = value
+
+    def render(self):
+        lines = super().render()
+        lines[1] = f"# TYPE {self.name} gauge"
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = label_key(self.label_names, labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            series["counts"][bisect.bisect_left(self.buckets, value)] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {key: {**series, "counts": list(series["counts"])} for key, series in self._series.items()}
+
+    def quantile(self, series, q):
+        # upper bound of the bucket the q-th observation falls in, good enough to spot the slow stage
+        target = q * series["count"]
+        cumulative = 0
+        for bound, count in zip(self.buckets, series["counts"]):
+            cumulative += count
+            if cumulative >= target and cumulative:
+                return bound
+        return self.buckets[-1]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for key, series in sorted(self.snapshot().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, series["counts"]):
+                cumulative += count
+                labels = format_labels(self.label_names, key, [("le", format_bound(bound))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.label_names, key)} {series['sum']}")
+            lines.append(f"{self.name}_count{format_labels(self.label_names, key)} {series['count']}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help_text, label_names=()):
+        metric = Counter(name, help_text, label_names)
+        self.metrics.append(metric)
+        return metric
+
+    def gauge(self, name, help_text, label_names=()):
+        metric = Gauge(name, help_text, label_names)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, help_text, label_names, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        # Prometheus text exposition format
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+# one registry per process. with BATCH_MODE=process the worker processes keep their own numbers,
+# so the batch summary only covers what ran in the main process.
+REGISTRY = MetricsRegistry()
+STAGE_SECONDS = REGISTRY.histogram(
+    "pipeline_stage_seconds", "Time spent in each pipeline stage", ("stage", "document_type")
+)
+STAGE_ERRORS = REGISTRY.counter(
+    "pipeline_stage_errors_total", "Exceptions raised out of a pipeline stage", ("stage", "document_type")
+)
+DOCUMENTS = REGISTRY.counter(
+    "pipeline_documents_total", "Documents processed, by result", ("result", "document_type")
+)
+PAGES = REGISTRY.counter(
+    "pipeline_pages_total", "Pages OCR'd, corrected by the LLM, skipped from correction or reused from a near-duplicate", ("stage", "document_type")
+)
+LLM_REQUESTS = REGISTRY.counter(
+    "llm_requests_total", "LLM calls by result: ok, error or cached", ("result",)
+)
+LLM_TOKENS = REGISTRY.counter(
+    "llm_tokens_total", "Tokens reported by the API, by kind: prompt, cached_prompt or completion", ("kind",)
+)
+LLM_SECONDS = REGISTRY.histogram(
+    "llm_request_seconds", "Time from sending an LLM request to its answer, by provider prompt cache hit or miss",
+    ("prompt_cache",)
+)
+LLM_RETRIES = REGISTRY.counter(
+    "llm_retries_total", "LLM calls retried after a retryable error", ("reason",)
+)
+CACHE_LOOKUPS = REGISTRY.counter(
+    "cache_lookups_total", "OCR and LLM cache lookups, by result: hit or miss", ("cache", "result")
+)
+# BATCH_MODE=pipeline, see stage_pipeline.py
+QUEUE_DEPTH = REGISTRY.gauge(
+    "pipeline_queue_depth", "Documents waiting in front of each pipeline stage", ("stage",)
+)
+QUEUE_SECONDS = REGISTRY.histogram(
+    "pipeline_queue_seconds", "Time a document waited in front of each pipeline stage", ("stage",)
+)
+BUSY_WORKERS = REGISTRY.gauge(
+    "pipeline_busy_workers", "Workers of each pipeline stage working on a document", ("stage",)
+)
+
+
+@contextmanager
+def timed_stage(stage):
+    # also works as a decorator: @timed_stage("ocr")
+    document_type = current_document_type.get()
+    started_at = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_ERRORS.inc(stage=stage, document_type=document_type)
+        raise
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - started_at, stage=stage, document_type=document_type)
+
+
+def timed_async_stage(stage):
+    # @timed_stage for async def functions, which would otherwise only time the creation of the coroutine
+    def decorate(function):
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            with timed_stage(stage):
+                return await function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def document_label(file_path, document_type=None, default_document_type=None):
+    # the document type passed in, taken from the folder or the script's default, like process_document
+    # resolves it. the file extension when none of them is known
+    return (
+        canonical_document_type(document_type)
+        or canonical_document_type(document_type_for(file_path, default_document_type))
+        or os.path.splitext(file_path)[1].lstrip(".").lower()
+        or "unknown"
+    )
+
+
+def track_document(process_document=None, default_document_type=None):
+    # wraps process_document(file_path, ..., document_type=None): labels every stage with the document type
+    # and times the whole document. works on async def versions too.
+    # @track_document(default_document_type=...) passes the script's default type on to document_label
+    if process_document is None:
+        return functools.partial(track_document, default_document_type=default_document_type)
+    signature = inspect.signature(process_document)
+
+    def start(file_path, args, kwargs):
+        arguments = signature.bind_partial(file_path, *args, **kwargs).arguments
+        return current_document_type.set(
+            document_label(file_path, arguments.get("document_type"), default_document_type)
+        )
+
+    if inspect.iscoroutinefunction(process_document):
+        @functools.wraps(process_document)
+        async def async_wrapper(file_path, *args, **kwargs):
+            token = start(file_path, args, kwargs)
+            try:
+                with timed_stage("document"):
+                    result = await process_document(file_path, *args, **kwargs)
+                count_document(result)
+                return result
+            finally:
+                current_document_type.reset(token)
+        return async_wrapper
+
+    @functools.wraps(process_document)
+    def wrapper(file_path, *args, **kwargs):
+        token = start(file_path, args, kwargs)
+        try:
+            with timed_stage("document"):
+                result = process_document(file_path, *args, **kwargs)
+            count_document(result)
+            return result
+        finally:
+            current_document_type.reset(token)
+    return wrapper
+
+
+def count_document(result):
+    failed = isinstance(result, dict) and "error" in result
+    DOCUMENTS.inc(result="failed" if failed else "succeeded", document_type=current_document_type.get())
+
+
+def document_context(file_path, document_type=None, default_document_type=None):
+    # a context labelled like track_document does, for a document whose stages run on different threads
+    context = contextvars.copy_context()
+    context.run(current_document_type.set, document_label(file_path, document_type, default_document_type))
+    return context
+
+
+def count_pages(stage, count):
+    if count:
+        PAGES.inc(count, stage=stage, document_type=current_document_type.get())
+
+
+def count_cache_lookup(cache, hit):
+    CACHE_LOOKUPS.inc(cache=cache, result="hit" if hit else "miss")
+
+
+def record_llm_usage(response):
+    LLM_REQUESTS.inc(result="ok")
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        return
+    LLM_TOKENS.inc(getattr(usage, "prompt_tokens", 0) or 0, kind="prompt")
+    LLM_TOKENS.inc(cached_prompt_tokens(response), kind="cached_prompt")
+    LLM_TOKENS.inc(getattr(usage, "completion_tokens", 0) or 0, kind="completion")
+
+
+def cached_prompt_tokens(response):
+    # prompt tokens the provider served from its prompt cache (usage.prompt_tokens_details.cached_tokens)
+    details = getattr(getattr(response, "usage", None), "prompt_tokens_details", None)
+    if isinstance(details, dict):
+        return details.get("cached_tokens") or 0
+    return getattr(details, "cached_tokens", 0) or 0
+
+
+def observe_llm_request(response, seconds):
+    LLM_SECONDS.observe(seconds, prompt_cache="hit" if cached_prompt_tokens(response) else "miss")
+
+
+def render_metrics():
+    return REGISTRY.render()
+
+
+def metrics_summary():
+    # per stage and document type: how often it ran, total and mean seconds, p95 and its share of the total time
+    stages = []
+    series_by_key = STAGE_SECONDS.snapshot()
+    # "document" wraps the other stages, leave it out of the shares
+    total_seconds = sum(series["sum"] for (stage, _), series in series_by_key.items() if stage != "document")
+    for (stage, document_type), series in sorted(series_by_key.items(), key=lambda item: -item[1]["sum"]):
+        stages.append({
+            "stage": stage,
+            "document_type": document_type,
+            "count": series["count"],
+            "total_seconds": round(series["sum"], 3),
+            "mean_seconds": round(series["sum"] / series["count"], 3) if series["count"] else 0.0,
+            "p95_seconds": STAGE_SECONDS.quantile(series, 0.95),
+            "share": round(series["sum"] / total_seconds, 3) if total_seconds and stage != "document" else None,
+        })
+    return {
+        "stages": stages,
+        "errors": {"/".join(key): value for key, value in STAGE_ERRORS.snapshot().items()},
+        "pages": {"/".join(key): value for key, value in PAGES.snapshot().items()},
+        "llm_requests": {key[0]: value for key, value in LLM_REQUESTS.snapshot().items()},
+        "llm_tokens": {key[0]: value for key, value in LLM_TOKENS.snapshot().items()},
+        "llm_retries": {key[0]: value for key, value in LLM_RETRIES.snapshot().items()},
+        "cache_lookups": {"/".join(key): value for key, value in CACHE_LOOKUPS.snapshot().items()},
+        # mean LLM latency with and without a provider prompt cache hit
+        "llm_mean_seconds": {
+            key[0]: round(series["sum"] / series["count"], 3)
+            for key, series in LLM_SECONDS.snapshot().items() if series["count"]
+        },
+    }
+
+
+def print_metrics_summary(summary=None):
+    summary = summary or metrics_summary()
+    print("Time per stage (slowest first):")
+    for stage in summary["stages"]:
+        share = f", {stage['share'] * 100:.0f}% of stage time" if stage["share"] is not None else ""
+        print(
+            f"  {stage['stage']} [{stage['document_type']}]: {stage['count']} calls, "
+            f"{stage['total_seconds']}s total, {stage['mean_seconds']}s mean, p95 <= {format_bound(stage['p95_seconds'])}s{share}"
+        )
+    for name in ("errors", "pages", "llm_requests", "llm_tokens", "llm_retries", "cache_lookups", "llm_mean_seconds"):
+        if summary[name]:
+            print(f"  {name}: {summary[name]}")
@@ -1,12 +1,29 @@
 import os
 import json
-from fastapi import FastAPI
-from fastapi.responses import JSONResponse
+import asyncio
+import tempfile
+from fastapi import FastAPI, UploadFile, File
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, PlainTextResponse
 from azure.ai.formrecognizer import DocumentAnalysisClient
+from azure.ai.formrecognizer.aio import DocumentAnalysisClient as AsyncDocumentAnalysisClient
 from azure.core.credentials import AzureKeyCredential
 from dotenv import load_dotenv
 import requests
-from openai import AzureOpenAI
+from openai_clients import get_openai_client, get_async_openai_client, close_async_openai_clients
+from ocr_correction import correct_pages_batched, correct_pages_batched_async, build_batch_prompt, split_by_confidence, merge_pages
+from ocr_result import document_details_from_result, ocr_pages, confidences_by_page
+from field_prefill import prefill_fields_with_confidence, remaining_fields, merge_prefilled
+from metadata_parser import parse_extracted_metadata, extract_fields, extract_fields_async
+from prompt_builder import build_extraction_prompt
+from field_schemas import document_type_for, fields_for, validate_answers
+from ocr_cache import ocr_cache_from_env
+from pdf_text_layer import details_with_text_layer, details_with_text_layer_async
+from page_dedup import page_index_from_env
+from llm_cache import llm_cache_from_env
+from rate_limiter import rate_limiter_from_env, estimate_request_tokens, priority, PRIORITY_INTERACTIVE
+from metrics import timed_stage, timed_async_stage, track_document, count_pages, count_cache_lookup, record_llm_usage, LLM_REQUESTS, render_metrics
+from job_queue import JobManager, JobQueueFullError, JOB_QUEUED, JOB_RUNNING
 
 
 # Load environment variables
@@ -18,109 +35,329 @@ form_recognizer_key = os.getenv("AZURE_OCR_KEY")
 document_analysis_client = DocumentAnalysisClient(
     endpoint=form_recognizer_endpoint, credential=AzureKeyCredential(form_recognizer_key)
 )
+# the same client from azure.ai.formrecognizer.aio for the async path (/process and /upload)
+async_document_analysis_client = AsyncDocumentAnalysisClient(
+    endpoint=form_recognizer_endpoint, credential=AzureKeyCredential(form_recognizer_key)
+)
+
+# number of pages sent to the LLM at the same time during OCR correction
+ocr_correction_workers = int(os.getenv("OCR_CORRECTION_WORKERS", "4"))
+
+# short pages are packed into one correction request up to this many (estimated) tokens, 0 = one request per page
+ocr_batch_token_budget = int(os.getenv("OCR_BATCH_TOKEN_BUDGET", "600"))
+
+# pages whose average OCR word confidence is at least this high are not sent to the LLM, 0 = correct every page
+ocr_confidence_threshold = float(os.getenv("OCR_CONFIDENCE_THRESHOLD", "0.95"))
+
+# attempts at getting every field out of the LLM, later attempts only ask for the fields still missing
+extraction_max_attempts = int(os.getenv("EXTRACTION_MAX_ATTEMPTS", "5"))
+
+# OCR model and the on-disk cache of its results, keyed by file content hash and model id
+ocr_model_id = "prebuilt-document"
+ocr_cache = ocr_cache_from_env()
+
+# born-digital PDFs: pages with a clean embedded text layer are read locally (needs the optional pypdf package)
+# and skip both Azure OCR and LLM correction, only image-only pages are sent to OCR
+pdf_text_layer_enabled = os.getenv("PDF_TEXT_LAYER", "1") == "1"
+pdf_text_layer_min_chars = int(os.getenv("PDF_TEXT_LAYER_MIN_CHARS", "100"))
+
+# near-duplicates of already corrected pages (riders, notary acknowledgements, disclaimers) reuse that correction.
+# pages repeated in PAGE_DEDUP_BOILERPLATE_DOCUMENTS documents go last in the extraction input,
+# or are left out of it with PAGE_DEDUP_SKIP_BOILERPLATE=1
+page_index = page_index_from_env()
+skip_boilerplate_pages = os.getenv("PAGE_DEDUP_SKIP_BOILERPLATE", "0") == "1"
+
+# opt-in cache of LLM responses (LLM_CACHE_ENABLED=1), pass bypass_cache=True to skip it for one call
+llm_cache = llm_cache_from_env()
+
+# every LLM call is throttled against the deployment's quota (OPENAI_RPM / OPENAI_TPM, 0 = no limit),
+# rate limited and failed requests are retried with backoff
+rate_limiter = rate_limiter_from_env()
+
+# pass document_type (DEED, DEED_OF_TRUST, SETTLEMENT_STATEMENT, ...) to ask only for the fields that type of
+# document can contain, see field_schemas.py. without it (and without DOCUMENT_TYPE) every field is asked for
+default_document_type = os.getenv("DOCUMENT_TYPE") or None
+
+# uploads are spooled to disk in chunks of this size, so memory per request stays bounded
+upload_chunk_size = int(os.getenv("UPLOAD_CHUNK_KB", "1024")) * 1024
+upload_directory = os.getenv("UPLOAD_DIR") or None
+
+# /process and /upload run the async pipeline on the event loop, so one worker process keeps many OCR polls and
+# LLM calls in flight. ASYNC_PIPELINE=0 runs process_document in the thread pool instead. /jobs stays on threads
+async_pipeline_enabled = os.getenv("ASYNC_PIPELINE", "1") == "1"
+
+# background jobs submitted through /jobs, the queue is bounded so a flood of submissions is rejected instead of piling up
+job_manager = JobManager(
+    lambda file_path, pages=None, document_type=None: process_document(file_path, pages, document_type),
+    max_queue_size=int(os.getenv("JOB_QUEUE_SIZE", "500")),
+    workers=int(os.getenv("JOB_WORKERS", "4")),
+)
 
 
 
 # Initialize FastAPI
 app = FastAPI()
 
-def analyze_document(document_path):
+@timed_stage("ocr")
+def analyze_document_details(document_path, pages=None):
+    # pages is an optional 1-based range such as "1-3" or "1,4-5", only those pages are read
+    if pdf_text_layer_enabled:
+        return details_with_text_layer(document_path, pages, ocr_document_details, pdf_text_layer_min_chars)
+    return ocr_document_details(document_path, pages)
+
+def ocr_cache_hit(document_path, cache_key, cached_details):
+    # counts the OCR cache lookup, shared by the sync and async OCR calls
+    if cache_key is not None:
+        count_cache_lookup("ocr", cached_details is not None)
+    if cached_details is not None:
+        count_pages("ocr_cached", len(cached_details["pages"]))
+        print(f"Using cached OCR result for {document_path}")
+    return cached_details
+
+def ocr_result_details(result):
+    document_details = document_details_from_result(result)
+    count_pages("ocr", len(document_details["pages"]))
+    return document_details
+
+def ocr_document_details(document_path, pages=None):
     try:
+        cache_key = ocr_cache.key_for(document_path, ocr_model_id, pages)
+        cached_details = ocr_cache_hit(document_path, cache_key, ocr_cache.get(cache_key))
+        if cached_details is not None:
+            return cached_details
+
+        # the open file is streamed to Azure instead of being read into memory first
+        analyze_options = {"pages": pages} if pages else {}
         with open(document_path, "rb") as f:
             poller = document_analysis_client.begin_analyze_document(
-                "prebuilt-document", document=f.read()
+                ocr_model_id, document=f, **analyze_options
             )
-        result = poller.result()
+        document_details = ocr_result_details(poller.result())
+        ocr_cache.set(cache_key, document_details, model_id=ocr_model_id, source=document_path)
+        return document_details
+    except Exception as e:
+        print(f"Error during document analysis: {e}")
+        raise
+
+def analyze_document(document_path, pages=None):
+    return ocr_pages(analyze_document_details(document_path, pages))
 
-        extracted_data = []
-        for page in result.pages:
-            page_content = " ".join([line.content for line in page.lines])
-            extracted_data.append({str(page.page_number - 1): page_content})
-        return extracted_data
+
+@timed_async_stage("ocr")
+async def analyze_document_details_async(document_path, pages=None):
+    # analyze_document_details() on the async client: the OCR poll waits on the event loop, not in a thread
+    if pdf_text_layer_enabled:
+        return await details_with_text_layer_async(document_path, pages, ocr_document_details_async, pdf_text_layer_min_chars)
+    return await ocr_document_details_async(document_path, pages)
+
+async def ocr_document_details_async(document_path, pages=None):
+    try:
+        # hashing the file for the cache key and the cache's disk reads and writes run in threads
+        cache_key = await asyncio.to_thread(ocr_cache.key_for, document_path, ocr_model_id, pages)
+        cached_details = ocr_cache_hit(document_path, cache_key, await asyncio.to_thread(ocr_cache.get, cache_key))
+        if cached_details is not None:
+            return cached_details
+
+        analyze_options = {"pages": pages} if pages else {}
+        with open(document_path, "rb") as f:
+            poller = await async_document_analysis_client.begin_analyze_document(
+                ocr_model_id, document=f, **analyze_options
+            )
+        document_details = ocr_result_details(await poller.result())
+        await asyncio.to_thread(ocr_cache.set, cache_key, document_details, model_id=ocr_model_id, source=document_path)
+        return document_details
     except Exception as e:
         print(f"Error during document analysis: {e}")
         raise
 
-def process_ocr_output(ocr_output):
+async def analyze_document_async(document_path, pages=None):
+    return ocr_pages(await analyze_document_details_async(document_path, pages))
+
+def correction_limits(max_workers, token_budget):
+    if max_workers is None:
+        max_workers = ocr_correction_workers
+    if token_budget is None:
+        token_budget = ocr_batch_token_budget
+    return max_workers, token_budget
+
+def pages_needing_correction(ocr_output, pages_to_check, reused_pages, boilerplate, page_confidences, stats):
+    # the pages left for the LLM after the near-duplicate lookup and the confidence split, with their stats and counts
+    if reused_pages:
+        print(f"Reusing the correction of {len(reused_pages)} of {len(ocr_output)} near-duplicate pages")
+    pages_to_correct, skipped_pages = split_by_confidence(pages_to_check, page_confidences, ocr_confidence_threshold)
+    if skipped_pages:
+        print(f"Skipping LLM correction for {len(skipped_pages)} of {len(ocr_output)} pages with high OCR confidence")
+    if stats is not None:
+        stats["pages_corrected"] = len(pages_to_correct)
+        stats["pages_skipped"] = len(skipped_pages)
+        stats["pages_reused"] = len(reused_pages)
+        stats["boilerplate_pages"] = boilerplate
+    count_pages("corrected", len(pages_to_correct))
+    count_pages("skipped", len(skipped_pages))
+    count_pages("reused", len(reused_pages))
+    return pages_to_correct
+
+@timed_stage("correction")
+def process_ocr_output(ocr_output, max_workers=None, token_budget=None, page_confidences=None, stats=None, document_id=None):
+    max_workers, token_budget = correction_limits(max_workers, token_budget)
     try:
-        corrected_output_parts = []
-        
-        for page in ocr_output:
-            page_content = list(page.values())[0]
-            messages = f"You are a helpful assistant that fixes errors in OCR outputs and provides correct data in the same JSON format.:\n{page_content}"
-            response = get_openai_response(messages)
-            corrected_output_parts.append({list(page.keys())[0]: response})
-        
-        return corrected_output_parts
+        # near-duplicates of pages corrected before take that correction instead of another LLM call
+        pages_to_check, reused_pages, boilerplate = page_index.split_reusable(ocr_output, document_id)
+        pages_to_correct = pages_needing_correction(
+            ocr_output, pages_to_check, reused_pages, boilerplate, page_confidences, stats
+        )
+        corrected_pages = correct_pages_batched(pages_to_correct, correct_ocr_page, correct_ocr_batch, token_budget, max_workers)
+        # skipped and failed pages are indexed without a correction, they only count towards boilerplate
+        page_index.remember(pages_to_check, corrected_pages, document_id)
+        return merge_pages(ocr_output, reused_pages + corrected_pages)
     except json.JSONDecodeError as e:
-        print(f"Error parsing corrected JSON: {e}") 
+        print(f"Error parsing corrected JSON: {e}")
         raise
 
+def correct_ocr_page(page_content):
+    messages = f"You are a helpful assistant that fixes errors in OCR outputs and provides correct data in the same JSON format.:\n{page_content}"
+    return get_openai_response(messages)
 
+def correct_ocr_batch(pages):
+    messages = build_batch_prompt("You are a helpful assistant that fixes errors in OCR outputs.", pages)
+    return get_openai_response(messages)
 
-def get_openai_response(messages):
+@timed_async_stage("correction")
+async def process_ocr_output_async(ocr_output, max_workers=None, token_budget=None, page_confidences=None, stats=None, document_id=None):
+    # process_ocr_output() with the correction requests as tasks on the event loop, max_workers of them in flight
+    max_workers, token_budget = correction_limits(max_workers, token_budget)
     try:
-        client = AzureOpenAI(
-            api_key=os.getenv("OPENAI_API_KEY"),
-            api_version="2024-07-01-preview",  
-            azure_endpoint=os.getenv("OPENAI_ENDPOINT"),
-            azure_deployment="aipal",
+        pages_to_check, reused_pages, boilerplate = await asyncio.to_thread(page_index.split_reusable, ocr_output, document_id)
+        pages_to_correct = pages_needing_correction(
+            ocr_output, pages_to_check, reused_pages, boilerplate, page_confidences, stats
         )
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",  
-            messages=[
-                {"role": "user", "content": "You are a helpful assistant."},
-                {"role": "user", "content": messages}
-            ],
-            max_tokens=800
+        corrected_pages = await correct_pages_batched_async(
+            pages_to_correct, correct_ocr_page_async, correct_ocr_batch_async, token_budget, max_workers
+        )
+        await asyncio.to_thread(page_index.remember, pages_to_check, corrected_pages, document_id)
+        return merge_pages(ocr_output, reused_pages + corrected_pages)
+    except json.JSONDecodeError as e:
+        print(f"Error parsing corrected JSON: {e}")
+        raise
+
+async def correct_ocr_page_async(page_content):
+    messages = f"You are a helpful assistant that fixes errors in OCR outputs and provides correct data in the same JSON format.:\n{page_content}"
+    return await get_openai_response_async(messages)
+
+async def correct_ocr_batch_async(pages):
+    messages = build_batch_prompt("You are a helpful assistant that fixes errors in OCR outputs.", pages)
+    return await get_openai_response_async(messages)
+
+def chat_request(messages, bypass_cache=False, response_format=None):
+    # the chat.completions.create() arguments and their cache key, the same for the sync and async clients
+    chat_messages = [
+        {"role": "user", "content": "You are a helpful assistant."},
+        {"role": "user", "content": messages}
+    ]
+    cache_key = None if bypass_cache else llm_cache.key_for("gpt-3.5-turbo", "aipal", chat_messages, 800, response_format=response_format)
+    request = {
+        "model": "gpt-3.5-turbo",
+        "messages": chat_messages,
+        "max_tokens": 800,
+        **({"response_format": response_format} if response_format else {})
+    }
+    return request, cache_key
+
+def llm_cache_hit(cache_key, cached_response, validate=None):
+    # validate(response_text) is true for a usable response. only those are cached, so a retry after an
+    # unparseable answer asks the model again instead of getting the same text back from the cache
+    if cached_response is not None and validate is not None and not validate(cached_response):
+        cached_response = None
+    if cache_key is not None:
+        count_cache_lookup("llm", cached_response is not None)
+    if cached_response is not None:
+        LLM_REQUESTS.inc(result="cached")
+    return cached_response
+
+def llm_response_text(response):
+    record_llm_usage(response)
+    return response.choices[0].message.content.strip()
+
+def llm_request_failed(e):
+    LLM_REQUESTS.inc(result="error")
+    print(f"Error fetching response from Azure OpenAI: {e}")
+
+def get_openai_response(messages, bypass_cache=False, response_format=None, validate=None):
+    request, cache_key = chat_request(messages, bypass_cache, response_format)
+    cached_response = llm_cache_hit(cache_key, llm_cache.get(cache_key), validate)
+    if cached_response is not None:
+        return cached_response
+    try:
+        client = get_openai_client("azure")
+        response = rate_limiter.call(
+            lambda: client.chat.completions.create(**request),
+            estimate_request_tokens(request["messages"], request["max_tokens"]),
         )
+        response_text = llm_response_text(response)
+        if validate is None or validate(response_text):
+            llm_cache.set(cache_key, response_text)
+        return response_text
+    except Exception as e:
+        llm_request_failed(e)
+        return None
 
-        return response.choices[0].message.content.strip()
+async def get_openai_response_async(messages, bypass_cache=False, response_format=None, validate=None):
+    # get_openai_response() on the async client, sharing the cache and the rate limiter with the threads
+    request, cache_key = chat_request(messages, bypass_cache, response_format)
+    cached_response = llm_cache_hit(cache_key, await asyncio.to_thread(llm_cache.get, cache_key), validate)
+    if cached_response is not None:
+        return cached_response
+    try:
+        client = get_async_openai_client("azure")
+        response = await rate_limiter.call_async(
+            lambda: client.chat.completions.create(**request),
+            estimate_request_tokens(request["messages"], request["max_tokens"]),
+        )
+        response_text = llm_response_text(response)
+        if validate is None or validate(response_text):
+            await asyncio.to_thread(llm_cache.set, cache_key, response_text)
+        return response_text
     except Exception as e:
-        print(f"Error fetching response from Azure OpenAI: {e}")
+        llm_request_failed(e)
         return None
 
     
-def get_metadata(content):
-   prompt = """
-You are an AI assistant tasked with extracting specific metadata fields from a document. Your goal is to accurately extract all required fields from the given document text and provide confidence scores for each extraction. Follow these instructions carefully:
-
-1. Here is the full text of the document:
-<document_text>
-{content}
-</document_text>
-
-2. You need to extract information for the following fields:
-
-<fields_to_extract>
-Seller Name
-Seller Suffix
-Seller Relationship
-Seller Current Address
-Seller Same as Property address
-Seller City
-Seller State
-Seller Zip Code
-Seller Email address
-Seller WorkPhone /Ext:
-Seller Fax
-Seller Marketing Rep
-Seller Marketing Source
-Buyer Name
-Buyer Suffix
-Buyer Relationship
-Buyer Current Address
-Buyer Same as Property address
-Buyer City
-Buyer State
-Buyer Zip Code
-Buyer Email address
-Buyer WorkPhone /Ext:
-Buyer Fax
-Buyer Marketing Rep
-Buyer Marketing Source
-
-</fields_to_extract>
+# fields extracted by get_metadata
+metadata_fields = [
+    'Seller Name',
+    'Seller Suffix',
+    'Seller Relationship',
+    'Seller Current Address',
+    'Seller Same as Property address',
+    'Seller City',
+    'Seller State',
+    'Seller Zip Code',
+    'Seller Email address',
+    'Seller WorkPhone /Ext:',
+    'Seller Fax',
+    'Seller Marketing Rep',
+    'Seller Marketing Source',
+    'Buyer Name',
+    'Buyer Suffix',
+    'Buyer Relationship',
+    'Buyer Current Address',
+    'Buyer Same as Property address',
+    'Buyer City',
+    'Buyer State',
+    'Buyer Zip Code',
+    'Buyer Email address',
+    'Buyer WorkPhone /Ext:',
+    'Buyer Fax',
+    'Buyer Marketing Rep',
+    'Buyer Marketing Source',
+]
+
+# static part of the extraction prompt, the field list and then the document text are appended after it
+metadata_instructions = """You are an AI assistant tasked with extracting specific metadata fields from a document. Your goal is to accurately extract all required fields from the given document text and provide confidence scores for each extraction. Follow these instructions carefully:
+
+1. You need to extract information for the fields listed in <fields_to_extract> below.
+
+2. The full text of the document follows the field list, in <document_text>.
 
 3. To extract the information:
 a. Carefully read through the entire document text.
@@ -155,43 +392,125 @@ a. Double-check each extracted field against the original document to ensure acc
 b. Verify that you have addressed all fields listed in the <fields_to_extract> section.
 
 Remember, accuracy and completeness are crucial. Take your time to carefully extract all required information from the document and provide appropriate confidence scores for each extraction.
-   """
+"""
+
+def parse_metadata(response, fields_to_ask):
+    return validate_answers(parse_extracted_metadata(response, fields_to_ask))
+
+@timed_stage("extraction")
+def get_metadata(content, fields=None):
+   if fields is None:
+       fields = metadata_fields
    try:
-       response = get_openai_response(prompt.format(content=content))
-       return response
-       # Parse the XML-like response
-    #    import xml.etree.ElementTree as ET
-    #    root = ET.fromstring(response)
-    #    return {elem.tag: elem.text for elem in root}
+       # the <extracted_metadata> answer is parsed locally, fields it is missing are asked for again on their own
+       return extract_fields(
+           lambda fields_to_ask: get_openai_response(
+               build_extraction_prompt(metadata_instructions, fields_to_ask, content),
+               validate=lambda response: parse_metadata(response, fields_to_ask),
+           ),
+           parse_metadata,
+           fields,
+           extraction_max_attempts,
+       )
         
    except Exception as e:
        print(f"Failed to parse OpenAI response for metadata: {e}")
        return None
 
-def process_document(file_path):
+@timed_async_stage("extraction")
+async def get_metadata_async(content, fields=None):
+    if fields is None:
+        fields = metadata_fields
+    try:
+        return await extract_fields_async(
+            lambda fields_to_ask: get_openai_response_async(
+                build_extraction_prompt(metadata_instructions, fields_to_ask, content),
+                validate=lambda response: parse_metadata(response, fields_to_ask),
+            ),
+            parse_metadata,
+            fields,
+            extraction_max_attempts,
+        )
+    except Exception as e:
+        print(f"Failed to parse OpenAI response for metadata: {e}")
+        return None
+
+def add_prefilled_metadata(fields_and_answers, prefilled, fields):
+    # pre-filled fields use the same {"value", "confidence"} shape as the parsed LLM answer (confidence 0-100)
+    prefilled_answers = {
+        field: {"value": value, "confidence": round(confidence * 100)} for field, (value, confidence) in prefilled.items()
+    }
+    return merge_prefilled(fields_and_answers, prefilled_answers, fields)
+
+def extraction_result(fields_and_answers, prefilled, fields):
+    if fields_and_answers is None:
+        return {"error": "Failed to extract metadata from OpenAI"}
+    return add_prefilled_metadata(fields_and_answers, prefilled, fields)
+
+def document_fields(file_path, document_type=None):
+    return fields_for(document_type or document_type_for(file_path, default_document_type), metadata_fields)
+
+def extraction_text(processed_data, ocr_stats):
+    processed_data = page_index.order_for_extraction(
+        processed_data, ocr_stats["boilerplate_pages"], skip_boilerplate_pages
+    )
+    print("Processed OCR is completed. Now getting values for the fields.")
+    return processed_data
+
+def prefill_from_ocr(document_details, fields):
+    # fields Azure already paired with a value are filled directly, the LLM is only asked for the rest
+    prefilled = prefill_fields_with_confidence(document_details.get("key_value_pairs"), fields)
+    if prefilled:
+        print(f"Pre-filled {len(prefilled)} of {len(fields)} fields from OCR key-value pairs")
+    return prefilled, remaining_fields(fields, prefilled)
+
+@track_document(default_document_type=default_document_type)
+def process_document(file_path, pages=None, document_type=None):
+    fields = document_fields(file_path, document_type)
     try:
-        extracted_data = analyze_document(file_path)
+        document_details = analyze_document_details(file_path, pages)
+        extracted_data = ocr_pages(document_details)
         print("OCR is completed, now processing OCR output")
         if not extracted_data:
             return {"error": "No data extracted"}
         else:
-            processed_data = process_ocr_output(extracted_data)
-            print("Processed OCR is completed. Now getting values for the fields.")
+            ocr_stats = {}
+            processed_data = process_ocr_output(
+                extracted_data, page_confidences=confidences_by_page(document_details), stats=ocr_stats, document_id=file_path
+            )
+            processed_data = extraction_text(processed_data, ocr_stats)
 
-        fields_and_answers = get_metadata(processed_data)
-        max_attempts = 5
-        attempt = 0
+        prefilled, fields_to_ask = prefill_from_ocr(document_details, fields)
+        if not fields_to_ask:
+            return add_prefilled_metadata({}, prefilled, fields)
 
-        while fields_and_answers is None and attempt < max_attempts:
-            fields_and_answers = get_metadata(processed_data)
-            if fields_and_answers is None:
-                print(f"Attempt {attempt + 1}: Unexpected response from OpenAI, retrying...")
-            attempt += 1
+        return extraction_result(get_metadata(processed_data, fields_to_ask), prefilled, fields)
 
-        if fields_and_answers is None:
-            return {"error": "Failed to extract metadata from OpenAI"}
-        else:
-            return fields_and_answers
+    except Exception as e:
+        print(f"Document analysis (OCR) failed for the document: {e}")
+        return {"error": str(e)}
+
+@track_document(default_document_type=default_document_type)
+async def process_document_async(file_path, pages=None, document_type=None):
+    # process_document() on the async clients, many documents can be in flight on one event loop
+    fields = document_fields(file_path, document_type)
+    try:
+        document_details = await analyze_document_details_async(file_path, pages)
+        extracted_data = ocr_pages(document_details)
+        print("OCR is completed, now processing OCR output")
+        if not extracted_data:
+            return {"error": "No data extracted"}
+        ocr_stats = {}
+        processed_data = await process_ocr_output_async(
+            extracted_data, page_confidences=confidences_by_page(document_details), stats=ocr_stats, document_id=file_path
+        )
+        processed_data = extraction_text(processed_data, ocr_stats)
+
+        prefilled, fields_to_ask = prefill_from_ocr(document_details, fields)
+        if not fields_to_ask:
+            return add_prefilled_metadata({}, prefilled, fields)
+
+        return extraction_result(await get_metadata_async(processed_data, fields_to_ask), prefilled, fields)
 
     except Exception as e:
         print(f"Document analysis (OCR) failed for the document: {e}")
@@ -202,11 +521,89 @@ def process_document(file_path):
 def read_root():
     return {"status": "success"}
 
+@app.get("/metrics")
+def metrics_route():
+    # Prometheus text format: stage latency histograms by document type, page, token, cache and retry counters
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+@app.get("/cache/stats")
+def cache_stats_route():
+    return {
+        "ocr_cache": ocr_cache.stats(),
+        "llm_cache": llm_cache.stats(),
+        "rate_limiter": rate_limiter.stats(),
+        "page_dedup": page_index.stats(),
+    }
+
 @app.get("/process")
-def process_route(file_path: str):
-    process_result = process_document(file_path)
+async def process_route(file_path: str, pages: str = None, document_type: str = None):
+    # someone is waiting on the response, so its LLM calls go ahead of queued /jobs work
+    with priority(PRIORITY_INTERACTIVE):
+        if async_pipeline_enabled:
+            process_result = await process_document_async(file_path, pages, document_type)
+        else:
+            process_result = await run_in_threadpool(process_document, file_path, pages, document_type)
     return JSONResponse(content=process_result, status_code=200)
 
+@app.post("/upload")
+async def upload_route(file: UploadFile = File(...), pages: str = None, document_type: str = None):
+    suffix = os.path.splitext(file.filename or "")[1]
+    fd, spool_path = tempfile.mkstemp(suffix=suffix, dir=upload_directory)
+    try:
+        with os.fdopen(fd, "wb") as spool:
+            while True:
+                chunk = await file.read(upload_chunk_size)
+                if not chunk:
+                    break
+                spool.write(chunk)
+        with priority(PRIORITY_INTERACTIVE):
+            if async_pipeline_enabled:
+                process_result = await process_document_async(spool_path, pages, document_type)
+            else:
+                process_result = await run_in_threadpool(process_document, spool_path, pages, document_type)
+    finally:
+        await file.close()
+        os.remove(spool_path)
+    return JSONResponse(content=process_result, status_code=200)
+
+@app.on_event("startup")
+def start_job_workers():
+    job_manager.start()
+
+@app.on_event("shutdown")
+def stop_job_workers():
+    job_manager.stop()
+
+@app.on_event("shutdown")
+async def close_async_clients():
+    await async_document_analysis_client.close()
+    await close_async_openai_clients()
+
+@app.post("/jobs")
+def submit_job_route(file_path: str, pages: str = None, document_type: str = None):
+    try:
+        job_id = job_manager.submit(file_path, pages, document_type)
+    except JobQueueFullError as e:
+        return JSONResponse(content={"error": str(e)}, status_code=503)
+    return JSONResponse(content={"job_id": job_id, "status": JOB_QUEUED}, status_code=202)
+
+@app.get("/jobs/{job_id}")
+def job_status_route(job_id: str):
+    status = job_manager.status(job_id)
+    if status is None:
+        return JSONResponse(content={"error": "Unknown job id"}, status_code=404)
+    return JSONResponse(content=status, status_code=200)
+
+@app.get("/jobs/{job_id}/result")
+def job_result_route(job_id: str):
+    job = job_manager.result(job_id)
+    if job is None:
+        return JSONResponse(content={"error": "Unknown job id"}, status_code=404)
+    if job["status"] in (JOB_QUEUED, JOB_RUNNING):
+        return JSONResponse(content={"job_id": job_id, "status": job["status"]}, status_code=202)
+    return JSONResponse(content=job["result"], status_code=200)
+
+
 if __name__ == '__main__':
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8008)
@@ -0,0 +1,26 @@
+import os
+import hashlib
+from disk_cache import DiskCache, file_sha256
+
+# bump this when the shape of the cached OCR output changes so old entries are ignored
+CACHE_FORMAT_VERSION = 4
+
+
+class OCRCache(DiskCache):
+    def key_for(self, document_path, model_id, pages=None):
+        if not self.enabled:
+            return None
+        content_hash = file_sha256(document_path)
+        key_text = f"{CACHE_FORMAT_VERSION}:{model_id}:{content_hash}"
+        if pages:
+            key_text += f":{pages}"
+        return hashlib.sha256(key_text.encode("utf-8")).hexdigest()
+
+
+def ocr_cache_from_env():
+    return OCRCache(
+        cache_dir=os.getenv("OCR_CACHE_DIR", ".ocr_cache"),
+        max_bytes=int(float(os.getenv("OCR_CACHE_MAX_MB", "1024")) * 1024 * 1024),
+        max_age_seconds=int(float(os.getenv("OCR_CACHE_MAX_AGE_DAYS", "30")) * 24 * 3600),
+        enabled=os.getenv("OCR_CACHE_ENABLED", "1") == "1",
+    )
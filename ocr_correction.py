@@ -0,0 +1,208 @@
+import re
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+
+def correct_pages(ocr_output, correct_page, max_workers=1):
+    # correct_page takes the raw text of one page and returns the corrected text (or None on failure).
+    # the result keeps the [{page_index: text}, ...] shape and the original page order.
+    if not max_workers or max_workers <= 1 or len(ocr_output) <= 1:
+        return [correct_single_page(page, correct_page) for page in ocr_output]
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(ocr_output))) as executor:
+        futures = [
+            executor.submit(contextvars.copy_context().run, correct_single_page, page, correct_page)
+            for page in ocr_output
+        ]
+        return [future.result() for future in futures]
+
+
+def correct_single_page(page, correct_page):
+    page_index, page_content = next(iter(page.items()))
+    try:
+        response = correct_page(page_content)
+    except Exception as e:
+        print(f"Error correcting OCR output for page {page_index}: {e}")
+        response = None
+
+    if response is None:
+        # keep the raw OCR text so a single failed page doesn't lose the rest of the document
+        print(f"Using uncorrected OCR text for page {page_index}")
+        return {page_index: page_content}
+    return {page_index: response}
+
+
+# pages packed into one correction request are separated by these marker lines
+PAGE_MARKER = "<<<PAGE {page_index}>>>"
+PAGE_MARKER_PATTERN = re.compile(r"^\s*<<<PAGE\s+([^>\s]+)\s*>>>\s*$", re.MULTILINE)
+
+
+def estimate_tokens(text):
+    # rough count (about 4 characters per token), good enough to size requests
+    return len(text) // 4 + 1
+
+
+def pack_pages(ocr_output, token_budget):
+    # groups consecutive pages until the next page would push the group past token_budget
+    groups = []
+    current_group = []
+    current_tokens = 0
+    for page in ocr_output:
+        page_tokens = estimate_tokens(next(iter(page.values())) or "")
+        if current_group and current_tokens + page_tokens > token_budget:
+            groups.append(current_group)
+            current_group = []
+            current_tokens = 0
+        current_group.append(page)
+        current_tokens += page_tokens
+    if current_group:
+        groups.append(current_group)
+    return groups
+
+
+def build_batch_prompt(instruction, pages):
+    parts = [
+        f"{instruction}\n"
+        "The text below contains several pages. Each page starts with a marker line such as "
+        f"{PAGE_MARKER.format(page_index=0)}. Return the corrected text of every page, keeping every "
+        "marker line exactly as it is, in the same order, and nothing else."
+    ]
+    for page in pages:
+        page_index, page_content = next(iter(page.items()))
+        parts.append(f"{PAGE_MARKER.format(page_index=page_index)}\n{page_content}")
+    return "\n\n".join(parts)
+
+
+def split_batch_response(response, pages):
+    # returns the corrected pages, or None when the markers in the response don't match the pages sent
+    if not response:
+        return None
+    expected_indexes = [next(iter(page.keys())) for page in pages]
+    matches = list(PAGE_MARKER_PATTERN.finditer(response))
+    if [match.group(1) for match in matches] != expected_indexes:
+        return None
+
+    corrected_pages = []
+    for position, match in enumerate(matches):
+        end = matches[position + 1].start() if position + 1 < len(matches) else len(response)
+        page_text = response[match.end():end].strip()
+        original_text = next(iter(pages[position].values()))
+        if not page_text and original_text.strip():
+            return None
+        corrected_pages.append({expected_indexes[position]: page_text})
+    return corrected_pages
+
+
+def correct_pages_batched(ocr_output, correct_page, correct_batch, token_budget, max_workers=1):
+    # correct_batch takes a list of pages and returns the raw LLM response for all of them.
+    # when its response can't be split back into pages, every page in the group is corrected on its own.
+    if not ocr_output:
+        return []
+    if not token_budget or token_budget <= 0:
+        return correct_pages(ocr_output, correct_page, max_workers)
+
+    groups = pack_pages(ocr_output, token_budget)
+    print(f"Correcting {len(ocr_output)} pages in {len(groups)} requests")
+
+    def correct_group(group):
+        if len(group) == 1:
+            return [correct_single_page(group[0], correct_page)]
+        try:
+            corrected_pages = split_batch_response(correct_batch(group), group)
+        except Exception as e:
+            print(f"Error correcting OCR output for pages {[next(iter(page)) for page in group]}: {e}")
+            corrected_pages = None
+        if corrected_pages is None:
+            print("Could not split the batched correction, falling back to one request per page")
+            return [correct_single_page(page, correct_page) for page in group]
+        return corrected_pages
+
+    if not max_workers or max_workers <= 1 or len(groups) <= 1:
+        grouped_results = [correct_group(group) for group in groups]
+    else:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(groups))) as executor:
+            futures = [executor.submit(contextvars.copy_context().run, correct_group, group) for group in groups]
+            grouped_results = [future.result() for future in futures]
+    return [page for group_result in grouped_results for page in group_result]
+
+
+async def correct_pages_async(ocr_output, correct_page, max_concurrency=1):
+    # correct_pages() for an async correct_page: at most max_concurrency requests of the document in flight
+    semaphore = asyncio.Semaphore(max(1, max_concurrency or 1))
+
+    async def correct(page):
+        async with semaphore:
+            return await correct_single_page_async(page, correct_page)
+    return list(await asyncio.gather(*(correct(page) for page in ocr_output)))
+
+
+async def correct_single_page_async(page, correct_page):
+    page_index, page_content = next(iter(page.items()))
+    try:
+        response = await correct_page(page_content)
+    except Exception as e:
+        print(f"Error correcting OCR output for page {page_index}: {e}")
+        response = None
+
+    if response is None:
+        print(f"Using uncorrected OCR text for page {page_index}")
+        return {page_index: page_content}
+    return {page_index: response}
+
+
+async def correct_pages_batched_async(ocr_output, correct_page, correct_batch, token_budget, max_concurrency=1):
+    # correct_pages_batched() for async correct_page / correct_batch, the groups run as tasks on the event loop
+    if not ocr_output:
+        return []
+    if not token_budget or token_budget <= 0:
+        return await correct_pages_async(ocr_output, correct_page, max_concurrency)
+
+    groups = pack_pages(ocr_output, token_budget)
+    print(f"Correcting {len(ocr_output)} pages in {len(groups)} requests")
+    semaphore = asyncio.Semaphore(max(1, max_concurrency or 1))
+
+    async def correct_group(group):
+        async with semaphore:
+            if len(group) == 1:
+                return [await correct_single_page_async(group[0], correct_page)]
+            try:
+                corrected_pages = split_batch_response(await correct_batch(group), group)
+            except Exception as e:
+                print(f"Error correcting OCR output for pages {[next(iter(page)) for page in group]}: {e}")
+                corrected_pages = None
+            if corrected_pages is None:
+                print("Could not split the batched correction, falling back to one request per page")
+                return [await correct_single_page_async(page, correct_page) for page in group]
+            return corrected_pages
+
+    grouped_results = await asyncio.gather(*(correct_group(group) for group in groups))
+    return [page for group_result in grouped_results for page in group_result]
+
+
+def split_by_confidence(ocr_output, page_confidences, threshold):
+    # pages whose OCR confidence reaches the threshold (and blank pages) skip LLM correction
+    if not threshold or not page_confidences:
+        return list(ocr_output), []
+    pages_to_correct = []
+    skipped_pages = []
+    for page in ocr_output:
+        page_index, page_content = next(iter(page.items()))
+        confidence = page_confidences.get(page_index)
+        if not (page_content or "").strip() or (confidence is not None and confidence >= threshold):
+            skipped_pages.append(page)
+        else:
+            pages_to_correct.append(page)
+    return pages_to_correct, skipped_pages
+
+
+def merge_pages(ocr_output, corrected_pages):
+    # puts corrected pages back in place of the originals, leaving skipped pages untouched
+    corrected_by_index = {}
+    for page in corrected_pages:
+        corrected_by_index.update(page)
+    merged = []
+    for page in ocr_output:
+        page_index, page_content = next(iter(page.items()))
+        merged.append({page_index: corrected_by_index.get(page_index, page_content)})
+    return merged
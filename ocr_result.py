@@ -0,0 +1,32 @@
+def document_details_from_result(result):
+    # keeps what the pipeline needs from a prebuilt-document result in a JSON friendly shape:
+    # the joined line text of every page plus its word confidences, and the key-value pairs Azure found
+    pages = []
+    for page in result.pages:
+        word_confidences = [word.confidence for word in (page.words or []) if word.confidence is not None]
+        pages.append({
+            "page_index": str(page.page_number - 1),
+            "content": " ".join([line.content for line in page.lines]),
+            "confidence": sum(word_confidences) / len(word_confidences) if word_confidences else None,
+            "min_confidence": min(word_confidences) if word_confidences else None,
+            "word_count": len(word_confidences),
+        })
+    key_value_pairs = []
+    for pair in getattr(result, "key_value_pairs", None) or []:
+        if pair.key is None:
+            continue
+        key_value_pairs.append({
+            "key": pair.key.content,
+            "value": pair.value.content if pair.value is not None else None,
+            "confidence": pair.confidence,
+        })
+    return {"pages": pages, "key_value_pairs": key_value_pairs}
+
+
+def ocr_pages(document_details):
+    # the [{page_index: text}, ...] shape used by process_ocr_output and get_metadata
+    return [{page["page_index"]: page["content"]} for page in document_details["pages"]]
+
+
+def confidences_by_page(document_details):
+    return {page["page_index"]: page.get("confidence") for page in document_details["pages"]}
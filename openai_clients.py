@@ -0,0 +1,125 @@
+import os
+import asyncio
+import threading
+import weakref
+import httpx
+from openai import OpenAI, AzureOpenAI, AsyncOpenAI, AsyncAzureOpenAI
+
+# one client per kind is shared by every pipeline stage so HTTP connections are kept alive and reused.
+#   "openai"   - OpenAI client with OPENAI_API_KEY / OPENAI_ENDPOINT (content.py)
+#   "azure"    - AzureOpenAI client with OPENAI_API_KEY (new_content.py, Updating_in_csv.py)
+#   "azure_ad" - AzureOpenAI client authenticated with DefaultAzureCredential (adm.py)
+AZURE_API_VERSION = "2024-07-01-preview"
+AZURE_DEPLOYMENT = "aipal"
+
+_process_clients = {}
+_thread_clients = threading.local()
+_loop_clients = weakref.WeakKeyDictionary()
+_lock = threading.Lock()
+
+
+def pool_settings(async_client=False):
+    # an event loop keeps far more requests in flight than a thread pool, so async clients get a bigger pool
+    return {
+        "max_connections": int(
+            os.getenv("OPENAI_ASYNC_MAX_CONNECTIONS", "200") if async_client else os.getenv("OPENAI_MAX_CONNECTIONS", "20")
+        ),
+        "max_keepalive_connections": int(os.getenv("OPENAI_MAX_KEEPALIVE_CONNECTIONS", "10")),
+        "keepalive_expiry": float(os.getenv("OPENAI_KEEPALIVE_EXPIRY", "30")),
+        "timeout": float(os.getenv("OPENAI_TIMEOUT", "120")),
+        "connect_timeout": float(os.getenv("OPENAI_CONNECT_TIMEOUT", "10")),
+        # retries are done by rate_limiter.RateLimiter, which also knows about the other workers' traffic
+        "max_retries": int(os.getenv("OPENAI_SDK_MAX_RETRIES", "0")),
+    }
+
+
+def build_http_client(async_client=False):
+    settings = pool_settings(async_client)
+    limits = httpx.Limits(
+        max_connections=settings["max_connections"],
+        max_keepalive_connections=settings["max_keepalive_connections"],
+        keepalive_expiry=settings["keepalive_expiry"],
+    )
+    timeout = httpx.Timeout(settings["timeout"], connect=settings["connect_timeout"])
+    if async_client:
+        return httpx.AsyncClient(limits=limits, timeout=timeout)
+    return httpx.Client(limits=limits, timeout=timeout)
+
+
+def build_openai_client(kind="azure", async_client=False):
+    http_client = build_http_client(async_client)
+    if kind == "openai":
+        client_class = AsyncOpenAI if async_client else OpenAI
+        return client_class(
+            api_key=os.getenv("OPENAI_API_KEY"),
+            base_url=os.getenv("OPENAI_ENDPOINT"),
+            http_client=http_client,
+            max_retries=pool_settings()["max_retries"],
+        )
+
+    client_class = AsyncAzureOpenAI if async_client else AzureOpenAI
+    client_kwargs = {
+        "api_version": AZURE_API_VERSION,
+        "azure_endpoint": os.getenv("OPENAI_ENDPOINT"),
+        "azure_deployment": AZURE_DEPLOYMENT,
+        "http_client": http_client,
+        "max_retries": pool_settings()["max_retries"],
+    }
+    if kind == "azure_ad":
+        from azure.identity import DefaultAzureCredential, get_bearer_token_provider
+        client_kwargs["azure_ad_token_provider"] = get_bearer_token_provider(
+            DefaultAzureCredential(), "https://cognitiveservices.azure.com/.default"
+        )
+    elif kind == "azure":
+        client_kwargs["api_key"] = os.getenv("OPENAI_API_KEY")
+    else:
+        raise ValueError(f"Unknown OpenAI client kind: {kind}")
+    return client_class(**client_kwargs)
+
+
+def get_openai_client(kind="azure", scope=None):
+    # scope "process" shares one client (and connection pool) across all threads,
+    # scope "thread" gives every worker thread its own client
+    scope = scope or os.getenv("OPENAI_CLIENT_SCOPE", "process")
+    if scope == "thread":
+        clients = getattr(_thread_clients, "clients", None)
+        if clients is None:
+            clients = _thread_clients.clients = {}
+        if kind not in clients:
+            clients[kind] = build_openai_client(kind)
+        return clients[kind]
+
+    client = _process_clients.get(kind)
+    if client is None:
+        with _lock:
+            client = _process_clients.get(kind)
+            if client is None:
+                client = _process_clients[kind] = build_openai_client(kind)
+    return client
+
+
+def get_async_openai_client(kind="azure"):
+    # async clients are bound to the event loop that created their connections, so keep one per loop
+    loop = asyncio.get_running_loop()
+    with _lock:
+        clients = _loop_clients.setdefault(loop, {})
+        if kind not in clients:
+            clients[kind] = build_openai_client(kind, async_client=True)
+        return clients[kind]
+
+
+def close_openai_clients():
+    with _lock:
+        clients = list(_process_clients.values())
+        _process_clients.clear()
+    for client in clients:
+        client.close()
+
+
+async def close_async_openai_clients():
+    # closes the async clients of the running event loop, on application shutdown
+    loop = asyncio.get_running_loop()
+    with _lock:
+        clients = list(_loop_clients.pop(loop, {}).values())
+    for client in clients:
+        await client.close()
@@ -0,0 +1,263 @@
+import os
+import re
+import random
+import hashlib
+import threading
+from array import array
+from collections import OrderedDict
+from ocr_correction import estimate_tokens
+
+# 61-bit Mersenne prime for the (a * x + b) mod p permutations
+MERSENNE_PRIME = (1 << 61) - 1
+MAX_HASH = (1 << 32) - 1
+
+
+def page_words(text):
+    return re.sub(r"[^a-z0-9]+", " ", (text or "").lower()).split()
+
+
+def shingles(text, size=5):
+    # overlapping runs of `size` words, short pages are a single shingle
+    words = page_words(text)
+    if len(words) <= size:
+        return {" ".join(words)} if words else set()
+    return {" ".join(words[start:start + size]) for start in range(len(words) - size + 1)}
+
+
+def stable_hash(shingle):
+    # not hash(), which changes between processes
+    return int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class MinHasher:
+    def __init__(self, num_perm=64, seed=1):
+        # fixed seed: signatures must match across runs and worker processes
+        generator = random.Random(seed)
+        self.permutations = [
+            (generator.randrange(1, MERSENNE_PRIME), generator.randrange(0, MERSENNE_PRIME)) for _ in range(num_perm)
+        ]
+
+    def signature(self, hashes):
+        # hashes: the stable hashes of a page's shingles
+        return tuple(
+            min(((a * value + b) % MERSENNE_PRIME) & MAX_HASH for value in hashes) for a, b in self.permutations
+        )
+
+
+def exact_key(text):
+    # the page's text with whitespace collapsed. only a page with the same key reuses a correction: one word or
+    # digit apart (another APN, name or amount) and it gets its own
+    return hashlib.blake2b(" ".join((text or "").split()).encode("utf-8"), digest_size=16).digest()
+
+
+def jaccard(first, second):
+    first, second = set(first), set(second)
+    return len(first & second) / len(first | second) if first or second else 1.0
+
+
+class PageIndex:
+    # near-duplicate pages (standard riders, notary acknowledgements, disclaimers) across the documents of a run.
+    # candidates come from LSH over MinHash signatures (pages sharing any band of the signature), their similarity
+    # is then measured exactly on the shingles.
+    #   threshold: pages at least this similar are the same page, one seen in `boilerplate_documents` different
+    #   documents is boilerplate for extraction
+    # a corrected text is only reused for a page with exactly the same text (see exact_key). similarity can't
+    # decide that: two long pages that differ only in the APN are more than 0.98 similar.
+    def __init__(self, threshold=0.9, num_perm=64, bands=16, max_entries=20000,
+                 boilerplate_documents=3, min_words=30, enabled=True):
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.max_entries = max_entries
+        self.boilerplate_documents = boilerplate_documents
+        self.min_words = min_words
+        self.enabled = enabled
+        self.hasher = MinHasher(num_perm)
+        self.pages_reused = 0
+        self.tokens_saved = 0
+        self.boilerplate_pages = 0
+        self.extraction_tokens_saved = 0
+        self._entries = OrderedDict()
+        self._buckets = {}
+        self._exact = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def band_keys(self, signature):
+        return [(band, signature[band * self.rows:(band + 1) * self.rows]) for band in range(self.bands)]
+
+    def fingerprint(self, text):
+        # (shingle hashes, minhash signature, exact key), None for pages too short to tell apart
+        if not self.enabled or len(page_words(text)) < self.min_words:
+            return None
+        hashes = array("Q", sorted({stable_hash(shingle) for shingle in shingles(text)}))
+        return hashes, self.hasher.signature(hashes), exact_key(text)
+
+    def find(self, fingerprint):
+        # (the most similar indexed page at or above the threshold, its similarity), or (None, 0)
+        hashes, signature, key = fingerprint
+        entry_id = self._exact.get(key)
+        if entry_id is not None:
+            return self._entries[entry_id], 1.0
+        candidates = set()
+        for key in self.band_keys(signature):
+            candidates.update(self._buckets.get(key, ()))
+        best, best_similarity = None, 0.0
+        for entry_id in candidates:
+            entry = self._entries[entry_id]
+            similarity = jaccard(hashes, entry["hashes"])
+            if similarity >= self.threshold and similarity > best_similarity:
+                best, best_similarity = entry, similarity
+        return best, best_similarity
+
+    def lookup(self, text, document_id=None):
+        # -> {"corrected": reusable corrected text or None, "boilerplate": bool} for a near-duplicate page, or None
+        fingerprint = self.fingerprint(text)
+        if fingerprint is None:
+            return None
+        with self._lock:
+            entry, _ = self.find(fingerprint)
+            if entry is None:
+                return None
+            self._entries.move_to_end(entry["id"])
+            if document_id is not None and len(entry["documents"]) < self.boilerplate_documents:
+                entry["documents"].add(document_id)
+            return {
+                "corrected": entry["corrected"] if entry["exact_key"] == fingerprint[2] else None,
+                "boilerplate": len(entry["documents"]) >= self.boilerplate_documents,
+            }
+
+    def add(self, text, corrected, document_id=None):
+        # corrected is the LLM's correction of text, or None for a page that wasn't (or couldn't be) corrected:
+        # it is still indexed so repeats of it are recognised as boilerplate, but nothing is reused from it
+        fingerprint = self.fingerprint(text)
+        if fingerprint is None:
+            return
+        if corrected == text:
+            # a failed correction hands back the OCR text unchanged, it is no correction to reuse
+            corrected = None
+        with self._lock:
+            entry, _ = self.find(fingerprint)
+            if entry is not None and entry["exact_key"] == fingerprint[2]:
+                if entry["corrected"] is None:
+                    entry["corrected"] = corrected
+                return
+            if entry is not None and corrected is None:
+                # the near-duplicate entry already counts this page's documents
+                return
+            entry_id = self._next_id
+            self._next_id += 1
+            keys = self.band_keys(fingerprint[1])
+            documents = set(entry["documents"]) if entry is not None else set()
+            if document_id is not None:
+                documents.add(document_id)
+            self._entries[entry_id] = {
+                "id": entry_id,
+                "hashes": fingerprint[0],
+                "exact_key": fingerprint[2],
+                "corrected": corrected,
+                "documents": documents,
+                "keys": keys,
+            }
+            self._exact[fingerprint[2]] = entry_id
+            for key in keys:
+                self._buckets.setdefault(key, set()).add(entry_id)
+            while len(self._entries) > self.max_entries:
+                _, evicted = self._entries.popitem(last=False)
+                if self._exact.get(evicted["exact_key"]) == evicted["id"]:
+                    del self._exact[evicted["exact_key"]]
+                for key in evicted["keys"]:
+                    bucket = self._buckets.get(key)
+                    if bucket is not None:
+                        bucket.discard(evicted["id"])
+                        if not bucket:
+                            del self._buckets[key]
+
+    def count_match(self, page_content, match):
+        # a reused page saves its correction request: the page going in and the corrected text coming back
+        with self._lock:
+            if match["corrected"] is not None:
+                self.pages_reused += 1
+                self.tokens_saved += estimate_tokens(page_content or "") + estimate_tokens(match["corrected"])
+            self.boilerplate_pages += 1 if match["boilerplate"] else 0
+
+    def split_reusable(self, pages, document_id=None):
+        # -> (pages that still need correcting, [{page_index: reused corrected text}], {boilerplate page indexes})
+        pages_to_correct = []
+        reused_pages = []
+        boilerplate = set()
+        for page in pages:
+            page_index, page_content = next(iter(page.items()))
+            match = self.lookup(page_content, document_id)
+            if match is None:
+                pages_to_correct.append(page)
+                continue
+            self.count_match(page_content, match)
+            if match["boilerplate"]:
+                boilerplate.add(page_index)
+            if match["corrected"] is None:
+                pages_to_correct.append(page)
+            else:
+                reused_pages.append({page_index: match["corrected"]})
+        return pages_to_correct, reused_pages, boilerplate
+
+    def remember(self, pages, corrected_pages, document_id=None):
+        # corrected_pages: the LLM corrections of some of pages. the others (skipped or failed) are indexed
+        # without a correction
+        corrected_by_index = {}
+        for page in corrected_pages:
+            corrected_by_index.update(page)
+        for page in pages:
+            page_index, page_content = next(iter(page.items()))
+            self.add(page_content, corrected_by_index.get(page_index), document_id)
+
+    def reusing(self, correct_page, document_id=None):
+        # wraps correct_page(text) for the page-at-a-time (streaming) path
+        def correct_or_reuse(page_content):
+            match = self.lookup(page_content, document_id)
+            if match is not None:
+                self.count_match(page_content, match)
+                if match["corrected"] is not None:
+                    return match["corrected"]
+            corrected = correct_page(page_content)
+            self.add(page_content, corrected, document_id)
+            return corrected
+        return correct_or_reuse
+
+    def order_for_extraction(self, pages, boilerplate, skip=False):
+        # boilerplate pages go after the document's own pages, so a value found there only wins when nothing else has it.
+        # with skip they are left out, unless the document has nothing else.
+        own_pages = [page for page in pages if next(iter(page)) not in boilerplate]
+        boilerplate_pages = [page for page in pages if next(iter(page)) in boilerplate]
+        if skip and own_pages:
+            saved = sum(estimate_tokens(next(iter(page.values())) or "") for page in boilerplate_pages)
+            with self._lock:
+                self.extraction_tokens_saved += saved
+            return own_pages
+        return own_pages + boilerplate_pages
+
+    def stats(self):
+        with self._lock:
+            return {
+                "indexed_pages": len(self._entries),
+                "pages_reused": self.pages_reused,
+                "boilerplate_pages": self.boilerplate_pages,
+                "estimated_tokens_saved": self.tokens_saved + self.extraction_tokens_saved,
+            }
+
+    def stats_since(self, earlier):
+        # what one batch saved, from stats() taken before it started
+        current = self.stats()
+        return {
+            key: value if key == "indexed_pages" else value - earlier.get(key, 0) for key, value in current.items()
+        }
+
+
+def page_index_from_env():
+    # one index per process: with BATCH_MODE=process every worker process builds its own
+    return PageIndex(
+        threshold=float(os.getenv("PAGE_DEDUP_THRESHOLD", "0.9")),
+        max_entries=int(os.getenv("PAGE_DEDUP_MAX_PAGES", "20000")),
+        boilerplate_documents=int(os.getenv("PAGE_DEDUP_BOILERPLATE_DOCUMENTS", "3")),
+        enabled=os.getenv("PAGE_DEDUP", "1") == "1",
+    )
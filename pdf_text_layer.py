@@ -0,0 +1,134 @@
+import os
+import re
+import string
+import asyncio
+from metrics import count_pages
+
+# pypdf is optional: without it (or for anything that isn't a PDF) every page goes to Azure OCR as before
+try:
+    import pypdf
+except ImportError:
+    pypdf = None
+
+# characters expected in real text, a text layer with many others is usually a broken font encoding
+TEXT_CHARACTERS = set(string.ascii_letters + string.digits + string.punctuation + string.whitespace + "§°½¼¾’‘“”–—•")
+# pypdf's placeholder for glyphs it couldn't map to a character
+UNMAPPED_GLYPH = re.compile(r"\(cid:\d+\)")
+
+
+def parse_page_range(pages, page_count):
+    # "1-3" or "1,4-5" -> [1, 2, 3] / [1, 4, 5], limited to the pages the document has. None means every page.
+    if not pages:
+        return list(range(1, page_count + 1))
+    numbers = set()
+    for part in str(pages).split(","):
+        part = part.strip()
+        if not part:
+            continue
+        first, _, last = part.partition("-")
+        first = int(first)
+        last = int(last) if last else first
+        numbers.update(range(first, min(last, page_count) + 1))
+    return sorted(number for number in numbers if 1 <= number <= page_count)
+
+
+def format_page_range(numbers):
+    # [1, 2, 3, 5] -> "1-3,5", the format Azure's `pages` option takes
+    parts = []
+    start = previous = None
+    for number in sorted(numbers):
+        if previous is not None and number == previous + 1:
+            previous = number
+            continue
+        if start is not None:
+            parts.append(f"{start}-{previous}" if previous != start else str(start))
+        start = previous = number
+    if start is not None:
+        parts.append(f"{start}-{previous}" if previous != start else str(start))
+    return ",".join(parts)
+
+
+def is_clean_text(text, min_chars=100, min_text_ratio=0.9):
+    # enough text to be a real page, and mostly characters that belong in text
+    if len(text) < min_chars or UNMAPPED_GLYPH.search(text):
+        return False
+    text_characters = sum(1 for character in text if character in TEXT_CHARACTERS)
+    letters = sum(1 for character in text if character.isalpha())
+    return text_characters / len(text) >= min_text_ratio and letters / len(text) >= 0.3
+
+
+def read_text_layer(document_path, pages=None, min_chars=100):
+    # returns ({page_number: text} for pages with a clean embedded text layer, [page numbers that need OCR]),
+    # or None when the file can't be read locally
+    if pypdf is None or not document_path.lower().endswith(".pdf"):
+        return None
+    try:
+        # given a path, PdfReader copies the whole file into memory first. given an open file it reads
+        # only what it needs, so every page has to be read before the file is closed
+        with open(document_path, "rb") as f:
+            reader = pypdf.PdfReader(f)
+            if reader.is_encrypted:
+                return None
+            page_numbers = parse_page_range(pages, len(reader.pages))
+            text_pages = {}
+            ocr_page_numbers = []
+            for page_number in page_numbers:
+                raw_text = reader.pages[page_number - 1].extract_text() or ""
+                # same shape as the OCR content: the lines of the page joined with single spaces
+                text = " ".join(line.strip() for line in raw_text.splitlines() if line.strip())
+                if is_clean_text(text, min_chars):
+                    text_pages[page_number] = text
+                else:
+                    ocr_page_numbers.append(page_number)
+            return text_pages, ocr_page_numbers
+    except Exception as e:
+        print(f"Could not read the text layer of {document_path}, using OCR: {e}")
+        return None
+
+
+def text_layer_page(page_number, text):
+    # text from the PDF itself is exact, the full confidence keeps it out of LLM correction
+    return {
+        "page_index": str(page_number - 1),
+        "content": text,
+        "confidence": 1.0,
+        "min_confidence": 1.0,
+        "word_count": len(text.split()),
+        "source": "text_layer",
+    }
+
+
+def details_with_text_layer(document_path, pages, run_ocr, min_chars=100):
+    # run_ocr(document_path, pages) is the regular (cached) Azure OCR call returning document details.
+    # pages with a clean text layer are read locally, only the others are sent to OCR.
+    text_layer = read_text_layer(document_path, pages, min_chars)
+    if text_layer is None or not text_layer[0]:
+        return run_ocr(document_path, pages)
+    text_pages, ocr_page_numbers = text_layer
+    document_details = {"pages": [], "key_value_pairs": []}
+    if ocr_page_numbers:
+        document_details = run_ocr(document_path, format_page_range(ocr_page_numbers))
+    return with_text_layer_pages(document_path, document_details, text_pages, ocr_page_numbers)
+
+
+async def details_with_text_layer_async(document_path, pages, run_ocr, min_chars=100):
+    # details_with_text_layer() for an async run_ocr, pypdf runs in a thread so the event loop isn't blocked
+    text_layer = await asyncio.to_thread(read_text_layer, document_path, pages, min_chars)
+    if text_layer is None or not text_layer[0]:
+        return await run_ocr(document_path, pages)
+    text_pages, ocr_page_numbers = text_layer
+    document_details = {"pages": [], "key_value_pairs": []}
+    if ocr_page_numbers:
+        document_details = await run_ocr(document_path, format_page_range(ocr_page_numbers))
+    return with_text_layer_pages(document_path, document_details, text_pages, ocr_page_numbers)
+
+
+def with_text_layer_pages(document_path, document_details, text_pages, ocr_page_numbers):
+    count_pages("text_layer", len(text_pages))
+    print(f"Read {len(text_pages)} pages of {os.path.basename(document_path)} from the PDF text layer, "
+          f"{len(ocr_page_numbers)} pages need OCR")
+    document_pages = document_details["pages"] + [
+        text_layer_page(page_number, text) for page_number, text in text_pages.items()
+    ]
+    document_pages.sort(key=lambda page: int(page["page_index"]))
+    return {"pages": document_pages, "key_value_pairs": document_details.get("key_value_pairs", [])}
@@ -0,0 +1,23 @@
+import textwrap
+from functools import lru_cache
+
+# providers cache the longest prompt prefix they have seen recently (OpenAI / Azure OpenAI: from 1024 tokens on),
+# so every extraction prompt is laid out as
+#   [static instructions][field list][document text]
+# the instructions are identical for every request and the field list for every document of the same type,
+# only the part after them changes from one document (or window) to the next.
+DOCUMENT_INTRO = "Here is the full text of the document:"
+
+
+@lru_cache(maxsize=256)
+def prompt_prefix(instructions, fields, field_separator="\n"):
+    # fields is a tuple so the prefix can be cached, the result must not depend on anything but its arguments
+    fields_text = field_separator.join(fields)
+    return f"{textwrap.dedent(instructions).strip()}\n\n<fields_to_extract>\n{fields_text}\n</fields_to_extract>\n\n"
+
+
+def build_extraction_prompt(instructions, fields, content, field_separator="\n"):
+    return (
+        prompt_prefix(instructions, tuple(fields), field_separator)
+        + f"{DOCUMENT_INTRO}\n<document_text>\n{content}\n</document_text>\n"
+    )
@@ -0,0 +1,268 @@
+import os
+import time
+import random
+import asyncio
+import threading
+import contextvars
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+import openai
+from ocr_correction import estimate_tokens
+from metrics import LLM_RETRIES, observe_llm_request
+
+PRIORITY_INTERACTIVE = "interactive"
+PRIORITY_BATCH = "batch"
+
+# requests made while handling /process or /upload run as interactive, everything else (jobs, batch runs) as batch.
+# worker pools copy the context into their threads so the pages of one request keep its priority.
+request_priority = contextvars.ContextVar("request_priority", default=PRIORITY_BATCH)
+
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+
+@contextmanager
+def priority(level):
+    token = request_priority.set(level)
+    try:
+        yield
+    finally:
+        request_priority.reset(token)
+
+
+class TokenBucket:
+    # refills at rate_per_minute and holds at most one minute worth, a rate of 0 never throttles
+    def __init__(self, rate_per_minute, clock=time.monotonic):
+        self.rate_per_minute = rate_per_minute
+        self.capacity = float(rate_per_minute)
+        self.level = float(rate_per_minute)
+        self.clock = clock
+        self.updated_at = clock()
+
+    def _refill(self, now):
+        elapsed = max(0.0, now - self.updated_at)
+        self.level = min(self.capacity, self.level + elapsed * self.rate_per_minute / 60.0)
+        self.updated_at = now
+
+    def wait_time(self, amount, now):
+        if not self.rate_per_minute:
+            return 0.0
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) * 60.0 / self.rate_per_minute
+
+    def take(self, amount, now):
+        if not self.rate_per_minute:
+            return
+        self._refill(now)
+        self.level -= min(amount, self.capacity)
+
+    def give_back(self, amount):
+        # a negative amount charges tokens that were used beyond the estimate, the bucket may go into debt
+        if not self.rate_per_minute:
+            return
+        self.level = min(self.capacity, self.level + amount)
+
+
+class RateLimiter:
+    # throttles chat completions against the deployment's requests-per-minute and tokens-per-minute quotas.
+    # each request reserves its estimated prompt + completion tokens up front, the reservation is corrected
+    # with the usage the API reports. interactive requests go ahead of batch requests that are waiting.
+    def __init__(self, requests_per_minute=0, tokens_per_minute=0, max_retries=5, backoff_base=1.0,
+                 backoff_max=60.0, clock=time.monotonic, sleep=time.sleep):
+        self.requests = TokenBucket(requests_per_minute, clock)
+        self.tokens = TokenBucket(tokens_per_minute, clock)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.clock = clock
+        self.sleep = sleep
+        self.paused_until = 0.0
+        self.interactive_waiting = 0
+        self.request_count = 0
+        self.retry_count = 0
+        self.rate_limited_count = 0
+        self.throttled_seconds = 0.0
+        self._condition = threading.Condition()
+
+    def acquire(self, estimated_tokens, level=None):
+        level = level or request_priority.get()
+        interactive = level == PRIORITY_INTERACTIVE
+        started_at = self.clock()
+        with self._condition:
+            if interactive:
+                self.interactive_waiting += 1
+            try:
+                while True:
+                    wait = self._reserve(estimated_tokens, interactive, started_at)
+                    if wait <= 0:
+                        return
+                    self._condition.wait(timeout=wait)
+            finally:
+                if interactive:
+                    self.interactive_waiting -= 1
+                    self._condition.notify_all()
+
+    async def acquire_async(self, estimated_tokens, level=None):
+        # acquire() for coroutines: shares the buckets with the threads, but waits with asyncio.sleep
+        # so the event loop keeps running the other requests
+        level = level or request_priority.get()
+        interactive = level == PRIORITY_INTERACTIVE
+        started_at = self.clock()
+        with self._condition:
+            if interactive:
+                self.interactive_waiting += 1
+        try:
+            while True:
+                with self._condition:
+                    wait = self._reserve(estimated_tokens, interactive, started_at)
+                if wait <= 0:
+                    return
+                await asyncio.sleep(wait)
+        finally:
+            if interactive:
+                with self._condition:
+                    self.interactive_waiting -= 1
+                    self._condition.notify_all()
+
+    def _reserve(self, estimated_tokens, interactive, started_at):
+        # takes the capacity for one request and returns 0, or returns how long to wait before trying again.
+        # called with self._condition held
+        now = self.clock()
+        wait = self.paused_until - now
+        if wait > 0:
+            return wait
+        if not interactive and self.interactive_waiting:
+            # let the waiting interactive requests take the next free capacity
+            return 0.05
+        wait = max(self.requests.wait_time(1, now), self.tokens.wait_time(estimated_tokens, now))
+        if wait > 0:
+            return wait
+        self.requests.take(1, now)
+        self.tokens.take(estimated_tokens, now)
+        self.request_count += 1
+        self.throttled_seconds += now - started_at
+        return 0.0
+
+    def record_usage(self, estimated_tokens, used_tokens):
+        if used_tokens is None:
+            return
+        with self._condition:
+            self.tokens.give_back(estimated_tokens - used_tokens)
+            self._condition.notify_all()
+
+    def pause(self, seconds):
+        # a 429 applies to the whole deployment, so every request waits out the Retry-After, not just the one that got it
+        with self._condition:
+            self.paused_until = max(self.paused_until, self.clock() + seconds)
+            self.rate_limited_count += 1
+
+    def backoff_delay(self, attempt, retry_after=None):
+        if retry_after is not None:
+            return retry_after + random.uniform(0, self.backoff_base)
+        # full jitter so the workers that failed together don't all come back at the same moment
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def call(self, send, estimated_tokens):
+        # send() makes the request and returns the completion, retryable errors are retried with backoff
+        # and the last error is raised once max_retries is used up
+        for attempt in range(self.max_retries + 1):
+            self.acquire(estimated_tokens)
+            sent_at = time.perf_counter()
+            try:
+                response = send()
+            except Exception as e:
+                self.sleep(self._retry_delay(e, attempt, estimated_tokens))
+                continue
+            return self._received(response, estimated_tokens, sent_at)
+
+    async def call_async(self, send, estimated_tokens):
+        # call() for an async client: send() returns the awaitable completion
+        for attempt in range(self.max_retries + 1):
+            await self.acquire_async(estimated_tokens)
+            sent_at = time.perf_counter()
+            try:
+                response = await send()
+            except Exception as e:
+                await asyncio.sleep(self._retry_delay(e, attempt, estimated_tokens))
+                continue
+            return self._received(response, estimated_tokens, sent_at)
+
+    def _retry_delay(self, error, attempt, estimated_tokens):
+        # seconds to wait before retrying a failed request, raises the error when it isn't retried
+        # the request didn't go through, hand back its reservation
+        self.record_usage(estimated_tokens, 0)
+        if attempt >= self.max_retries or not is_retryable(error):
+            raise error
+        retry_after = retry_after_seconds(error)
+        if getattr(error, "status_code", None) == 429:
+            self.pause(retry_after if retry_after is not None else self.backoff_delay(attempt))
+        delay = self.backoff_delay(attempt, retry_after)
+        with self._condition:
+            self.retry_count += 1
+        LLM_RETRIES.inc(reason="rate_limited" if getattr(error, "status_code", None) == 429 else "error")
+        print(f"OpenAI request failed ({error.__class__.__name__}), retrying in {delay:.1f}s "
+              f"(attempt {attempt + 1} of {self.max_retries})")
+        return delay
+
+    def _received(self, response, estimated_tokens, sent_at):
+        observe_llm_request(response, time.perf_counter() - sent_at)
+        usage = getattr(response, "usage", None)
+        self.record_usage(estimated_tokens, getattr(usage, "total_tokens", None))
+        return response
+
+    def stats(self):
+        with self._condition:
+            return {
+                "requests": self.request_count,
+                "retries": self.retry_count,
+                "rate_limited": self.rate_limited_count,
+                "throttled_seconds": round(self.throttled_seconds, 3),
+                "interactive_waiting": self.interactive_waiting,
+            }
+
+
+def estimate_request_tokens(messages, max_tokens):
+    # the prompt estimate plus the completion limit, a few tokens of overhead per message
+    return sum(estimate_tokens(message["content"]) + 4 for message in messages) + max_tokens
+
+
+def is_retryable(error):
+    if isinstance(error, (openai.APIConnectionError, openai.APITimeoutError)):
+        return True
+    return getattr(error, "status_code", None) in RETRYABLE_STATUS_CODES
+
+
+def retry_after_seconds(error):
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms:
+        try:
+            return float(retry_after_ms) / 1000.0
+        except ValueError:
+            pass
+    retry_after = headers.get("retry-after")
+    if not retry_after:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def rate_limiter_from_env():
+    return RateLimiter(
+        requests_per_minute=int(os.getenv("OPENAI_RPM", "0")),
+        tokens_per_minute=int(os.getenv("OPENAI_TPM", "0")),
+        max_retries=int(os.getenv("OPENAI_MAX_RETRIES", "5")),
+        backoff_base=float(os.getenv("OPENAI_BACKOFF_BASE", "1")),
+        backoff_max=float(os.getenv("OPENAI_BACKOFF_MAX", "60")),
+    )
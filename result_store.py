@@ -0,0 +1,257 @@
+import os
+import csv
+import json
+import time
+import sqlite3
+import argparse
+import threading
+from disk_cache import file_sha256
+from csv_sink import read_columns
+
+# pyarrow is optional, it is only needed for export_parquet
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# the columns every row has, the same leading fields as metadata.csv
+OFFICE_FIELD = "office name"
+DOCUMENT_TYPE_FIELD = "document type"
+FILENAME_FIELD = "filename"
+LEADING_FIELDS = [OFFICE_FIELD, DOCUMENT_TYPE_FIELD, FILENAME_FIELD]
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS results (
+        id INTEGER PRIMARY KEY,
+        office_name TEXT,
+        document_type TEXT,
+        filename TEXT,
+        fields TEXT NOT NULL,
+        created_at REAL NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS results_filename ON results (filename)",
+    "CREATE INDEX IF NOT EXISTS results_office ON results (office_name, document_type)",
+    "CREATE INDEX IF NOT EXISTS results_document_type ON results (document_type)",
+    # CSV files already imported, so running the import twice doesn't duplicate rows
+    "CREATE TABLE IF NOT EXISTS imports (source TEXT PRIMARY KEY, sha256 TEXT, rows INTEGER, imported_at REAL)",
+]
+
+
+class SQLiteResultStore:
+    # the extracted fields of each document in an indexed SQLite database, as an alternative (or addition)
+    # to metadata.csv. write_row / close take the same arguments as AppendOnlyCSVWriter.
+    # the office, document type and filename get their own indexed columns, the other fields are kept as JSON.
+    # WAL mode lets other processes query the database while a batch is writing to it.
+    # there is one row per document: a row for an office, document type and filename already in the store
+    # replaces the earlier one, e.g. when a changed file is processed again.
+    def __init__(self, db_path, commit_every=1):
+        self.db_path = db_path
+        self.commit_every = max(1, commit_every)
+        self.rows_written = 0
+        self._uncommitted = 0
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connection = sqlite3.connect(db_path, check_same_thread=False)
+        self._connection.row_factory = sqlite3.Row
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        with self._connection:
+            for statement in SCHEMA:
+                self._connection.execute(statement)
+
+    def write_row(self, row_data):
+        with self._lock:
+            self._insert(row_data)
+            self.rows_written += 1
+            self._uncommitted += 1
+            if self._uncommitted >= self.commit_every:
+                self._connection.commit()
+                self._uncommitted = 0
+
+    def _insert(self, row_data, created_at=None):
+        fields = {field: value for field, value in row_data.items() if field not in LEADING_FIELDS}
+        office_name = row_data.get(OFFICE_FIELD)
+        document_type = row_data.get(DOCUMENT_TYPE_FIELD)
+        filename = row_data.get(FILENAME_FIELD)
+        self._connection.execute(
+            "DELETE FROM results WHERE filename IS ? AND office_name IS ? AND document_type IS ?",
+            (filename, office_name, document_type),
+        )
+        self._connection.execute(
+            "INSERT INTO results (office_name, document_type, filename, fields, created_at) VALUES (?, ?, ?, ?, ?)",
+            (office_name, document_type, filename, json.dumps(fields), created_at or time.time()),
+        )
+
+    def query(self, where="", parameters=(), limit=None):
+        # rows in the same shape as they were written, newest first
+        sql = f"SELECT * FROM results {where} ORDER BY id DESC"
+        if limit:
+            sql += f" LIMIT {int(limit)}"
+        with self._lock:
+            rows = self._connection.execute(sql, parameters).fetchall()
+        return [row_from_record(record) for record in rows]
+
+    def by_filename(self, filename, limit=None):
+        return self.query("WHERE filename = ?", (filename,), limit)
+
+    def by_office(self, office_name, document_type=None, limit=None):
+        if document_type is None:
+            return self.query("WHERE office_name = ?", (office_name,), limit)
+        return self.query("WHERE office_name = ? AND document_type = ?", (office_name, document_type), limit)
+
+    def by_document_type(self, document_type, limit=None):
+        return self.query("WHERE document_type = ?", (document_type,), limit)
+
+    def counts(self):
+        # {(office, document type): rows}
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT office_name, document_type, COUNT(*) FROM results GROUP BY office_name, document_type"
+            ).fetchall()
+        return {(office_name, document_type): count for office_name, document_type, count in rows}
+
+    def import_csv(self, csv_file_path, force=False):
+        # one-shot import of an existing metadata.csv, including fields only listed in its columns sidecar.
+        # returns the number of rows imported, 0 when this exact file was imported before.
+        source = os.path.abspath(csv_file_path)
+        content_hash = file_sha256(csv_file_path)
+        with self._lock:
+            previous = self._connection.execute("SELECT sha256 FROM imports WHERE source = ?", (source,)).fetchone()
+        if previous is not None and previous[0] == content_hash and not force:
+            print(f"{csv_file_path} was already imported")
+            return 0
+
+        columns = read_columns(csv_file_path)
+        imported_at = time.time()
+        rows = 0
+        with self._lock, self._connection:
+            with open(csv_file_path, "r", newline="") as f:
+                reader = csv.reader(f)
+                next(reader, None)
+                for values in reader:
+                    if not any(values):
+                        continue
+                    self._insert({field: value for field, value in zip(columns, values) if value != ""}, imported_at)
+                    rows += 1
+            self._connection.execute(
+                "INSERT OR REPLACE INTO imports (source, sha256, rows, imported_at) VALUES (?, ?, ?, ?)",
+                (source, content_hash, rows, imported_at),
+            )
+        return rows
+
+    def export_parquet(self, parquet_path, office_name=None, document_type=None, batch_size=10000):
+        # one column per field, every value as a string. two passes over the rows: the first collects the columns,
+        # the second writes them batch_size rows at a time so large result sets aren't held in memory.
+        if pyarrow is None:
+            raise RuntimeError("Parquet export needs the optional pyarrow package (pip install pyarrow)")
+        conditions, parameters = [], []
+        if office_name is not None:
+            conditions.append("office_name = ?")
+            parameters.append(office_name)
+        if document_type is not None:
+            conditions.append("document_type = ?")
+            parameters.append(document_type)
+        where = ("WHERE " + " AND ".join(conditions)) if conditions else ""
+
+        with self._lock:
+            self._connection.commit()
+            connection = sqlite3.connect(self.db_path)
+        connection.row_factory = sqlite3.Row
+        try:
+            # a dict keeps the columns in the order they first show up
+            columns = dict.fromkeys(LEADING_FIELDS)
+            for (fields,) in connection.execute(f"SELECT fields FROM results {where}", parameters):
+                columns.update(dict.fromkeys(json.loads(fields)))
+            schema = pyarrow.schema([(column, pyarrow.string()) for column in columns])
+
+            rows = 0
+            with pyarrow.parquet.ParquetWriter(parquet_path, schema) as writer:
+                cursor = connection.execute(f"SELECT * FROM results {where} ORDER BY id", parameters)
+                while True:
+                    records = cursor.fetchmany(batch_size)
+                    if not records:
+                        break
+                    batch = []
+                    for record in records:
+                        row = row_from_record(record)
+                        batch.append({column: parquet_value(row.get(column)) for column in columns})
+                    writer.write_table(pyarrow.Table.from_pylist(batch, schema=schema))
+                    rows += len(batch)
+            return rows
+        finally:
+            connection.close()
+
+    def close(self, compact=True):
+        # compact is accepted for AppendOnlyCSVWriter compatibility, there is nothing to rewrite
+        with self._lock:
+            self._connection.commit()
+            self._connection.close()
+
+
+def row_from_record(record):
+    row = {
+        OFFICE_FIELD: record["office_name"],
+        DOCUMENT_TYPE_FIELD: record["document_type"],
+        FILENAME_FIELD: record["filename"],
+    }
+    row.update(json.loads(record["fields"]))
+    return row
+
+
+def parquet_value(value):
+    if value is None or isinstance(value, str):
+        return value
+    return json.dumps(value) if isinstance(value, (dict, list)) else str(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import, query and export the SQLite result store")
+    parser.add_argument("--db", default=os.getenv("RESULT_DB_PATH", "metadata.sqlite"), help="SQLite database path")
+    commands = parser.add_subparsers(dest="command", required=True)
+    import_command = commands.add_parser("import-csv", help="import existing metadata CSV files")
+    import_command.add_argument("csv_files", nargs="+")
+    import_command.add_argument("--force", action="store_true", help="import files that were imported before again")
+    export_command = commands.add_parser("export-parquet", help="write the results to a Parquet file")
+    export_command.add_argument("parquet_path")
+    export_command.add_argument("--office")
+    export_command.add_argument("--document-type")
+    query_command = commands.add_parser("query", help="print matching rows as JSON lines")
+    query_command.add_argument("--filename")
+    query_command.add_argument("--office")
+    query_command.add_argument("--document-type")
+    query_command.add_argument("--limit", type=int)
+    commands.add_parser("counts", help="rows per office and document type")
+    args = parser.parse_args()
+
+    store = SQLiteResultStore(args.db)
+    try:
+        if args.command == "import-csv":
+            for csv_file_path in args.csv_files:
+                print(f"Imported {store.import_csv(csv_file_path, args.force)} rows from {csv_file_path}")
+        elif args.command == "export-parquet":
+            rows = store.export_parquet(args.parquet_path, args.office, args.document_type)
+            print(f"Wrote {rows} rows to {args.parquet_path}")
+        elif args.command == "query":
+            if args.filename:
+                rows = store.by_filename(args.filename, args.limit)
+            elif args.office:
+                rows = store.by_office(args.office, args.document_type, args.limit)
+            elif args.document_type:
+                rows = store.by_document_type(args.document_type, args.limit)
+            else:
+                rows = store.query(limit=args.limit)
+            for row in rows:
+                print(json.dumps(row))
+        else:
+            for (office_name, document_type), count in sorted(store.counts().items(), key=str):
+                print(f"{office_name}\t{document_type}\t{count}")
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+import time
+import queue
+import threading
+from metrics import QUEUE_DEPTH, QUEUE_SECONDS, BUSY_WORKERS, STAGE_SECONDS, count_document, current_document_type
+
+SINK_STAGE = "sink"
+# tells a worker that nothing more is coming
+DONE = object()
+
+
+class Stage:
+    # one step of the pipeline: function(value) returns the value handed to the next stage.
+    # a value that is a dict with an "error" key skips the remaining stages and goes straight to the sink.
+    def __init__(self, name, function, workers=1):
+        self.name = name
+        self.function = function
+        self.workers = max(1, workers)
+
+
+class StageQueue:
+    # bounded queue in front of a stage, keeps its depth gauge and the time documents wait in it
+    def __init__(self, stage_name, maxsize):
+        self.stage_name = stage_name
+        self.stats = {"documents": 0, "queue_seconds": 0.0, "max_depth": 0}
+        self._queue = queue.Queue(maxsize=max(1, maxsize))
+        self._lock = threading.Lock()
+
+    def put(self, job):
+        # blocks while the stage is behind, which holds back the stages in front of it
+        self._queue.put((time.perf_counter(), job))
+        if job is not DONE:
+            depth = self._queue.qsize()
+            QUEUE_DEPTH.set(depth, stage=self.stage_name)
+            with self._lock:
+                self.stats["max_depth"] = max(self.stats["max_depth"], depth)
+
+    def get(self):
+        queued_at, job = self._queue.get()
+        if job is not DONE:
+            waited = time.perf_counter() - queued_at
+            QUEUE_DEPTH.set(self._queue.qsize(), stage=self.stage_name)
+            QUEUE_SECONDS.observe(waited, stage=self.stage_name)
+            with self._lock:
+                self.stats["documents"] += 1
+                self.stats["queue_seconds"] += waited
+        return job
+
+
+def is_error(value):
+    return isinstance(value, dict) and "error" in value
+
+
+def run_pipeline(items, stages, write_result, queue_size=8, context_for=None):
+    # every stage has its own workers and a bounded queue in front of it, so OCR of the next documents
+    # runs while earlier ones are corrected and extracted. write_result(index, item, result) is the sink:
+    # it runs on the calling thread, in the original item order, like run_batch's.
+    # context_for(item) returns the contextvars.Context the item's stages run in (metrics labels, priority).
+    # returns the same summary as run_batch plus per-stage numbers under "stages".
+    started_at = time.time()
+    summary = {"total": len(items), "succeeded": 0, "failed": []}
+    queues = [StageQueue(stage.name, queue_size) for stage in stages]
+    results = StageQueue(SINK_STAGE, queue_size)
+    busy_seconds = {stage.name: 0.0 for stage in stages}
+    busy_seconds[SINK_STAGE] = 0.0
+    running_workers = [stage.workers for stage in stages]
+    lock = threading.Lock()
+
+    def feed():
+        for index, item in enumerate(items):
+            context = context_for(item) if context_for else None
+            job = {"index": index, "item": item, "value": item, "context": context, "started_at": time.perf_counter()}
+            queues[0].put(job)
+        for _ in range(stages[0].workers):
+            queues[0].put(DONE)
+
+    def work(stage_number):
+        stage = stages[stage_number]
+        next_queue = queues[stage_number + 1] if stage_number + 1 < len(stages) else results
+        while True:
+            job = queues[stage_number].get()
+            if job is DONE:
+                break
+            if not is_error(job["value"]):
+                BUSY_WORKERS.inc(1, stage=stage.name)
+                stage_started_at = time.perf_counter()
+                try:
+                    if job["context"] is not None:
+                        job["value"] = job["context"].run(stage.function, job["value"])
+                    else:
+                        job["value"] = stage.function(job["value"])
+                except Exception as e:
+                    job["value"] = {"error": str(e)}
+                finally:
+                    BUSY_WORKERS.inc(-1, stage=stage.name)
+                    with lock:
+                        busy_seconds[stage.name] += time.perf_counter() - stage_started_at
+            next_queue.put(job)
+        # the last worker of a stage to finish tells every worker of the next one
+        with lock:
+            running_workers[stage_number] -= 1
+            last = running_workers[stage_number] == 0
+        if last:
+            for _ in range(stages[stage_number + 1].workers if next_queue is not results else 1):
+                next_queue.put(DONE)
+
+    threads = [threading.Thread(target=feed, name="pipeline-feed", daemon=True)]
+    for stage_number, stage in enumerate(stages):
+        threads += [
+            threading.Thread(target=work, args=(stage_number,), name=f"pipeline-{stage.name}-{worker}", daemon=True)
+            for worker in range(stage.workers)
+        ]
+    for thread in threads:
+        thread.start()
+
+    finished = {}
+    next_to_write = 0
+    while True:
+        job = results.get()
+        if job is DONE:
+            break
+        finished[job["index"]] = job
+        while next_to_write in finished:
+            job = finished.pop(next_to_write)
+            item, result = job["item"], job["value"]
+            if job["context"] is not None:
+                job["context"].run(finish_document, result, time.perf_counter() - job["started_at"])
+            if is_error(result):
+                print(f"Failed to process {item}: {result['error']}")
+                summary["failed"].append({"file": item, "error": result["error"]})
+            else:
+                summary["succeeded"] += 1
+            sink_started_at = time.perf_counter()
+            try:
+                write_result(next_to_write, item, result)
+            except Exception as e:
+                print(f"Error writing result for {item}: {e}")
+            busy_seconds[SINK_STAGE] += time.perf_counter() - sink_started_at
+            next_to_write += 1
+    for thread in threads:
+        thread.join()
+
+    elapsed = time.time() - started_at
+    summary["elapsed_seconds"] = round(elapsed, 2)
+    summary["documents_per_minute"] = round(summary["total"] / elapsed * 60, 2) if elapsed else 0.0
+    summary["stages"] = []
+    # the sink is the calling thread, a single writer
+    for stage, stage_queue in zip(stages + [Stage(SINK_STAGE, write_result)], queues + [results]):
+        stats = stage_queue.stats
+        summary["stages"].append({
+            "stage": stage.name,
+            "workers": stage.workers,
+            "documents": stats["documents"],
+            "mean_queue_seconds": round(stats["queue_seconds"] / stats["documents"], 3) if stats["documents"] else 0.0,
+            "max_queue_depth": stats["max_depth"],
+            # share of the run the stage's workers were busy, the stage closest to 1 is the bottleneck
+            "utilization": round(busy_seconds[stage.name] / (stage.workers * elapsed), 3) if elapsed else 0.0,
+        })
+    return summary
+
+
+def finish_document(result, seconds):
+    # what track_document records for a document processed in one call
+    STAGE_SECONDS.observe(seconds, stage="document", document_type=current_document_type.get())
+    count_document(result)
+
+
+def print_stage_summary(summary):
+    stages = summary.get("stages")
+    if not stages:
+        return
+    print("Pipeline stages:")
+    for stage in stages:
+        print(
+            f"  {stage['stage']}: {stage['workers']} workers, {stage['documents']} documents, "
+            f"{stage['mean_queue_seconds']}s mean wait in queue, max queue depth {stage['max_queue_depth']}, "
+            f"{stage['utilization'] * 100:.0f}% busy"
+        )
+    bottleneck = max(stages, key=lambda stage: stage["utilization"])
+    print(f"  bottleneck: {bottleneck['stage']}, give it more workers or the others fewer")
@@ -0,0 +1,81 @@
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from ocr_correction import correct_single_page, split_by_confidence, estimate_tokens
+from chunked_extraction import split_text, extract_with_retries, merge_extractions
+
+
+def page_sort_key(page_index):
+    try:
+        return int(page_index)
+    except ValueError:
+        return page_index
+
+
+def iter_corrected_pages(ocr_output, correct_page, max_workers=4, page_confidences=None, confidence_threshold=None):
+    # yields {page_index: text} pages in page order, each one as soon as it and every page before it are corrected.
+    # a page that finishes early waits in `ready`, so the extraction windows built from them are consecutive pages
+    pages_to_correct, skipped_pages = split_by_confidence(ocr_output, page_confidences, confidence_threshold)
+    positions = {id(page): position for position, page in enumerate(ocr_output)}
+    ready = {positions[id(page)]: page for page in skipped_pages}
+    next_position = 0
+    while next_position in ready:
+        yield ready.pop(next_position)
+        next_position += 1
+    if not pages_to_correct:
+        return
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers or 1, len(pages_to_correct)))) as executor:
+        futures = {
+            executor.submit(contextvars.copy_context().run, correct_single_page, page, correct_page): positions[id(page)]
+            for page in pages_to_correct
+        }
+        for future in as_completed(futures):
+            ready[futures[future]] = future.result()
+            while next_position in ready:
+                yield ready.pop(next_position)
+                next_position += 1
+
+
+def iter_windows(corrected_pages, max_tokens):
+    # groups pages into extraction windows as they arrive, a window is handed out as soon as it is full
+    current_window = []
+    current_tokens = 0
+    for page in corrected_pages:
+        page_index, page_content = next(iter(page.items()))
+        for part_number, part in enumerate(split_text(page_content or "", max_tokens)):
+            part_key = page_index if part_number == 0 else f"{page_index}.{part_number}"
+            part_tokens = estimate_tokens(part)
+            if current_window and current_tokens + part_tokens > max_tokens:
+                yield sorted_window(current_window)
+                current_window = []
+                current_tokens = 0
+            current_window.append({part_key: part})
+            current_tokens += part_tokens
+    if current_window:
+        yield sorted_window(current_window)
+
+
+def sorted_window(window):
+    return sorted(window, key=lambda page: [page_sort_key(part) for part in next(iter(page)).split(".")])
+
+
+def iter_window_extractions(corrected_pages, extract_window, max_tokens, max_workers=4, max_attempts=3):
+    # extraction of a window starts while later pages are still being corrected;
+    # yields (window, extraction) pairs as each extraction finishes
+    with ThreadPoolExecutor(max_workers=max(1, max_workers or 1)) as executor:
+        pending = {}
+        for window_number, window in enumerate(iter_windows(corrected_pages, max_tokens)):
+            future = executor.submit(
+                contextvars.copy_context().run, extract_with_retries, extract_window, window, max_attempts, window_number
+            )
+            pending[future] = window
+            for finished_future in [done_future for done_future in pending if done_future.done()]:
+                yield pending.pop(finished_future), finished_future.result()
+        for future in as_completed(pending):
+            yield pending[future], future.result()
+
+
+def extract_streaming(corrected_pages, extract_window, max_tokens, max_workers=4, max_attempts=3):
+    # windows finish in any order, they are merged in page order so the result doesn't depend on timing
+    finished = list(iter_window_extractions(corrected_pages, extract_window, max_tokens, max_workers, max_attempts))
+    finished.sort(key=lambda item: [page_sort_key(part) for part in next(iter(item[0][0])).split(".")])
+    return merge_extractions([extraction for _, extraction in finished])
@@ -0,0 +1,32 @@
+import time
+from batch_runner import run_batch
+
+
+def process_file(file_path):
+    # "hang" stands in for an OCR poll that never returns
+    time.sleep(60 if file_path == "hang" else 0.1)
+    return {"file": file_path}
+
+
+def run(file_paths, mode):
+    written = []
+    summary = run_batch(
+        file_paths, process_file, lambda index, file_path, result: written.append(file_path),
+        max_workers=1, mode=mode, timeout=1,
+    )
+    return summary, written
+
+
+def test_a_hung_process_worker_is_replaced():
+    started_at = time.time()
+    summary, written = run(["a", "hang", "b", "c"], "process")
+    assert time.time() - started_at < 15
+    assert written == ["a", "hang", "b", "c"]
+    assert summary["succeeded"] == 3
+    assert [failure["file"] for failure in summary["failed"]] == ["hang"]
+
+
+def test_files_keep_their_order_and_results():
+    summary, written = run(["a", "b", "c"], "thread")
+    assert written == ["a", "b", "c"]
+    assert summary["succeeded"] == 3 and not summary["failed"]
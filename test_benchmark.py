@@ -0,0 +1,38 @@
+import json
+from benchmark import FakeOpenAIClient
+from ocr_correction import build_batch_prompt
+from prompt_builder import build_extraction_prompt
+from field_schemas import validate_answers
+
+PAGE_TEXT = "GRANT DEED\nAPN: 123-456-789\nthe grantor hereby conveys to grantee"
+
+# the single page correction prompt of each target
+CORRECTION_PROMPTS = {
+    "adm": f"Correct the following OCR text:\n{PAGE_TEXT}",
+    "content": (
+        "You are a helpful assistant that fixes errors in OCR outputs and provides correct data in the same "
+        f"JSON format.:\n{PAGE_TEXT}"
+    ),
+}
+
+
+def test_correction_replies_return_the_ocr_text():
+    client = FakeOpenAIClient(fields=["Seller Name", "APN"], reply_format="lines")
+    for target, prompt in CORRECTION_PROMPTS.items():
+        assert client.reply_for(prompt) == PAGE_TEXT, target
+
+
+def test_batched_correction_replies_return_the_pages():
+    client = FakeOpenAIClient(fields=["Seller Name", "APN"], reply_format="lines")
+    prompt = build_batch_prompt("Correct the following OCR text.", [{"1": PAGE_TEXT}, {"2": "second page"}])
+    reply = client.reply_for(prompt)
+    assert PAGE_TEXT in reply and "second page" in reply
+    assert "Seller Name" not in reply
+
+
+def test_extraction_replies_pass_validation():
+    fields = ["Seller Name", "Seller Zip Code", "Seller Email address", "Seller WorkPhone /Ext:", "Loan Amount"]
+    client = FakeOpenAIClient(fields=fields, reply_format="json")
+    answers = json.loads(client.reply_for(build_extraction_prompt("Extract the fields.", fields, PAGE_TEXT)))
+    assert set(answers) == set(fields)
+    assert validate_answers(answers) == answers
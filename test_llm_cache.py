@@ -0,0 +1,19 @@
+import time
+from llm_cache import LLMCache
+
+
+def test_entries_read_from_disk_keep_their_ttl(tmp_path, monkeypatch):
+    cache = LLMCache(str(tmp_path), ttl_seconds=10, enabled=True)
+    key = cache.key_for("model", None, [{"role": "user", "content": "hello"}], 100)
+    written_at = time.time()
+    cache.set(key, "cached answer")
+
+    # a new process: only the disk tier has the entry, it is read 8 seconds after it was written
+    cache = LLMCache(str(tmp_path), ttl_seconds=10, enabled=True)
+    monkeypatch.setattr(time, "time", lambda: written_at + 8)
+    assert cache.get(key) == "cached answer"
+    assert cache.disk_hits == 1
+
+    # 11 seconds after it was written it has expired, even though it was read from disk 3 seconds ago
+    monkeypatch.setattr(time, "time", lambda: written_at + 11)
+    assert cache.get(key) is None
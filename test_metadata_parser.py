@@ -0,0 +1,52 @@
+from metadata_parser import parse_extracted_metadata, extract_fields
+
+# field names from new_content.py, two of them end in a colon
+FIELDS = ['Seller Name', 'Seller WorkPhone /Ext:', 'Buyer WorkPhone /Ext:', 'Settlement Date']
+
+
+def test_field_names_with_a_colon():
+    response = """<extracted_metadata>
+[
+Seller WorkPhone /Ext: : 555-123-4567,
+'Confidence score': 90
+]
+[
+Buyer WorkPhone /Ext: : Not provided,
+'Confidence': 100
+]
+[
+'Field'-Seller Name : 'Extracted Value' - John Smith,
+'Confidence score': 95
+]
+[
+'Settlement Date' : 01/02/2024 10:30,
+'Confidence score': 80
+]
+</extracted_metadata>"""
+    parsed = parse_extracted_metadata(response, FIELDS)
+    assert parsed == {
+        'Seller WorkPhone /Ext:': {"value": "555-123-4567", "confidence": 90.0},
+        'Buyer WorkPhone /Ext:': {"value": "Not provided", "confidence": 100.0},
+        'Seller Name': {"value": "John Smith", "confidence": 95.0},
+        'Settlement Date': {"value": "01/02/2024 10:30", "confidence": 80.0},
+    }
+
+
+def test_field_names_with_a_colon_in_plain_lines():
+    response = "Seller WorkPhone /Ext: : 555-123-4567\nBuyer WorkPhone /Ext: 555-765-4321\nSeller Name : John Smith"
+    parsed = parse_extracted_metadata(response, FIELDS)
+    assert parsed['Seller WorkPhone /Ext:']["value"] == "555-123-4567"
+    assert parsed['Buyer WorkPhone /Ext:']["value"] == "555-765-4321"
+    assert parsed['Seller Name']["value"] == "John Smith"
+
+
+def test_not_provided_is_an_answer_and_not_asked_again():
+    calls = []
+
+    def ask(fields_to_ask):
+        calls.append(fields_to_ask)
+        return "\n".join(f"{field} : Not provided" for field in fields_to_ask)
+
+    answers = extract_fields(ask, parse_extracted_metadata, FIELDS, max_attempts=5)
+    assert len(calls) == 1
+    assert all(answers[field]["value"] == "Not provided" for field in FIELDS)
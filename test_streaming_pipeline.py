@@ -0,0 +1,41 @@
+import time
+import random
+from streaming_pipeline import iter_corrected_pages, iter_windows
+
+# 100 characters is 26 estimated tokens, so two pages fit in a 60 token window
+PAGE_TEXT = "x" * 100
+WINDOW_TOKENS = 60
+
+
+def shuffled_correction(seed, page_count):
+    # page i takes delays[i] to correct, so pages finish in a different order for every seed
+    delays = [0.01 * step for step in range(page_count)]
+    random.Random(seed).shuffle(delays)
+
+    def correct_page(page_content):
+        time.sleep(delays[int(page_content.partition(":")[0])])
+        return page_content
+    return correct_page
+
+
+def window_pages(windows):
+    return [[next(iter(page)) for page in window] for window in windows]
+
+
+def test_windows_are_consecutive_pages_whatever_the_completion_order():
+    ocr_output = [{str(number): f"{number}:{PAGE_TEXT}"} for number in range(6)]
+    for seed in range(5):
+        corrected_pages = iter_corrected_pages(ocr_output, shuffled_correction(seed, 6), max_workers=6)
+        windows = list(iter_windows(corrected_pages, WINDOW_TOKENS))
+        assert window_pages(windows) == [["0", "1"], ["2", "3"], ["4", "5"]]
+
+
+def test_skipped_pages_keep_their_place():
+    ocr_output = [{str(number): f"{number}:{PAGE_TEXT}"} for number in range(6)]
+    # pages 1 and 4 have a high OCR confidence and are not corrected
+    page_confidences = {str(number): 0.99 if number in (1, 4) else 0.5 for number in range(6)}
+    corrected_pages = iter_corrected_pages(
+        ocr_output, shuffled_correction(3, 6), max_workers=6, page_confidences=page_confidences,
+        confidence_threshold=0.9,
+    )
+    assert [next(iter(page)) for page in corrected_pages] == ["0", "1", "2", "3", "4", "5"]